@@ -0,0 +1,143 @@
+# coding=utf-8
+# Copyright 2020 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Time of the gradient clipping and AdamW step of a sequence classification model, per parameter or multi-tensor.
+
+The model is built from the config of --model_name_or_path with the attention and alignment options of run_glue.py,
+so that its alignment modules are included. For random gradients, the mean time of clip_grad_norm_ + the per-parameter
+AdamW step is compared to the multi-tensor AdamW with fused clipping, as well as the largest difference between the
+parameters they end up with. The results are written to adamw.tsv in the output dir. Example:
+
+    python benchmark_adamw.py --model_name_or_path albert-base-v2 --att_type soft_weibull --adver_type none \
+        --num_steps 50 --no_cuda --output_dir /tmp/adamw/
+"""
+
+
+import copy
+import logging
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+
+from run_glue import attention_config
+from transformers import AdamW, AutoConfig, AutoModelForSequenceClassification, HfArgumentParser, TrainingArguments
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class AdamWBenchmarkArguments:
+    """
+    Arguments pertaining to the model whose optimizer step is timed.
+    """
+
+    model_name_or_path: str = field(metadata={"help": "Pretrained config name or path of the model to build"})
+    num_steps: int = field(default=20, metadata={"help": "Number of timed optimizer steps, after one warm-up step."})
+    cache_dir: Optional[str] = field(
+        default=None, metadata={"help": "Where do you want to store the pretrained models downloaded from s3"}
+    )
+
+
+def time_steps(model, training_args, num_steps, foreach):
+    """ Mean seconds per clipping + optimizer step and the parameters after them. """
+    model = copy.deepcopy(model).to(training_args.device)
+    no_decay = ["bias", "LayerNorm.weight"]
+    parameters = [
+        {
+            "params": [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)],
+            "weight_decay": training_args.weight_decay,
+        },
+        {"params": [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)], "weight_decay": 0.0},
+    ]
+    optimizer = AdamW(
+        parameters,
+        lr=training_args.learning_rate,
+        eps=training_args.adam_epsilon,
+        foreach=foreach,
+        max_grad_norm=training_args.max_grad_norm if foreach else None,
+    )
+    generator = torch.Generator().manual_seed(training_args.seed)
+    gradients = [torch.randn(p.shape, generator=generator).to(p.device) for p in model.parameters()]
+
+    def step():
+        for p, gradient in zip(model.parameters(), gradients):
+            p.grad = gradient.clone()
+        if not foreach:
+            torch.nn.utils.clip_grad_norm_(model.parameters(), training_args.max_grad_norm)
+        optimizer.step()
+
+    step()
+    if training_args.device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        step()
+    if training_args.device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_steps, [p.detach() for p in model.parameters()]
+
+
+def main():
+    parser = HfArgumentParser((AdamWBenchmarkArguments, TrainingArguments))
+
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        bench_args, training_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        bench_args, training_args = parser.parse_args_into_dataclasses()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    config = AutoConfig.from_pretrained(bench_args.model_name_or_path, cache_dir=bench_args.cache_dir)
+    config.update(attention_config(training_args))
+    model = AutoModelForSequenceClassification.from_config(config)
+    num_tensors = sum(1 for _ in model.parameters())
+
+    seconds, expected = time_steps(model, training_args, bench_args.num_steps, foreach=False)
+    foreach_seconds, params = time_steps(model, training_args, bench_args.num_steps, foreach=True)
+    max_diff = max(float((p - q).abs().max()) for p, q in zip(expected, params))
+
+    rows = [
+        dict(foreach=0, tensors=num_tensors, ms_per_step=seconds * 1000, speedup=1.0, max_abs_diff=0.0),
+        dict(
+            foreach=1,
+            tensors=num_tensors,
+            ms_per_step=foreach_seconds * 1000,
+            speedup=seconds / foreach_seconds,
+            max_abs_diff=max_diff,
+        ),
+    ]
+    for row in rows:
+        logger.info("  ".join("%s = %.4g" % (key, value) for key, value in row.items()))
+
+    os.makedirs(training_args.output_dir, exist_ok=True)
+    output_file = os.path.join(training_args.output_dir, "adamw.tsv")
+    with open(output_file, "w") as writer:
+        writer.write("\t".join(rows[0]) + "\n")
+        for row in rows:
+            writer.write("\t".join("%.6g" % value for value in row.values()) + "\n")
+    logger.info("AdamW benchmark saved in %s", output_file)
+    return rows
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# coding=utf-8
+# Copyright 2020 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Peak memory of one forward (and backward) pass of the (variational) attention encoders.
+
+Every measurement runs in a fresh process, so the peak RSS (or the peak CUDA allocation with --torch_cuda) only
+covers the pass being measured. Example:
+
+    python benchmark_attention_memory.py --model_type albert --att_types soft_attention soft_weibull --seq_len 512
+"""
+
+import argparse
+import multiprocessing
+import resource
+
+import torch
+
+from run_glue import attention_config
+from transformers import AlbertConfig, AlbertModel, BertConfig, BertModel, TrainingArguments
+
+
+MODEL_CLASSES = {
+    "albert": (AlbertConfig, AlbertModel),
+    "bert": (BertConfig, BertModel),
+}
+
+def peak_rss_bytes():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(args, att_type, mode, queue):
+    torch.manual_seed(42)
+    device = torch.device("cuda" if args.torch_cuda else "cpu")
+    training_args = TrainingArguments(
+        output_dir="", att_type=att_type, adver_type="none", att_prior_type="constant", smyrf=False,
+    )
+    config_class, model_class = MODEL_CLASSES[args.model_type]
+    config = config_class.from_pretrained(args.config_name) if args.config_name else config_class()
+    config.num_hidden_layers = args.num_hidden_layers
+    config.max_position_embeddings = max(config.max_position_embeddings, args.seq_len)
+    config.update(attention_config(training_args))
+    model = model_class(config).to(device)
+    model.train(mode == "train")
+
+    input_ids = torch.randint(config.vocab_size, (args.batch_size, args.seq_len), device=device)
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[:, args.seq_len // 2 :] = 0
+
+    if args.torch_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_max_memory_allocated()
+        before = torch.cuda.max_memory_allocated()
+    else:
+        before = peak_rss_bytes()
+
+    if mode == "train":
+        outputs = model(input_ids, attention_mask=attention_mask)
+        outputs[0].float().mean().backward()
+    else:
+        with torch.no_grad():
+            model(input_ids, attention_mask=attention_mask)
+
+    if args.torch_cuda:
+        torch.cuda.synchronize()
+        after = torch.cuda.max_memory_allocated()
+    else:
+        after = peak_rss_bytes()
+    queue.put(after - before)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", default="albert", choices=list(MODEL_CLASSES.keys()))
+    parser.add_argument("--config_name", default=None, help="Pretrained config name or path (default: base config).")
+    parser.add_argument(
+        "--att_types", nargs="+", default=["soft_attention", "soft_weibull", "soft_lognormal"],
+    )
+    parser.add_argument("--modes", nargs="+", default=["inference", "train"], choices=["inference", "train"])
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--seq_len", type=int, default=512)
+    parser.add_argument("--num_hidden_layers", type=int, default=12)
+    parser.add_argument("--torch_cuda", action="store_true", help="Measure peak CUDA allocations instead of RSS.")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    print(f"{args.model_type} batch_size={args.batch_size} seq_len={args.seq_len} layers={args.num_hidden_layers}")
+    for att_type in args.att_types:
+        for mode in args.modes:
+            queue = context.Queue()
+            process = context.Process(target=measure, args=(args, att_type, mode, queue))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print(f"\t{att_type}/{mode}: failed (exit code {process.exitcode})")
+                continue
+            peak = queue.get()
+            print(f"\t{att_type}/{mode}: {peak / 2 ** 20:.1f} MB peak")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+# coding=utf-8
+# Copyright 2020 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Scaling of multi-process CPU data-parallel (gloo) training of a GLUE task, from 1 to N processes on one host.
+
+For every number of processes and of gradient accumulation steps, the Trainer runs --max_steps optimization steps
+with --per_gpu_train_batch_size examples per micro-batch and process (i.e. weak scaling), each process using
+--threads_per_process intra-op threads. The gradients are only all-reduced once per optimization step (no_sync),
+so the all-reduced megabytes per example drop with the accumulation steps; --compare_no_sync also runs every
+configuration with an all-reduce after every micro-batch (--ddp_sync_every_micro_batch). The all-reduce calls and
+bytes are counted by the communication hook of DistributedDataParallel. The training time, the throughput, the
+speedup and the parallel efficiency (relative to the fewest processes with the same accumulation and mode), the
+all-reduce calls per optimization step and the all-reduced megabytes per example are written to cpu_ddp.tsv in the
+output dir. Example:
+
+    python benchmark_cpu_ddp.py --model_name_or_path albert-base-v2 --task_name MRPC --data_dir $GLUE_DIR/MRPC/ \
+        --process_counts 1,2,4 --accumulation_steps 1,4 --threads_per_process 4 --max_steps 20 --compare_no_sync \
+        --output_dir /tmp/mrpc_ddp/
+"""
+
+
+import dataclasses
+import json
+import logging
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import torch
+import torch.multiprocessing as mp
+
+from run_glue import attention_config
+from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer, GlueDataset
+from transformers import GlueDataTrainingArguments as DataTrainingArguments
+from transformers import (
+    AllReduceCounter,
+    HfArgumentParser,
+    Trainer,
+    TrainingArguments,
+    glue_tasks_num_labels,
+    set_seed,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class DdpBenchmarkArguments:
+    """
+    Arguments pertaining to the model and to the numbers of processes to benchmark.
+    """
+
+    model_name_or_path: str = field(metadata={"help": "Path to pretrained model or model identifier"})
+    process_counts: str = field(default="1,2,4", metadata={"help": "Comma-separated numbers of processes."})
+    accumulation_steps: str = field(
+        default="1", metadata={"help": "Comma-separated numbers of gradient accumulation steps."}
+    )
+    threads_per_process: int = field(
+        default=0,
+        metadata={"help": "Intra-op threads of every process, by default the cores divided by the processes."},
+    )
+    compare_no_sync: bool = field(
+        default=False,
+        metadata={"help": "Also run every configuration with an all-reduce after every micro-batch (no no_sync)."},
+    )
+    master_port: int = field(default=29500, metadata={"help": "Port of the gloo rendezvous on localhost."})
+    cache_dir: Optional[str] = field(
+        default=None, metadata={"help": "Where do you want to store the pretrained models downloaded from s3"}
+    )
+
+
+def train_worker(rank, world_size, bench_args, training_args, config, train_dataset, result_file):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(bench_args.master_port)
+    torch.set_num_threads(bench_args.threads_per_process or max(1, os.cpu_count() // world_size))
+    torch.distributed.init_process_group(backend="gloo", rank=rank, world_size=world_size)
+
+    training_args = dataclasses.replace(training_args, local_rank=rank, no_cuda=True)
+    set_seed(training_args.seed)
+    model = AutoModelForSequenceClassification.from_pretrained(
+        bench_args.model_name_or_path, config=config, cache_dir=bench_args.cache_dir
+    )
+    trainer = Trainer(model=model, args=training_args, train_dataset=train_dataset)
+    if world_size > 1:
+        trainer.allreduce_counter = AllReduceCounter()
+
+    torch.distributed.barrier()
+    start = time.perf_counter()
+    output = trainer.train()
+    seconds = time.perf_counter() - start
+
+    if rank == 0:
+        counter = trainer.allreduce_counter or AllReduceCounter()
+        with open(result_file, "w") as writer:
+            json.dump(
+                {
+                    "seconds": seconds,
+                    "global_step": output.global_step,
+                    "loss": output.training_loss,
+                    "allreduce_calls": counter.calls,
+                    "allreduce_bytes": counter.bytes,
+                },
+                writer,
+            )
+    torch.distributed.destroy_process_group()
+
+
+def main():
+    parser = HfArgumentParser((DdpBenchmarkArguments, DataTrainingArguments, TrainingArguments))
+
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        bench_args, data_args, training_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        bench_args, data_args, training_args = parser.parse_args_into_dataclasses()
+    if training_args.max_steps <= 0:
+        raise ValueError("Set --max_steps: the processes are compared on a fixed number of optimization steps")
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    try:
+        num_labels = glue_tasks_num_labels[data_args.task_name]
+    except KeyError:
+        raise ValueError("Task not found: %s" % (data_args.task_name))
+
+    config = AutoConfig.from_pretrained(
+        bench_args.model_name_or_path,
+        num_labels=num_labels,
+        finetuning_task=data_args.task_name,
+        cache_dir=bench_args.cache_dir,
+    )
+    config.update(attention_config(training_args))
+    tokenizer = AutoTokenizer.from_pretrained(bench_args.model_name_or_path, cache_dir=bench_args.cache_dir)
+    # featurized once here, the processes receive a copy
+    train_dataset = GlueDataset(data_args, tokenizer=tokenizer)
+
+    os.makedirs(training_args.output_dir, exist_ok=True)
+    # no checkpoints nor evaluation in the timed loop
+    training_args = dataclasses.replace(
+        training_args, save_steps=0, evaluate_during_training=False, async_evaluation=False
+    )
+
+    rows = []
+    sync_modes = [False, True] if bench_args.compare_no_sync else [training_args.ddp_sync_every_micro_batch]
+    for sync_every_micro_batch in sync_modes:
+        for accumulation_steps in [int(steps) for steps in bench_args.accumulation_steps.split(",")]:
+            baseline = None
+            for world_size in [int(count) for count in bench_args.process_counts.split(",")]:
+                result_file = os.path.join(training_args.output_dir, "cpu_ddp-{}.json".format(world_size))
+                args = dataclasses.replace(
+                    training_args,
+                    gradient_accumulation_steps=accumulation_steps,
+                    ddp_sync_every_micro_batch=sync_every_micro_batch,
+                )
+                mp.spawn(
+                    train_worker,
+                    args=(world_size, bench_args, args, config, train_dataset, result_file),
+                    nprocs=world_size,
+                    join=True,
+                )
+                with open(result_file) as reader:
+                    result = json.load(reader)
+                os.remove(result_file)
+
+                examples_per_step = args.per_gpu_train_batch_size * accumulation_steps * world_size
+                examples = result["global_step"] * examples_per_step
+                row = dict(
+                    processes=world_size,
+                    accumulation_steps=accumulation_steps,
+                    no_sync=float(not sync_every_micro_batch),
+                    seconds=result["seconds"],
+                    examples_per_second=examples / result["seconds"],
+                )
+                baseline = baseline or row
+                row["speedup"] = row["examples_per_second"] / baseline["examples_per_second"]
+                row["efficiency"] = row["speedup"] / (world_size / baseline["processes"])
+                row["allreduce_calls_per_step"] = result["allreduce_calls"] / result["global_step"]
+                row["allreduce_mb_per_example"] = result["allreduce_bytes"] / 2 ** 20 / examples
+                row["loss"] = result["loss"]
+                logger.info("  ".join("%s = %.4f" % (key, value) for key, value in row.items()))
+                rows.append(row)
+
+    output_file = os.path.join(training_args.output_dir, "cpu_ddp.tsv")
+    with open(output_file, "w") as writer:
+        writer.write("\t".join(rows[0]) + "\n")
+        for row in rows:
+            writer.write("\t".join("%.6f" % value for value in row.values()) + "\n")
+    logger.info("CPU data-parallel benchmark saved in %s", output_file)
+    return rows
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# coding=utf-8
+# Copyright 2020 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Latency/accuracy trade-off of the entropy-based early exit of ALBERT on a GLUE dev set.
+
+The model is evaluated at full depth and then with each entropy threshold; the metrics, the evaluation time and the
+mean number of layer iterations run per example are written to early_exit.tsv in the output dir. Example:
+
+    python benchmark_early_exit.py --model_name_or_path /tmp/mrpc_output/ --task_name MRPC \
+        --data_dir $GLUE_DIR/MRPC/ --early_exit_every 2 --entropy_thresholds 0.1,0.2,0.4 --output_dir /tmp/mrpc_exit/
+"""
+
+
+import logging
+import os
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import numpy as np
+
+from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer, EvalPrediction, GlueDataset
+from transformers import GlueDataTrainingArguments as DataTrainingArguments
+from transformers import (
+    HfArgumentParser,
+    Trainer,
+    TrainingArguments,
+    glue_compute_metrics,
+    glue_output_modes,
+    glue_tasks_num_labels,
+    set_seed,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class EarlyExitArguments:
+    """
+    Arguments pertaining to the model and to the exits to benchmark.
+    """
+
+    model_name_or_path: str = field(metadata={"help": "Path to the ALBERT model fine-tuned on the task by run_glue.py"})
+    entropy_thresholds: str = field(
+        default="0.05,0.1,0.2,0.4", metadata={"help": "Comma-separated prediction entropy thresholds to benchmark."}
+    )
+    cache_dir: Optional[str] = field(
+        default=None, metadata={"help": "Where do you want to store the pretrained models downloaded from s3"}
+    )
+
+
+def main():
+    parser = HfArgumentParser((EarlyExitArguments, DataTrainingArguments, TrainingArguments))
+
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        exit_args, data_args, training_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        exit_args, data_args, training_args = parser.parse_args_into_dataclasses()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    set_seed(training_args.seed)
+
+    try:
+        num_labels = glue_tasks_num_labels[data_args.task_name]
+        output_mode = glue_output_modes[data_args.task_name]
+    except KeyError:
+        raise ValueError("Task not found: %s" % (data_args.task_name))
+    if output_mode != "classification":
+        raise ValueError("Entropy-based early exit needs a classification task, not %s" % (data_args.task_name))
+
+    config = AutoConfig.from_pretrained(
+        exit_args.model_name_or_path,
+        num_labels=num_labels,
+        finetuning_task=data_args.task_name,
+        cache_dir=exit_args.cache_dir,
+    )
+    tokenizer = AutoTokenizer.from_pretrained(exit_args.model_name_or_path, cache_dir=exit_args.cache_dir)
+    model = AutoModelForSequenceClassification.from_pretrained(
+        exit_args.model_name_or_path, config=config, cache_dir=exit_args.cache_dir
+    )
+    if not hasattr(model, "early_exit_forward"):
+        raise ValueError("Early exit is only implemented for ALBERT, not %s" % (model.__class__.__name__))
+    # by default, the exits the model was trained with
+    if training_args.early_exit_every:
+        model.early_exit_every = training_args.early_exit_every
+    if not model.early_exit_every:
+        raise ValueError("Set --early_exit_every: the model was not trained with early exits")
+
+    eval_dataset = GlueDataset(data_args, tokenizer=tokenizer, evaluate=True)
+
+    def compute_metrics(p: EvalPrediction) -> Dict:
+        return glue_compute_metrics(data_args.task_name, np.argmax(p.predictions, axis=1), p.label_ids)
+
+    trainer = Trainer(model=model, args=training_args, compute_metrics=compute_metrics)
+
+    # number of layer iterations run by the examples of every evaluation batch
+    exit_layers = []
+    model.register_forward_hook(lambda module, inputs, outputs: exit_layers.append(module.exit_layers))
+
+    rows = []
+    thresholds = [0.0] + [float(threshold) for threshold in exit_args.entropy_thresholds.split(",")]
+    for threshold in thresholds:
+        model.early_exit_entropy = threshold
+        model.exit_layers = None
+        exit_layers.clear()
+
+        start = time.perf_counter()
+        result = trainer.evaluate(eval_dataset=eval_dataset)
+        seconds = time.perf_counter() - start
+
+        if threshold > 0.0:
+            mean_layers = float(np.mean(np.concatenate([layers.cpu().numpy() for layers in exit_layers])))
+        else:
+            mean_layers = float(config.num_hidden_layers)
+        row = dict(entropy_threshold=threshold, seconds=seconds, mean_layers=mean_layers)
+        row.update((key, value) for key, value in result.items() if key != "loss")
+        logger.info("  ".join("%s = %.4f" % (key, value) for key, value in row.items()))
+        rows.append(row)
+
+    os.makedirs(training_args.output_dir, exist_ok=True)
+    output_file = os.path.join(training_args.output_dir, "early_exit.tsv")
+    with open(output_file, "w") as writer:
+        writer.write("\t".join(rows[0]) + "\n")
+        for row in rows:
+            writer.write("\t".join("%.6f" % value for value in row.values()) + "\n")
+    logger.info("Early exit benchmark saved in %s", output_file)
+    return rows
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+# coding=utf-8
+# Copyright 2019-present, the HuggingFace Inc. team and Facebook, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Distills a GLUE-finetuned (alignment-trained) ALBERT/BERT teacher from run_glue.py into a shallower student.
+
+The student is initialized from evenly spaced layers of the teacher (ALBERT shares its layers, so its student simply
+runs the shared layers fewer times) and is trained on the task loss, the distillation loss on the logits and an
+alignment-matching loss between each student layer and its teacher layer: the per-head key/query transport costs of
+the act/combine alignment when both models use it, the per-head query/key attention maps otherwise.
+"""
+
+
+import copy
+import dataclasses
+import logging
+import os
+import re
+import sys
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from run_glue import attention_config
+from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer, EvalPrediction, GlueDataset
+from transformers import GlueDataTrainingArguments as DataTrainingArguments
+from transformers import (
+    HfArgumentParser,
+    Trainer,
+    TrainingArguments,
+    glue_compute_metrics,
+    glue_output_modes,
+    glue_tasks_num_labels,
+    set_seed,
+)
+from transformers.modeling_bert import BertSelfAttention
+
+
+logger = logging.getLogger(__name__)
+
+# the adver_type values whose attention layers compute a per-head transport cost (see run_bertology.py)
+ALIGNMENT_ADVER_TYPES = ("act", "act_test", "combine")
+
+
+@dataclass
+class DistillationArguments:
+    """
+    Arguments pertaining to the teacher and the student of the distillation.
+    """
+
+    teacher_name_or_path: str = field(metadata={"help": "Path to the teacher fine-tuned on the task by run_glue.py"})
+    student_num_hidden_layers: int = field(
+        default=6, metadata={"help": "Number of layers of the student, taken evenly spaced from the teacher."}
+    )
+    temperature: float = field(default=2.0, metadata={"help": "Distillation temperature."})
+    alpha_ce: float = field(default=0.5, metadata={"help": "Linear weight of the distillation loss on the logits."})
+    alpha_task: float = field(default=0.5, metadata={"help": "Linear weight of the task loss."})
+    alpha_align: float = field(
+        default=1.0,
+        metadata={
+            "help": "Linear weight of the alignment-matching loss on the per-head transport costs (act/combine "
+            "teacher and student) or attention maps."
+        },
+    )
+    cache_dir: Optional[str] = field(
+        default=None, metadata={"help": "Where do you want to store the pretrained models downloaded from s3"}
+    )
+
+
+def teacher_layer(student_layer, num_student_layers, num_teacher_layers):
+    """ Teacher layer matched with a student layer: the student keeps evenly spaced layers, the last one included. """
+    return (student_layer + 1) * num_teacher_layers // num_student_layers - 1
+
+
+def init_student(teacher, config):
+    """ Student with the embeddings, head and (evenly spaced) layers of the teacher. """
+    layers = None
+    if config.model_type != "albert":
+        layers = {
+            teacher_layer(i, config.num_hidden_layers, teacher.config.num_hidden_layers): i
+            for i in range(config.num_hidden_layers)
+        }
+        config.pruned_heads = {layers[k]: v for k, v in teacher.config.pruned_heads.items() if k in layers}
+
+    student = teacher.__class__(config)
+    state_dict = teacher.state_dict()
+    if layers is not None:
+        student_state_dict = {}
+        for key, value in state_dict.items():
+            match = re.search(r"\.layer\.(\d+)\.", key)
+            if match is None:
+                student_state_dict[key] = value
+            elif int(match.group(1)) in layers:
+                student_key = key[: match.start()] + ".layer.{}.".format(layers[int(match.group(1))])
+                student_state_dict[student_key + key[match.end() :]] = value
+        state_dict = student_state_dict
+
+    missing_keys, unexpected_keys = student.load_state_dict(state_dict, strict=False)
+    if missing_keys:
+        logger.info("Student weights not initialized from the teacher: %s", missing_keys)
+    if unexpected_keys:
+        logger.info("Teacher weights not used by the student: %s", unexpected_keys)
+    return student
+
+
+def alignment_matching_loss(student_attentions, teacher_attentions, attention_mask, eps=1e-12):
+    """
+    KL divergence between the query/key attention map of every head of each student layer and the one of the same
+    head of its teacher layer, averaged over the heads and the non-padding queries. The student keeps the heads of the
+    teacher (and its pruned heads).
+    """
+    valid = attention_mask.to(student_attentions[0].dtype)[:, None]
+    loss = 0.0
+    for i, student_map in enumerate(student_attentions):
+        teacher_map = teacher_attentions[teacher_layer(i, len(student_attentions), len(teacher_attentions))]
+        kl = (teacher_map * (torch.log(teacher_map + eps) - torch.log(student_map + eps))).sum(-1)
+        loss = loss + (kl * valid).sum() / (valid.sum() * kl.size(1))
+    return loss / len(student_attentions)
+
+
+def transport_cost_matching_loss(student_costs, teacher_costs):
+    """
+    Mean squared difference between the per-head transport costs (``head_alignment_cost``) of each student layer and
+    the ones of its teacher layer. The student costs are computed without the gradient reversal of the act/combine
+    alignment loss, so that this loss brings the alignment of the student's keys and queries closer to the teacher's.
+    """
+    loss = 0.0
+    for i, student_cost in enumerate(student_costs):
+        teacher_cost = teacher_costs[teacher_layer(i, len(student_costs), len(teacher_costs))]
+        loss = loss + F.mse_loss(student_cost, teacher_cost)
+    return loss / len(student_costs)
+
+
+class HeadTransportCosts:
+    """
+    Collects the per-head transport costs of the act/combine attention layers of a model, one [H] tensor per layer
+    call (ALBERT calls its shared layers several times), during the forward passes run under :meth:`collect`. The
+    costs are only computed there, as the alignment branches do not run in eval mode otherwise.
+    """
+
+    def __init__(self, model):
+        self.layers = [
+            module
+            for module in model.modules()
+            if isinstance(module, BertSelfAttention) and module.adver_type in ALIGNMENT_ADVER_TYPES
+        ]
+        self.costs: List[torch.Tensor] = []
+        for module in self.layers:
+            module.register_forward_hook(self._record)
+
+    def _record(self, module, inputs, outputs):
+        if module.alignment_statistics:
+            self.costs.append(module.head_alignment_cost)
+
+    @contextmanager
+    def collect(self, enabled: bool = True):
+        self.costs = []
+        layers = self.layers if enabled else []
+        for module in layers:
+            module.alignment_statistics = True
+        try:
+            yield self.costs
+        finally:
+            for module in layers:
+                module.alignment_statistics = False
+                module.head_alignment_cost = None
+
+
+class DistillationTrainer(Trainer):
+    """ Trainer adding the logit distillation and alignment-matching losses of a frozen teacher to the task loss. """
+
+    def __init__(self, teacher, distillation_args, **kwargs):
+        super().__init__(**kwargs)
+        self.teacher = teacher.to(self.args.device).eval()
+        self.distillation_args = distillation_args
+        self.teacher_costs = HeadTransportCosts(self.teacher)
+        self.student_costs = HeadTransportCosts(self.model)
+
+    @property
+    def matches_transport_costs(self) -> bool:
+        """ Whether the alignment-matching loss is on the transport costs rather than on the attention maps. """
+        return bool(self.teacher_costs.layers) and bool(self.student_costs.layers)
+
+    def _compute_loss(self, model, inputs, global_step):
+        args = self.distillation_args
+        match_costs = args.alpha_align > 0.0 and self.matches_transport_costs
+        with self.student_costs.collect(match_costs) as student_costs:
+            loss, outputs = super()._compute_loss(model, inputs, global_step)
+
+        teacher_inputs = {k: v for k, v in inputs.items() if k != "labels"}
+        with torch.no_grad(), self.teacher_costs.collect(match_costs) as teacher_costs:
+            teacher_outputs = self.teacher(**teacher_inputs)
+
+        logits, teacher_logits = outputs[1], teacher_outputs[0]
+        if self.model.num_labels == 1:
+            loss_ce = F.mse_loss(logits.view(-1), teacher_logits.view(-1))
+        else:
+            loss_ce = F.kl_div(
+                F.log_softmax(logits / args.temperature, dim=-1),
+                F.softmax(teacher_logits / args.temperature, dim=-1),
+                reduction="batchmean",
+            ) * (args.temperature ** 2)
+        loss = args.alpha_task * loss + args.alpha_ce * loss_ce
+
+        if match_costs:
+            loss = loss + args.alpha_align * transport_cost_matching_loss(student_costs, teacher_costs)
+        elif args.alpha_align > 0.0:
+            # without hidden states, the attentions follow the (loss and) logits
+            loss = loss + args.alpha_align * alignment_matching_loss(
+                outputs[2], teacher_outputs[1], inputs["attention_mask"]
+            )
+        return loss, outputs
+
+
+def main():
+    parser = HfArgumentParser((DistillationArguments, DataTrainingArguments, TrainingArguments))
+
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        distillation_args, data_args, training_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        distillation_args, data_args, training_args = parser.parse_args_into_dataclasses()
+
+    if (
+        os.path.exists(training_args.output_dir)
+        and os.listdir(training_args.output_dir)
+        and training_args.do_train
+        and not training_args.overwrite_output_dir
+    ):
+        raise ValueError(
+            f"Output directory ({training_args.output_dir}) already exists and is not empty. Use --overwrite_output_dir to overcome."
+        )
+    assert distillation_args.alpha_ce + distillation_args.alpha_task + distillation_args.alpha_align > 0.0
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO if training_args.local_rank in [-1, 0] else logging.WARN,
+    )
+    logger.info("Training/evaluation parameters %s", training_args)
+    set_seed(training_args.seed)
+
+    try:
+        num_labels = glue_tasks_num_labels[data_args.task_name]
+        output_mode = glue_output_modes[data_args.task_name]
+    except KeyError:
+        raise ValueError("Task not found: %s" % (data_args.task_name))
+
+    # The teacher keeps the attention configuration it was trained with, the student gets the one of the arguments
+    teacher_config = AutoConfig.from_pretrained(
+        distillation_args.teacher_name_or_path,
+        num_labels=num_labels,
+        finetuning_task=data_args.task_name,
+        cache_dir=distillation_args.cache_dir,
+    )
+    # the attention maps are only matched when the teacher and the student do not both compute transport costs
+    teacher_config.output_attentions = distillation_args.alpha_align > 0.0 and not (
+        getattr(teacher_config, "adver_type", "none") in ALIGNMENT_ADVER_TYPES
+        and training_args.adver_type in ALIGNMENT_ADVER_TYPES
+    )
+    tokenizer = AutoTokenizer.from_pretrained(distillation_args.teacher_name_or_path, cache_dir=distillation_args.cache_dir)
+    teacher = AutoModelForSequenceClassification.from_pretrained(
+        distillation_args.teacher_name_or_path, config=teacher_config, cache_dir=distillation_args.cache_dir
+    )
+
+    student_config = copy.deepcopy(teacher_config)
+    student_config.num_hidden_layers = distillation_args.student_num_hidden_layers
+    student_config.update(attention_config(training_args))
+    model = init_student(teacher, student_config)
+    logger.info(
+        "Student: %d layers, %.2e parameters (teacher: %d layers, %.2e parameters)",
+        student_config.num_hidden_layers,
+        sum(p.numel() for p in model.parameters()),
+        teacher_config.num_hidden_layers,
+        sum(p.numel() for p in teacher.parameters()),
+    )
+
+    train_dataset = (
+        GlueDataset(data_args, tokenizer=tokenizer, local_rank=training_args.local_rank, num_labels=num_labels,
+                    label_noise=training_args.label_noise)
+        if training_args.do_train
+        else None
+    )
+    eval_dataset = (
+        GlueDataset(data_args, tokenizer=tokenizer, local_rank=training_args.local_rank, evaluate=True)
+        if training_args.do_eval
+        else None
+    )
+
+    def compute_metrics(p: EvalPrediction) -> Dict:
+        if output_mode == "classification":
+            preds = np.argmax(p.predictions, axis=1)
+        elif output_mode == "regression":
+            preds = np.squeeze(p.predictions)
+        return glue_compute_metrics(data_args.task_name, preds, p.label_ids)
+
+    trainer = DistillationTrainer(
+        teacher=teacher,
+        distillation_args=distillation_args,
+        model=model,
+        args=training_args,
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
+        compute_metrics=compute_metrics,
+    )
+
+    if training_args.do_train:
+        trainer.train()
+        # the attentions were only needed by the alignment-matching loss
+        model.config.output_attentions = False
+        trainer.save_model()
+        if trainer.is_world_master():
+            tokenizer.save_pretrained(training_args.output_dir)
+
+    results = {}
+    if training_args.do_eval and training_args.local_rank in [-1, 0]:
+        logger.info("*** Evaluate ***")
+
+        eval_datasets = [eval_dataset]
+        if data_args.task_name == "mnli":
+            mnli_mm_data_args = dataclasses.replace(data_args, task_name="mnli-mm")
+            eval_datasets.append(
+                GlueDataset(mnli_mm_data_args, tokenizer=tokenizer, local_rank=training_args.local_rank, evaluate=True)
+            )
+
+        for eval_dataset in eval_datasets:
+            result = trainer.evaluate(eval_dataset=eval_dataset)
+
+            output_eval_file = os.path.join(
+                training_args.output_dir, f"eval_results_{eval_dataset.args.task_name}.txt"
+            )
+            with open(output_eval_file, "w") as writer:
+                logger.info("***** Eval results {} *****".format(eval_dataset.args.task_name))
+                for key, value in result.items():
+                    logger.info("  %s = %s", key, value)
+                    writer.write("%s = %s\n" % (key, value))
+
+            results.update(result)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
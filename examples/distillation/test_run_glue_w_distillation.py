@@ -0,0 +1,145 @@
+# coding=utf-8
+# Copyright 2020 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import tempfile
+import unittest
+
+import torch
+
+from run_glue import attention_config
+from run_glue_w_distillation import (
+    DistillationArguments,
+    DistillationTrainer,
+    alignment_matching_loss,
+    init_student,
+    transport_cost_matching_loss,
+)
+from transformers import (
+    AlbertConfig,
+    AlbertForSequenceClassification,
+    BertConfig,
+    BertForSequenceClassification,
+    TrainingArguments,
+)
+
+
+class DistillationTrainerTest(unittest.TestCase):
+    def get_trainer(self, adver_type, student_num_hidden_layers=2, bert=False, **kwargs):
+        args = TrainingArguments(
+            output_dir=tempfile.mkdtemp(),
+            no_cuda=True,
+            att_type="soft_attention",
+            adver_type=adver_type,
+            att_prior_type="contextual",
+            att_kl=0.0,
+        )
+        config_class, model_class = AlbertConfig, AlbertForSequenceClassification
+        if bert:
+            config_class, model_class = BertConfig, BertForSequenceClassification
+        config = config_class(
+            vocab_size=99,
+            embedding_size=16,
+            hidden_size=48,
+            num_hidden_layers=4,
+            num_attention_heads=12,
+            intermediate_size=37,
+            num_labels=3,
+            hidden_dropout_prob=0.0,
+            attention_probs_dropout_prob=0.0,
+            output_attentions=adver_type == "none",
+        )
+        config.update(attention_config(args))
+        torch.manual_seed(0)
+        teacher = model_class(config)
+        student_config = config_class.from_dict(config.to_dict())
+        student_config.num_hidden_layers = student_num_hidden_layers
+        student = init_student(teacher, student_config)
+        distillation_args = DistillationArguments(teacher_name_or_path="teacher", **kwargs)
+        return DistillationTrainer(teacher=teacher, distillation_args=distillation_args, model=student, args=args)
+
+    def get_inputs(self):
+        return {
+            "input_ids": torch.tensor([[31, 51, 98, 4, 2], [15, 5, 7, 0, 0]]),
+            "attention_mask": torch.tensor([[1, 1, 1, 1, 1], [1, 1, 1, 0, 0]]),
+            "labels": torch.tensor([0, 2]),
+        }
+
+    def test_alignment_matching_loss_is_per_head(self):
+        attention_mask = torch.ones(2, 5)
+        teacher_map = torch.softmax(torch.randn(2, 12, 5, 5), dim=-1)
+        self.assertAlmostEqual(alignment_matching_loss([teacher_map], [teacher_map], attention_mask).item(), 0.0)
+        # the same head-averaged map, but not the same heads
+        student_map = teacher_map.flip(1)
+        self.assertGreater(alignment_matching_loss([student_map], [teacher_map], attention_mask).item(), 1e-3)
+
+    def test_compute_loss_matches_transport_costs(self):
+        trainer = self.get_trainer("combine", alpha_task=0.0, alpha_ce=0.0, alpha_align=1.0)
+        self.assertTrue(trainer.matches_transport_costs)
+        model = trainer.model.train()
+        loss, outputs = trainer._compute_loss(model, self.get_inputs(), global_step=0)
+        self.assertEqual(len(outputs), 3)  # loss, logits and the alignment term, without attentions
+
+        # one [H] cost per layer call, differentiable for the student only
+        self.assertEqual([cost.shape for cost in trainer.student_costs.costs], [(12,)] * 2)
+        self.assertEqual(len(trainer.teacher_costs.costs), 4)
+        self.assertFalse(any(cost.requires_grad for cost in trainer.teacher_costs.costs))
+        expected = transport_cost_matching_loss(trainer.student_costs.costs, trainer.teacher_costs.costs)
+        self.assertTrue(torch.allclose(loss, expected))
+        self.assertGreater(loss.item(), 0.0)
+        loss.backward()
+        navigator = model.albert.encoder.albert_layer_groups[0].albert_layers[0].attention.se_linear5
+        self.assertGreater(navigator.weight.grad.abs().sum().item(), 0.0)
+        self.assertTrue(all(param.grad is None for param in trainer.teacher.parameters()))
+
+        # the costs are only computed for the loss
+        for module in trainer.student_costs.layers + trainer.teacher_costs.layers:
+            self.assertFalse(module.alignment_statistics)
+            self.assertIsNone(module.head_alignment_cost)
+
+        # a student running the teacher's layers as many times matches it
+        trainer = self.get_trainer("combine", student_num_hidden_layers=4, alpha_task=0.0, alpha_ce=0.0)
+        loss, _ = trainer._compute_loss(trainer.model.train(), self.get_inputs(), global_step=0)
+        self.assertLess(loss.item(), 1e-10)
+
+    def test_transport_cost_matching_step_lowers_loss(self):
+        # ALBERT act and BERT combine reverse the gradient of their alignment loss reaching the keys and queries
+        for adver_type, bert in (("act", False), ("combine", True)):
+            trainer = self.get_trainer(adver_type, bert=bert, alpha_task=0.0, alpha_ce=0.0, alpha_align=1.0)
+            model = trainer.model.train()
+            torch.manual_seed(1)
+            projections = [p for n, p in model.named_parameters() if n.endswith(("query.weight", "key.weight"))]
+            for param in projections:
+                param.data.normal_(0.0, 0.02)
+            optimizer = torch.optim.SGD(projections, lr=1e-2)
+
+            loss, _ = trainer._compute_loss(model, self.get_inputs(), global_step=0)
+            loss.backward()
+            optimizer.step()
+            new_loss, _ = trainer._compute_loss(model, self.get_inputs(), global_step=1)
+            self.assertLess(new_loss.item(), loss.item(), adver_type)
+
+    def test_compute_loss_without_alignment_layers(self):
+        trainer = self.get_trainer("none", alpha_task=0.5, alpha_ce=0.0, alpha_align=1.0)
+        self.assertFalse(trainer.matches_transport_costs)
+        inputs = self.get_inputs()
+        model = trainer.model.train()
+        loss, outputs = trainer._compute_loss(model, inputs, global_step=0)
+        self.assertEqual(trainer.student_costs.costs, [])
+        with torch.no_grad():
+            teacher_inputs = {k: v for k, v in inputs.items() if k != "labels"}
+            teacher_attentions = trainer.teacher(**teacher_inputs)[1]
+        expected = 0.5 * outputs[0] + alignment_matching_loss(outputs[2], teacher_attentions, inputs["attention_mask"])
+        self.assertTrue(torch.allclose(loss, expected))
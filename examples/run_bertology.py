@@ -16,12 +16,15 @@
     - compute the entropy of the head attentions
     - compute the importance of each head
     - prune (remove) the low importance head.
+    - prune heads down to FLOP budgets, ranking them by importance and, for the act/combine alignment models, by how
+      well their keys align with their queries, and save the pruned models with their speed/accuracy curve.
     Some parts of this script are adapted from the code of Michel et al. (http://arxiv.org/abs/1905.10650)
     which is available at https://github.com/pmichel31415/are-16-heads-really-better-than-1
 """
 import argparse
 import logging
 import os
+import time
 from datetime import datetime
 
 import numpy as np
@@ -41,10 +44,14 @@ from transformers import (
     glue_processors,
     set_seed,
 )
+from transformers.modeling_bert import BertSelfAttention
 
 
 logger = logging.getLogger(__name__)
 
+# attention layers whose alignment branch computes a transport cost per head
+ALIGNMENT_ADVER_TYPES = ("act", "act_test", "combine")
+
 
 def entropy(p):
     """ Compute the entropy of a probability distribution """
@@ -91,8 +98,8 @@ def compute_heads_importance(
         loss, logits, all_attentions = (
             outputs[0],
             outputs[1],
-            outputs[-1],
-        )  # Loss and logits are the first, attention the last
+            outputs[3] if model.config.output_hidden_states else outputs[2],
+        )  # Loss and logits are the first, then the (hidden states and) attentions, the KL terms are last
         loss.backward()  # Backpropagate to populate the gradients in the head mask
 
         if compute_entropy:
@@ -232,6 +239,185 @@ def prune_heads(args, model, eval_dataloader, head_mask):
     logger.info("Pruning: speed ratio (new timing / original timing): %f percents", original_time / new_time * 100)
 
 
+def unwrap_model(model):
+    return model.module if hasattr(model, "module") else model
+
+
+def attention_layers(model):
+    """
+    The prunable attention layers of the model, in the order of the layer indices of `prune_heads`, with the row of
+    the head mask each of them reads and the number of times it runs in a forward pass. ALBERT shares its layers:
+    the inner layer `k` of group `g` is pruned as layer `g * inner_group_num + k`, reads the head mask row of its
+    first call and runs once per hidden layer of its group.
+    """
+    model = unwrap_model(model)
+    config = model.config
+    modules = [module for module in model.modules() if isinstance(module, BertSelfAttention)]
+    if config.model_type != "albert":
+        return [(module, layer, 1) for layer, module in enumerate(modules)]
+
+    layers_per_group = config.num_hidden_layers // config.num_hidden_groups
+    rows = [
+        group * layers_per_group + inner
+        for group in range(config.num_hidden_groups)
+        for inner in range(config.inner_group_num)
+    ]
+    return [(module, row, layers_per_group) for module, row in zip(modules, rows)]
+
+
+def compute_heads_alignment(args, model, eval_dataloader):
+    """ Mean transport cost between the keys and the queries of every head of the act/combine alignment layers. """
+    layers = [module for module, _, _ in attention_layers(model)]
+    if not any(module.adver_type in ALIGNMENT_ADVER_TYPES for module in layers):
+        return None
+
+    config = unwrap_model(model).config
+    n_heads = config.num_attention_heads
+    head_cost = torch.zeros(len(layers), n_heads).to(args.device)
+    calls = torch.zeros(len(layers), 1).to(args.device)
+    # the costs of a pruned layer only cover its remaining heads, put them back at their original positions
+    kept_heads = [
+        torch.tensor(sorted(set(range(n_heads)) - set(config.pruned_heads.get(layer, []))), device=args.device)
+        for layer in range(len(layers))
+    ]
+
+    def accumulate(module, inputs, outputs):
+        layer = layers.index(module)
+        head_cost[layer, kept_heads[layer]] += module.head_alignment_cost
+        calls[layer] += 1
+
+    handles = []
+    for module in layers:
+        if module.adver_type in ALIGNMENT_ADVER_TYPES:
+            module.alignment_statistics = True
+            handles.append(module.register_forward_hook(accumulate))
+    try:
+        with torch.no_grad():
+            for inputs in tqdm(eval_dataloader, desc="Alignment", disable=args.local_rank not in [-1, 0]):
+                model(**{k: v.to(args.device) for k, v in inputs.items()})
+    finally:
+        for handle in handles:
+            handle.remove()
+        for module in layers:
+            module.alignment_statistics = False
+            module.head_alignment_cost = None
+
+    head_cost /= calls.clamp(min=1)
+    np.save(os.path.join(args.output_dir, "head_alignment_cost.npy"), head_cost.detach().cpu().numpy())
+    logger.info("Head alignment costs")
+    print_2d_tensor(head_cost)
+    return head_cost
+
+
+def evaluate(args, model, eval_dataloader):
+    """ Metric of the model on the evaluation set and wall time of the evaluation, in seconds. """
+    preds, labels = [], []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for inputs in tqdm(eval_dataloader, desc="Evaluation", disable=args.local_rank not in [-1, 0]):
+            inputs = {k: v.to(args.device) for k, v in inputs.items()}
+            preds.append(model(**inputs)[1].cpu().numpy())
+            labels.append(inputs["labels"].cpu().numpy())
+    if args.device.type == "cuda":
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start
+
+    preds, labels = np.concatenate(preds), np.concatenate(labels)
+    preds = np.argmax(preds, axis=1) if args.output_mode == "classification" else np.squeeze(preds)
+    return glue_compute_metrics(args.task_name, preds, labels)[args.metric_name], seconds
+
+
+def head_flops(config, seq_len):
+    """ FLOPs of one head in one attention layer call: its q/k/v/output projections, scores and context. """
+    head_size = config.hidden_size // config.num_attention_heads
+    return 8 * seq_len * config.hidden_size * head_size + 4 * seq_len * seq_len * head_size
+
+
+def prune_to_flop_budgets(args, model, tokenizer, eval_dataloader, head_importance, head_alignment=None):
+    """ Prunes the heads with the lowest scores until the attention FLOPs fit each budget, from the largest one.
+
+        Heads are ranked once, on the unpruned model, by their importance plus `args.alignment_weight` times their
+        normalized alignment (the negated transport cost between their keys and queries, so the heads that align
+        best are kept first). Every layer keeps at least one head. The model pruned to each budget is saved to
+        `output_dir/pruned-<budget>` and the score/speed curve to `output_dir/pruning_curve.tsv`.
+    """
+    base_model = unwrap_model(model)
+    layers = attention_layers(model)
+    n_heads = base_model.config.num_attention_heads
+
+    head_scores = head_importance[[row for _, row, _ in layers]].clone()
+    if head_alignment is not None and args.alignment_weight > 0:
+        alignment = -head_alignment
+        alignment = (alignment - alignment.min()) / (alignment.max() - alignment.min() + 1e-20)
+        head_scores += args.alignment_weight * alignment
+    np.save(os.path.join(args.output_dir, "head_scores.npy"), head_scores.detach().cpu().numpy())
+
+    flops_per_head = [head_flops(base_model.config, args.max_seq_length) * calls for _, _, calls in layers]
+    remaining = [module.num_attention_heads for module, _, _ in layers]
+    full_flops = sum(flops * n_heads for flops in flops_per_head)
+    current_flops = sum(flops * heads for flops, heads in zip(flops_per_head, remaining))
+    original_num_params = sum(p.numel() for p in base_model.parameters())
+
+    already_pruned = base_model.config.pruned_heads
+    order = [
+        position
+        for position in head_scores.view(-1).sort()[1].tolist()
+        if position % n_heads not in already_pruned.get(position // n_heads, ())
+    ]
+
+    score, seconds = evaluate(args, model, eval_dataloader)
+    original_seconds = seconds
+    curve = [(1.0, sum(remaining), current_flops / full_flops, 1.0, score, seconds, 1.0)]
+    logger.info("Pruning: unpruned score %f in %.2fs", score, seconds)
+
+    for budget in sorted(args.flop_budgets, reverse=True):
+        heads_to_prune = {}
+        for position in list(order):
+            if current_flops <= budget * full_flops:
+                break
+            layer, head = divmod(position, n_heads)
+            if remaining[layer] <= 1:
+                continue
+            order.remove(position)
+            heads_to_prune.setdefault(layer, []).append(head)
+            remaining[layer] -= 1
+            current_flops -= flops_per_head[layer]
+        base_model.prune_heads(heads_to_prune)
+
+        score, seconds = evaluate(args, model, eval_dataloader)
+        num_params = sum(p.numel() for p in base_model.parameters())
+        curve.append(
+            (
+                budget,
+                sum(remaining),
+                current_flops / full_flops,
+                num_params / original_num_params,
+                score,
+                seconds,
+                original_seconds / seconds,
+            )
+        )
+        logger.info(
+            "Pruning: budget %.2f, %d heads left (%.1f percents of the attention FLOPs), score %f, speedup %.2fx",
+            budget,
+            sum(remaining),
+            current_flops / full_flops * 100,
+            score,
+            original_seconds / seconds,
+        )
+
+        output_dir = os.path.join(args.output_dir, f"pruned-{budget:g}")
+        os.makedirs(output_dir, exist_ok=True)
+        base_model.save_pretrained(output_dir)
+        tokenizer.save_pretrained(output_dir)
+
+    with open(os.path.join(args.output_dir, "pruning_curve.tsv"), "w") as writer:
+        writer.write("budget\theads\tattention_flops\tparams\tscore\tseconds\tspeedup\n")
+        for row in curve:
+            writer.write("%g\t%d\t%.4f\t%.4f\t%.6f\t%.3f\t%.3f\n" % row)
+    return curve
+
+
 def main():
     parser = argparse.ArgumentParser()
     # Required parameters
@@ -315,6 +501,21 @@ def main():
         "--masking_amount", default=0.1, type=float, help="Amount to heads to masking at each masking step."
     )
     parser.add_argument("--metric_name", default="acc", type=str, help="Metric to use for head masking.")
+    parser.add_argument(
+        "--flop_budgets",
+        nargs="+",
+        type=float,
+        default=None,
+        help="Prune heads until the attention FLOPs are at most each of these fractions of the unpruned model "
+        "(e.g. 0.9 0.75 0.5), saving each pruned model and the speed/accuracy curve.",
+    )
+    parser.add_argument(
+        "--alignment_weight",
+        default=0.5,
+        type=float,
+        help="Weight of the key/query alignment of the act/combine heads in the pruning scores (0 to only use the "
+        "head importance).",
+    )
 
     parser.add_argument(
         "--max_seq_length",
@@ -331,6 +532,8 @@ def main():
     parser.add_argument("--server_ip", type=str, default="", help="Can be used for distant debugging.")
     parser.add_argument("--server_port", type=str, default="", help="Can be used for distant debugging.")
     args = parser.parse_args()
+    if args.flop_budgets and args.try_masking:
+        raise ValueError("--flop_budgets and --try_masking both prune the model, use one of them.")
 
     if args.server_ip and args.server_port:
         # Distant debugging - see https://code.visualstudio.com/docs/python/debugging#_attach-to-a-local-script
@@ -413,7 +616,12 @@ def main():
     )
 
     # Compute head entropy and importance score
-    compute_heads_importance(args, model, eval_dataloader)
+    _, head_importance, _, _ = compute_heads_importance(args, model, eval_dataloader)
+
+    # Prune heads down to each FLOP budget, keeping the important and well aligned heads
+    if args.flop_budgets:
+        head_alignment = compute_heads_alignment(args, model, eval_dataloader)
+        prune_to_flop_budgets(args, model, tokenizer, eval_dataloader, head_importance, head_alignment)
 
     # Try head masking (set heads to zero until the score goes under a threshole)
     # and head pruning (remove masked heads and see the effect on the network)
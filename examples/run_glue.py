@@ -29,6 +29,7 @@ from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTok
 from transformers import GlueDataTrainingArguments as DataTrainingArguments
 from transformers import (
     HfArgumentParser,
+    StreamingMetrics,
     Trainer,
     TrainingArguments,
     glue_compute_metrics,
@@ -61,6 +62,37 @@ class ModelArguments:
     )
 
 
+def attention_config(training_args: TrainingArguments) -> Dict:
+    """ The attention and alignment options of the TrainingArguments, which run_glue.py copies to the model config. """
+    return {"att_type": training_args.att_type,
+            # "opt_type": training_args.opt_type,
+            "adver_type": training_args.adver_type,
+            "rho": training_args.rho,
+            "smyrf": training_args.smyrf,
+            "n_hashes": training_args.n_hashes,
+            "k_cluster_size": training_args.k_cluster_size,
+            "q_cluster_size": training_args.q_cluster_size,
+            "r": training_args.r,
+            "k_weibull": training_args.k_weibull,
+            "att_prior_type": training_args.att_prior_type,
+            "alpha_gamma": training_args.alpha_gamma,
+            "beta_gamma": training_args.beta_gamma,
+            "prior_gamma": training_args.prior_gamma,
+            "three_initial": training_args.three_initial,
+            "sigma_normal_prior": training_args.sigma_normal_prior,
+            "sigma_normal_posterior": training_args.sigma_normal_posterior,
+            "att_contextual_se": training_args.att_contextual_se,
+            "att_se_hid_size": training_args.att_se_hid_size,
+            "att_se_nonlinear": training_args.att_se_nonlinear,
+            "label_noise": training_args.label_noise,
+            "k_parameterization": training_args.k_parameterization,
+            "att_noise_recompute": training_args.att_noise_recompute,
+            "embedding_projection_cache": training_args.embedding_projection_cache,
+            "early_exit_every": training_args.early_exit_every,
+            "early_exit_entropy": training_args.early_exit_entropy,
+            "frozen_layers": training_args.frozen_layers,}
+
+
 def main():
     # See all possible arguments in src/transformers/training_args.py
     # or by passing the --help flag to this script.
@@ -126,29 +158,7 @@ def main():
         model_args.tokenizer_name if model_args.tokenizer_name else model_args.model_name_or_path,
         cache_dir=model_args.cache_dir,
     )
-    va_args_dict = {"att_type": training_args.att_type,
-                    # "opt_type": training_args.opt_type,
-                    "adver_type": training_args.adver_type,
-                    "rho": training_args.rho,
-                    "smyrf": training_args.smyrf,
-                    "n_hashes": training_args.n_hashes,
-                    "k_cluster_size": training_args.k_cluster_size,
-                    "q_cluster_size": training_args.q_cluster_size,
-                    "r": training_args.r,
-                    "k_weibull": training_args.k_weibull,
-                    "att_prior_type": training_args.att_prior_type,
-                    "alpha_gamma": training_args.alpha_gamma,
-                    "beta_gamma": training_args.beta_gamma,
-                    "prior_gamma": training_args.prior_gamma,
-                    "three_initial": training_args.three_initial,
-                    "sigma_normal_prior": training_args.sigma_normal_prior,
-                    "sigma_normal_posterior": training_args.sigma_normal_posterior,
-                    "att_contextual_se": training_args.att_contextual_se,
-                    "att_se_hid_size": training_args.att_se_hid_size,
-                    "att_se_nonlinear": training_args.att_se_nonlinear,
-                    "label_noise": training_args.label_noise,
-                    "k_parameterization": training_args.k_parameterization,}
-    config.update(va_args_dict)
+    config.update(attention_config(training_args))
     model = AutoModelForSequenceClassification.from_pretrained(
         model_args.model_name_or_path,
         from_tf=bool(".ckpt" in model_args.model_name_or_path),
@@ -159,22 +169,32 @@ def main():
     # Get datasets
     train_dataset = (
         GlueDataset(data_args, tokenizer=tokenizer, local_rank=training_args.local_rank, num_labels=num_labels,
-                    label_noise=training_args.label_noise)
+                    label_noise=training_args.label_noise, pad_to_max_length=not training_args.dynamic_padding)
         if training_args.do_train
         else None
     )
     eval_dataset = (
-        GlueDataset(data_args, tokenizer=tokenizer, local_rank=training_args.local_rank, evaluate=True)
+        GlueDataset(data_args, tokenizer=tokenizer, local_rank=training_args.local_rank, evaluate=True,
+                    pad_to_max_length=not training_args.dynamic_padding)
         if training_args.do_eval
         else None
     )
 
-    def compute_metrics(p: EvalPrediction) -> Dict:
-        if output_mode == "classification":
-            preds = np.argmax(p.predictions, axis=1)
-        elif output_mode == "regression":
-            preds = np.squeeze(p.predictions)
-        return glue_compute_metrics(data_args.task_name, preds, p.label_ids)
+    class GlueMetrics(StreamingMetrics):
+        """ Only keeps the predicted label (or score) of every example instead of its logits. """
+
+        def reset(self):
+            self.preds, self.label_ids = [], []
+
+        def update(self, p: EvalPrediction):
+            if output_mode == "classification":
+                self.preds.append(np.argmax(p.predictions, axis=1))
+            elif output_mode == "regression":
+                self.preds.append(np.squeeze(p.predictions, axis=1))
+            self.label_ids.append(p.label_ids)
+
+        def compute(self) -> Dict:
+            return glue_compute_metrics(data_args.task_name, np.concatenate(self.preds), np.concatenate(self.label_ids))
 
     # Initialize our Trainer
     trainer = Trainer(
@@ -182,7 +202,7 @@ def main():
         args=training_args,
         train_dataset=train_dataset,
         eval_dataset=eval_dataset,
-        compute_metrics=compute_metrics,
+        compute_metrics=GlueMetrics(),
     )
 
     # Training
@@ -206,7 +226,13 @@ def main():
         if data_args.task_name == "mnli":
             mnli_mm_data_args = dataclasses.replace(data_args, task_name="mnli-mm")
             eval_datasets.append(
-                GlueDataset(mnli_mm_data_args, tokenizer=tokenizer, local_rank=training_args.local_rank, evaluate=True)
+                GlueDataset(
+                    mnli_mm_data_args,
+                    tokenizer=tokenizer,
+                    local_rank=training_args.local_rank,
+                    evaluate=True,
+                    pad_to_max_length=not training_args.dynamic_padding,
+                )
             )
 
         for eval_dataset in eval_datasets:
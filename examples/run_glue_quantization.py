@@ -0,0 +1,156 @@
+# coding=utf-8
+# Copyright 2020 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Dynamic int8 quantization of a GLUE-finetuned (alignment-trained) BERT/ALBERT model from run_glue.py.
+
+The query/key/value, attention output and feed-forward linear layers are quantized, the alignment modules stay in
+float. The quantized model is only saved if its dev-set metric stays within --max_accuracy_drop of the float model.
+"""
+
+
+import dataclasses
+import logging
+import os
+import sys
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import numpy as np
+
+from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer, EvalPrediction, GlueDataset
+from transformers import GlueDataTrainingArguments as DataTrainingArguments
+from transformers import (
+    HfArgumentParser,
+    Trainer,
+    TrainingArguments,
+    glue_compute_metrics,
+    glue_output_modes,
+    glue_tasks_num_labels,
+    quantize_dynamic,
+    set_seed,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class QuantizationArguments:
+    """
+    Arguments pertaining to the model to quantize and to the accuracy guard.
+    """
+
+    model_name_or_path: str = field(metadata={"help": "Path to the model fine-tuned on the task by run_glue.py"})
+    metric_name: str = field(
+        default="acc", metadata={"help": "Dev-set metric compared before and after quantization, e.g. acc, f1, mcc"}
+    )
+    max_accuracy_drop: float = field(
+        default=0.01, metadata={"help": "Largest drop of the metric for which the quantized model is saved."}
+    )
+    cache_dir: Optional[str] = field(
+        default=None, metadata={"help": "Where do you want to store the pretrained models downloaded from s3"}
+    )
+
+
+def main():
+    parser = HfArgumentParser((QuantizationArguments, DataTrainingArguments, TrainingArguments))
+
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        quantization_args, data_args, training_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        quantization_args, data_args, training_args = parser.parse_args_into_dataclasses()
+
+    if (
+        os.path.exists(training_args.output_dir)
+        and os.listdir(training_args.output_dir)
+        and not training_args.overwrite_output_dir
+    ):
+        raise ValueError(
+            f"Output directory ({training_args.output_dir}) already exists and is not empty. Use --overwrite_output_dir to overcome."
+        )
+    # dynamically quantized linear layers only run on CPU
+    training_args = dataclasses.replace(training_args, no_cuda=True, local_rank=-1)
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    logger.info("Evaluation parameters %s", training_args)
+    set_seed(training_args.seed)
+
+    try:
+        num_labels = glue_tasks_num_labels[data_args.task_name]
+        output_mode = glue_output_modes[data_args.task_name]
+    except KeyError:
+        raise ValueError("Task not found: %s" % (data_args.task_name))
+
+    config = AutoConfig.from_pretrained(
+        quantization_args.model_name_or_path,
+        num_labels=num_labels,
+        finetuning_task=data_args.task_name,
+        cache_dir=quantization_args.cache_dir,
+    )
+    tokenizer = AutoTokenizer.from_pretrained(
+        quantization_args.model_name_or_path, cache_dir=quantization_args.cache_dir
+    )
+    model = AutoModelForSequenceClassification.from_pretrained(
+        quantization_args.model_name_or_path, config=config, cache_dir=quantization_args.cache_dir
+    )
+    eval_dataset = GlueDataset(data_args, tokenizer=tokenizer, evaluate=True)
+
+    def compute_metrics(p: EvalPrediction) -> Dict:
+        if output_mode == "classification":
+            preds = np.argmax(p.predictions, axis=1)
+        elif output_mode == "regression":
+            preds = np.squeeze(p.predictions)
+        return glue_compute_metrics(data_args.task_name, preds, p.label_ids)
+
+    results = {}
+    for name, evaluated_model in (("float", model), ("int8", quantize_dynamic(model))):
+        trainer = Trainer(model=evaluated_model, args=training_args, compute_metrics=compute_metrics)
+        result = trainer.evaluate(eval_dataset=eval_dataset)
+        logger.info("***** Eval results {} ({}) *****".format(data_args.task_name, name))
+        for key, value in result.items():
+            logger.info("  %s = %s", key, value)
+        results[name] = result
+
+    metric = quantization_args.metric_name
+    if metric not in results["float"]:
+        raise ValueError(
+            "Metric {} not computed for {}, use one of {}".format(metric, data_args.task_name, list(results["float"]))
+        )
+    drop = results["float"][metric] - results["int8"][metric]
+    if drop > quantization_args.max_accuracy_drop:
+        raise ValueError(
+            "Quantization drops {} by {:.4f} (> {}), the quantized model is not saved".format(
+                metric, drop, quantization_args.max_accuracy_drop
+            )
+        )
+
+    logger.info("Quantization drops %s by %.4f, saving the quantized model", metric, drop)
+    trainer.save_model()
+    tokenizer.save_pretrained(training_args.output_dir)
+
+    output_eval_file = os.path.join(training_args.output_dir, f"eval_results_{data_args.task_name}.txt")
+    with open(output_eval_file, "w") as writer:
+        for name, result in results.items():
+            for key, value in result.items():
+                writer.write("%s_%s = %s\n" % (name, key, value))
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
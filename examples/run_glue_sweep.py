@@ -0,0 +1,266 @@
+# coding=utf-8
+# Copyright 2020 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Hyperparameter sweep of the attention and alignment options of run_glue.py, with successive halving.
+
+The features and the pretrained weights are loaded once, then the trials are trained by a pool of worker processes,
+each pinned to its share of the CPU cores. With n trials and a reduction factor eta, the trials are first trained
+for --max_steps / eta^k steps; only the best 1/eta of them on the dev set are retrained with eta times more steps,
+and so on until the last ones are trained for --max_steps. Every trial of a rung is retrained from the pretrained
+weights, so that its learning rate schedule completes. The dev metrics of all the trials of all the rungs are
+written to sweep.tsv in the output dir. Example:
+
+    python run_glue_sweep.py --model_name_or_path albert-base-v2 --task_name MRPC --data_dir $GLUE_DIR/MRPC/ \
+        --search_space '{"att_kl": [0.01, 0.1, 1.0], "att_type": ["soft_weibull", "soft_lognormal", "gamma_att"]}' \
+        --max_steps 900 --reduction_factor 3 --num_workers 4 --metric acc --output_dir /tmp/mrpc_sweep/
+"""
+
+
+import copy
+import dataclasses
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import sys
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+from run_glue import attention_config
+from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer, EvalPrediction, GlueDataset
+from transformers import GlueDataTrainingArguments as DataTrainingArguments
+from transformers import (
+    HfArgumentParser,
+    Trainer,
+    TrainingArguments,
+    glue_compute_metrics,
+    glue_output_modes,
+    glue_tasks_num_labels,
+    set_seed,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SweepArguments:
+    """
+    Arguments pertaining to the model and to the hyperparameters to sweep.
+    """
+
+    model_name_or_path: str = field(metadata={"help": "Path to pretrained model or model identifier"})
+    search_space: str = field(
+        metadata={
+            "help": "JSON object (or path to a JSON file) mapping TrainingArguments fields to the list of their "
+            'values to try, e.g. \'{"att_kl": [0.01, 0.1], "adver_type": ["none", "gan"]}\'.'
+        }
+    )
+    num_trials: int = field(
+        default=0, metadata={"help": "Number of configurations sampled from the grid, by default the whole grid."}
+    )
+    reduction_factor: int = field(default=3, metadata={"help": "Successive halving keeps 1/reduction_factor trials."})
+    num_workers: int = field(default=1, metadata={"help": "Number of worker processes sharing the CPU cores."})
+    metric: str = field(default="acc", metadata={"help": "Dev metric to maximize (or to minimize if it is loss)."})
+    cache_dir: Optional[str] = field(
+        default=None, metadata={"help": "Where do you want to store the pretrained models downloaded from s3"}
+    )
+
+
+def sample_trials(search_space: Dict[str, List], num_trials: int, seed: int) -> List[Dict]:
+    """ The configurations of the grid, or ``num_trials`` of them sampled without replacement. """
+    names = sorted(search_space)
+    trials = [dict(zip(names, values)) for values in itertools.product(*(search_space[name] for name in names))]
+    if 0 < num_trials < len(trials):
+        trials = random.Random(seed).sample(trials, num_trials)
+    return trials
+
+
+def successive_halving_steps(num_trials: int, max_steps: int, reduction_factor: int) -> List[int]:
+    """ Training steps of the trials of every rung, the last rung being trained for ``max_steps``. """
+    num_rungs = 1 + int(math.log(num_trials, reduction_factor) + 1e-9) if num_trials > 1 else 1
+    return [max(1, max_steps // reduction_factor ** (num_rungs - 1 - rung)) for rung in range(num_rungs)]
+
+
+def pretrained_state_dict(model_name_or_path: str, config, cache_dir: Optional[str] = None) -> Dict:
+    """ The pretrained weights, without the newly initialized modules (classifier, alignment modules, ...). """
+    model, loading_info = AutoModelForSequenceClassification.from_pretrained(
+        model_name_or_path, config=config, cache_dir=cache_dir, output_loading_info=True
+    )
+    prefix = model.base_model_prefix + "."
+    missing_keys = set(loading_info["missing_keys"])
+    return {
+        name: param
+        for name, param in model.state_dict().items()
+        if name not in missing_keys and (not name.startswith(prefix) or name[len(prefix) :] not in missing_keys)
+    }
+
+
+# set by main before the workers are forked, which share them with the parent
+_shared = {}
+
+
+def _init_worker(cores_queue):
+    cores = cores_queue.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+
+def run_trial(trial):
+    trial_id, params, max_steps = trial
+    training_args = _shared["training_args"]
+    output_dir = os.path.join(training_args.output_dir, "trial-{}".format(trial_id))
+    args = dataclasses.replace(
+        training_args,
+        output_dir=output_dir,
+        logging_dir=os.path.join(output_dir, "runs"),
+        max_steps=max_steps,
+        **params,
+    )
+    config = copy.deepcopy(_shared["config"])
+    config.update(attention_config(args))
+
+    set_seed(args.seed)
+    model = AutoModelForSequenceClassification.from_pretrained(None, config=config, state_dict=_shared["state_dict"])
+    trainer = Trainer(
+        model=model,
+        args=args,
+        train_dataset=_shared["train_dataset"],
+        eval_dataset=_shared["eval_dataset"],
+        compute_metrics=_shared["compute_metrics"],
+    )
+    trainer.train()
+    return trial_id, trainer.evaluate()
+
+
+def main():
+    parser = HfArgumentParser((SweepArguments, DataTrainingArguments, TrainingArguments))
+
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        sweep_args, data_args, training_args = parser.parse_json_file(json_file=os.path.abspath(sys.argv[1]))
+    else:
+        sweep_args, data_args, training_args = parser.parse_args_into_dataclasses()
+    if training_args.max_steps <= 0:
+        raise ValueError("Set --max_steps: the training steps of the trials of the last rung")
+
+    if os.path.isfile(sweep_args.search_space):
+        with open(sweep_args.search_space) as reader:
+            search_space = json.load(reader)
+    else:
+        search_space = json.loads(sweep_args.search_space)
+    unknown = set(search_space) - set(arg.name for arg in dataclasses.fields(TrainingArguments))
+    if unknown:
+        raise ValueError("Not TrainingArguments fields: %s" % (", ".join(sorted(unknown))))
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    try:
+        num_labels = glue_tasks_num_labels[data_args.task_name]
+        output_mode = glue_output_modes[data_args.task_name]
+    except KeyError:
+        raise ValueError("Task not found: %s" % (data_args.task_name))
+
+    def compute_metrics(p: EvalPrediction) -> Dict:
+        if output_mode == "classification":
+            preds = np.argmax(p.predictions, axis=1)
+        else:
+            preds = np.squeeze(p.predictions)
+        return glue_compute_metrics(data_args.task_name, preds, p.label_ids)
+
+    # the workers train on their own cores, without checkpoints, and share the cached activations of frozen layers
+    training_args = dataclasses.replace(
+        training_args,
+        no_cuda=True,
+        save_steps=0,
+        frozen_activations_dir=training_args.frozen_activations_dir or training_args.output_dir,
+    )
+    config = AutoConfig.from_pretrained(
+        sweep_args.model_name_or_path,
+        num_labels=num_labels,
+        finetuning_task=data_args.task_name,
+        cache_dir=sweep_args.cache_dir,
+    )
+    config.update(attention_config(training_args))
+    tokenizer = AutoTokenizer.from_pretrained(sweep_args.model_name_or_path, cache_dir=sweep_args.cache_dir)
+    _shared.update(
+        training_args=training_args,
+        config=config,
+        state_dict=pretrained_state_dict(sweep_args.model_name_or_path, config, sweep_args.cache_dir),
+        train_dataset=GlueDataset(
+            data_args,
+            tokenizer=tokenizer,
+            num_labels=num_labels,
+            label_noise=training_args.label_noise,
+            pad_to_max_length=not training_args.dynamic_padding,
+        ),
+        eval_dataset=GlueDataset(
+            data_args, tokenizer=tokenizer, evaluate=True, pad_to_max_length=not training_args.dynamic_padding
+        ),
+        compute_metrics=compute_metrics,
+    )
+
+    trials = sample_trials(search_space, sweep_args.num_trials, training_args.seed)
+    rung_steps = successive_halving_steps(len(trials), training_args.max_steps, sweep_args.reduction_factor)
+    logger.info("%d trials, trained for %s steps in the successive rungs", len(trials), rung_steps)
+
+    # fork once the features and weights are loaded: the workers share them with the parent
+    context = multiprocessing.get_context("fork")
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    num_workers = min(sweep_args.num_workers, len(cores))
+    cores_queue = context.Queue()
+    for worker in range(num_workers):
+        cores_queue.put(cores[worker::num_workers])
+
+    rows = []
+    trial_ids = list(range(len(trials)))
+    with context.Pool(num_workers, initializer=_init_worker, initargs=(cores_queue,)) as pool:
+        for rung, max_steps in enumerate(rung_steps):
+            results = dict(pool.imap_unordered(run_trial, [(i, trials[i], max_steps) for i in trial_ids]))
+            for trial_id in trial_ids:
+                row = dict(trial=trial_id, rung=rung, steps=max_steps)
+                row.update(trials[trial_id])
+                row.update(results[trial_id])
+                logger.info("  ".join("%s = %s" % (key, value) for key, value in row.items()))
+                rows.append(row)
+
+            scores = {trial_id: results[trial_id][sweep_args.metric] for trial_id in trial_ids}
+            trial_ids = sorted(trial_ids, key=scores.get, reverse=sweep_args.metric != "loss")
+            if rung < len(rung_steps) - 1:
+                trial_ids = trial_ids[: max(1, len(trial_ids) // sweep_args.reduction_factor)]
+
+    columns = list(dict.fromkeys(key for row in rows for key in row))
+    output_file = os.path.join(training_args.output_dir, "sweep.tsv")
+    os.makedirs(training_args.output_dir, exist_ok=True)
+    with open(output_file, "w") as writer:
+        writer.write("\t".join(columns) + "\n")
+        for row in rows:
+            writer.write("\t".join(str(row.get(column, "")) for column in columns) + "\n")
+    logger.info("Best trial: %d %s", trial_ids[0], trials[trial_ids[0]])
+    logger.info("Sweep results saved in %s", output_file)
+    return rows
+
+
+if __name__ == "__main__":
+    main()
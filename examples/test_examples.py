@@ -22,6 +22,7 @@ from unittest.mock import patch
 
 import run_generation
 import run_glue
+import run_glue_sweep
 import run_language_modeling
 import run_squad
 
@@ -124,3 +125,28 @@ class ExamplesTests(unittest.TestCase):
         with patch.object(sys, "argv", testargs + [model_type, model_name]):
             result = run_generation.main()
             self.assertGreaterEqual(len(result[0]), 10)
+
+
+class RunGlueSweepTest(unittest.TestCase):
+    def test_sample_trials(self):
+        search_space = {"att_type": ["soft_weibull", "gamma_att", "soft_lognormal"], "att_kl": [0.1, 1.0]}
+        grid = run_glue_sweep.sample_trials(search_space, num_trials=0, seed=42)
+        self.assertEqual(len(grid), 6)
+        self.assertEqual(grid[0], {"att_kl": 0.1, "att_type": "soft_weibull"})
+        self.assertEqual(grid[1], {"att_kl": 0.1, "att_type": "gamma_att"})
+        self.assertEqual(run_glue_sweep.sample_trials(search_space, num_trials=10, seed=42), grid)
+
+        trials = run_glue_sweep.sample_trials(search_space, num_trials=4, seed=42)
+        self.assertEqual(len(trials), 4)
+        self.assertTrue(all(trial in grid for trial in trials))
+        self.assertEqual(len({tuple(sorted(trial.items())) for trial in trials}), 4)
+        self.assertEqual(trials, run_glue_sweep.sample_trials(search_space, num_trials=4, seed=42))
+
+    def test_successive_halving_steps(self):
+        self.assertEqual(run_glue_sweep.successive_halving_steps(1, 900, 3), [900])
+        self.assertEqual(run_glue_sweep.successive_halving_steps(3, 900, 3), [300, 900])
+        self.assertEqual(run_glue_sweep.successive_halving_steps(4, 900, 3), [300, 900])
+        self.assertEqual(run_glue_sweep.successive_halving_steps(9, 900, 3), [100, 300, 900])
+        self.assertEqual(run_glue_sweep.successive_halving_steps(8, 800, 2), [100, 200, 400, 800])
+        # every rung trains for at least one step
+        self.assertEqual(run_glue_sweep.successive_halving_steps(27, 10, 3), [1, 1, 3, 10])
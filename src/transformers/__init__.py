@@ -328,8 +328,31 @@ if is_torch_available():
     )
 
     # Trainer
-    from .trainer import Trainer, set_seed, torch_distributed_zero_first, EvalPrediction
-    from .data.data_collator import DefaultDataCollator, DataCollator, DataCollatorForLanguageModeling
+    from .trainer import (
+        Trainer,
+        set_seed,
+        torch_distributed_zero_first,
+        EvalPrediction,
+        StreamingMetrics,
+        AllReduceCounter,
+    )
+    from .attention_store import AttentionRecorder, AttentionStore
+    from .modeling_export import (
+        export_onnx,
+        export_torchscript,
+        load_onnxruntime,
+        quantize_dynamic,
+        specialize_for_inference,
+    )
+    from .data.data_collator import (
+        DefaultDataCollator,
+        DataCollator,
+        DataCollatorForLanguageModeling,
+        DataCollatorWithPadding,
+        DataCollatorForFrozenActivations,
+    )
+    from .data.frozen_activations import FrozenActivationDataset
+    from .data.grouped_batch_sampler import GroupedBatchSampler, create_lengths_groups
     from .data.datasets import GlueDataset, TextDataset, LineByLineTextDataset, GlueDataTrainingArguments
 
 # TensorFlow
@@ -0,0 +1,221 @@
+# coding=utf-8
+# Copyright 2020 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Sampled on-disk store for attention maps and alignment transport plans. """
+
+import json
+import logging
+import os
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from .file_utils import is_torch_available
+
+
+if is_torch_available():
+    import torch
+
+
+logger = logging.getLogger(__name__)
+
+DATA_NAME = "maps.bin"
+INDEX_NAME = "index.jsonl"
+STORE_FORMATS = ("float16", "topk")
+
+
+class AttentionRecorder:
+    """
+    Records a random sample of the attention maps (and the `act`/`combine` transport maps) computed by the
+    BertSelfAttention/AlbertAttention layers of a model, without going through `output_attentions`.
+
+    Each sampled example is written as one [G, N, M] record per layer and map kind (G is the head dimension for
+    token-level maps). The maps are appended to `<store_dir>/maps.bin` either as float16 or as the `top_k` largest
+    entries of every row, and each record is described by one JSON line in `<store_dir>/index.jsonl`. Read them back
+    with :class:`AttentionStore`.
+
+    Args:
+        store_dir: directory of the store (created if needed, appended to if it already holds a store).
+        sample_rate: probability for each example of a batch to be recorded.
+        layers: only record these layers (all layers if None). For ALBERT, this is the index of the layer call.
+        heads: only record these heads of the head-level maps (all heads if None).
+        store_format: "float16" for dense maps or "topk" for the `top_k` largest entries of every row.
+        top_k: number of entries kept per row with the "topk" format.
+        seed: seed of the sampling generator, independent from the training RNG.
+    """
+
+    def __init__(
+        self,
+        store_dir: str,
+        sample_rate: float = 0.01,
+        layers: Optional[Iterable[int]] = None,
+        heads: Optional[Iterable[int]] = None,
+        store_format: str = "float16",
+        top_k: int = 32,
+        seed: int = 0,
+    ):
+        if store_format not in STORE_FORMATS:
+            raise ValueError("store_format should be one of {}, got {}".format(STORE_FORMATS, store_format))
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.sample_rate = sample_rate
+        self.layers = set(layers) if layers is not None else None
+        self.heads = sorted(heads) if heads is not None else None
+        self.store_format = store_format
+        self.top_k = top_k
+        self.global_step = None
+        # set to False to skip the forward passes that should not be recorded, e.g. evaluations during training
+        self.recording = True
+
+        self._generator = torch.Generator()
+        self._generator.manual_seed(seed)
+        self._data = open(os.path.join(store_dir, DATA_NAME), "ab")
+        self._index = open(os.path.join(store_dir, INDEX_NAME), "a")
+        self._handles = []
+        self._forward = -1
+        self._layer = -1
+        self._rows = None
+
+    def attach(self, model: "torch.nn.Module") -> "AttentionRecorder":
+        """ Start recording every forward pass of `model`. """
+        from .modeling_bert import BertSelfAttention
+
+        self._handles.append(model.register_forward_pre_hook(self._start_forward))
+        for module in model.modules():
+            if isinstance(module, BertSelfAttention):
+                module.attention_recorder = self
+                self._handles.append(module.register_forward_pre_hook(self._start_layer))
+        return self
+
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def close(self):
+        """ Detach from the model and flush the store to disk. """
+        self.detach()
+        self._data.close()
+        self._index.close()
+
+    def _start_forward(self, module, inputs):
+        if not self.recording:
+            return
+        self._forward += 1
+        self._layer = -1
+        self._rows = None
+
+    def _start_layer(self, module, inputs):
+        if self.recording:
+            self._layer += 1
+
+    def _sample_rows(self, batch_size):
+        if self._rows is None:
+            keep = torch.rand(batch_size, generator=self._generator) < self.sample_rate
+            self._rows = keep.nonzero().view(-1).tolist()
+        return self._rows
+
+    def record(self, kind: str, maps: "torch.Tensor", per_head: bool = True):
+        """
+        Called by the attention layers with a [B, G, N, M] map. Cheap when nothing in the batch is sampled: only
+        the sampled rows (and heads, if `per_head`) are copied to the host.
+        """
+        if not self.recording or self._data.closed or (self.layers is not None and self._layer not in self.layers):
+            return
+        rows = self._sample_rows(maps.size(0))
+        if not rows:
+            return
+
+        with torch.no_grad():
+            maps = maps.detach()[rows]
+            heads = None
+            if per_head and self.heads is not None:
+                heads = self.heads
+                maps = maps[:, heads]
+            if self.store_format == "topk":
+                values, indices = maps.topk(min(self.top_k, maps.size(-1)), dim=-1)
+                index_dtype = torch.int16 if maps.size(-1) <= np.iinfo(np.int16).max else torch.int32
+                values = values.to(torch.float16).cpu().numpy()
+                indices = indices.to(index_dtype).cpu().numpy()
+            else:
+                values = maps.to(torch.float16).cpu().numpy()
+
+        for i, row in enumerate(rows):
+            entry = {
+                "forward": self._forward,
+                "global_step": self.global_step,
+                "row": row,
+                "layer": self._layer,
+                "kind": kind,
+                "heads": heads,
+                "shape": list(maps.shape[1:]),
+                "format": self.store_format,
+                "offset": self._data.tell(),
+            }
+            self._data.write(values[i].tobytes())
+            if self.store_format == "topk":
+                entry["top_k"] = values.shape[-1]
+                entry["index_dtype"] = indices.dtype.name
+                self._data.write(indices[i].tobytes())
+            self._index.write(json.dumps(entry) + "\n")
+
+
+class AttentionStore:
+    """
+    Lazy reader for a store written by :class:`AttentionRecorder`. The data file is memory-mapped, so only the
+    records that are accessed are read from disk.
+
+    Example::
+
+        store = AttentionStore("runs/attention")
+        positions = store.select(kind="attention", layer=0)
+        first = store[positions[0]]  # dense float32 array of shape [heads, L, L]
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_NAME)) as f:
+            self.index: List[Dict] = [json.loads(line) for line in f if line.strip()]
+        self._data = None
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def data(self) -> np.memmap:
+        if self._data is None:
+            self._data = np.memmap(os.path.join(self.store_dir, DATA_NAME), dtype=np.uint8, mode="r")
+        return self._data
+
+    def select(self, **filters) -> List[int]:
+        """ Positions of the records whose index entries match all `filters` (e.g. `kind="m_forward", layer=3`). """
+        return [i for i, entry in enumerate(self.index) if all(entry.get(k) == v for k, v in filters.items())]
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        entry = self.index[i]
+        shape = tuple(entry["shape"])
+        offset = entry["offset"]
+        if entry["format"] == "float16":
+            size = int(np.prod(shape))
+            return self.data[offset : offset + 2 * size].view(np.float16).reshape(shape).astype(np.float32)
+
+        top_k = entry["top_k"]
+        index_dtype = np.dtype(entry["index_dtype"])
+        size = int(np.prod(shape[:-1])) * top_k
+        values = self.data[offset : offset + 2 * size].view(np.float16).reshape(shape[:-1] + (top_k,))
+        offset += 2 * size
+        indices = self.data[offset : offset + index_dtype.itemsize * size].view(index_dtype)
+        dense = np.zeros(shape, dtype=np.float32)
+        np.put_along_axis(dense, indices.reshape(shape[:-1] + (top_k,)).astype(np.int64), values, axis=-1)
+        return dense
@@ -6,11 +6,22 @@ from transformers.commands import BaseTransformersCLICommand
 
 def convert_command_factory(args: Namespace):
     """
-    Factory function used to convert a model TF 1.0 checkpoint in a PyTorch checkpoint.
+    Factory function used to convert a model TF 1.0 checkpoint in a PyTorch checkpoint,
+    or to export a PyTorch model to TorchScript/ONNX.
     :return: ServeCommand
     """
     return ConvertCommand(
-        args.model_type, args.tf_checkpoint, args.pytorch_dump_output, args.config, args.finetuning_task_name
+        args.model_type,
+        args.tf_checkpoint,
+        args.pytorch_dump_output,
+        args.config,
+        args.finetuning_task_name,
+        export_format=args.export_format,
+        model_name_or_path=args.model_name_or_path,
+        export_output=args.export_output,
+        batch_size=args.batch_size,
+        seq_len=args.seq_len,
+        benchmark_runs=args.benchmark_runs,
     )
 
 
@@ -25,15 +36,12 @@ class ConvertCommand(BaseTransformersCLICommand):
         train_parser = parser.add_parser(
             "convert",
             help="CLI tool to run convert model from original "
-            "author checkpoints to Transformers PyTorch checkpoints.",
+            "author checkpoints to Transformers PyTorch checkpoints, "
+            "or to export BERT/ALBERT PyTorch models to TorchScript/ONNX for inference.",
         )
         train_parser.add_argument("--model_type", type=str, required=True, help="Model's type.")
-        train_parser.add_argument(
-            "--tf_checkpoint", type=str, required=True, help="TensorFlow checkpoint path or folder."
-        )
-        train_parser.add_argument(
-            "--pytorch_dump_output", type=str, required=True, help="Path to the PyTorch savd model output."
-        )
+        train_parser.add_argument("--tf_checkpoint", type=str, help="TensorFlow checkpoint path or folder.")
+        train_parser.add_argument("--pytorch_dump_output", type=str, help="Path to the PyTorch savd model output.")
         train_parser.add_argument("--config", type=str, default="", help="Configuration file path or folder.")
         train_parser.add_argument(
             "--finetuning_task_name",
@@ -41,6 +49,30 @@ class ConvertCommand(BaseTransformersCLICommand):
             default=None,
             help="Optional fine-tuning task name if the TF model was a finetuned model.",
         )
+        train_parser.add_argument(
+            "--export_format",
+            type=str,
+            default=None,
+            choices=["torchscript", "onnx"],
+            help="Export the PyTorch model --model_name_or_path instead of converting a TF checkpoint.",
+        )
+        train_parser.add_argument(
+            "--model_name_or_path", type=str, help="PyTorch (sequence classification) model to export."
+        )
+        train_parser.add_argument("--export_output", type=str, help="Path of the exported model.")
+        train_parser.add_argument(
+            "--batch_size", type=int, default=1, help="Batch size of the export/benchmark inputs."
+        )
+        train_parser.add_argument(
+            "--seq_len", type=int, default=128, help="Sequence length of the export/benchmark inputs."
+        )
+        train_parser.add_argument(
+            "--benchmark_runs",
+            type=int,
+            default=10,
+            help="Number of CPU forward passes timed to compare the exported graph with eager mode (0 to skip). "
+            "ONNX graphs are timed with onnxruntime, and not timed if it is not installed.",
+        )
         train_parser.set_defaults(func=convert_command_factory)
 
     def __init__(
@@ -50,7 +82,13 @@ class ConvertCommand(BaseTransformersCLICommand):
         pytorch_dump_output: str,
         config: str,
         finetuning_task_name: str,
-        *args
+        *args,
+        export_format: str = None,
+        model_name_or_path: str = None,
+        export_output: str = None,
+        batch_size: int = 1,
+        seq_len: int = 128,
+        benchmark_runs: int = 10
     ):
         self._logger = getLogger("transformers-cli/converting")
 
@@ -60,8 +98,20 @@ class ConvertCommand(BaseTransformersCLICommand):
         self._pytorch_dump_output = pytorch_dump_output
         self._config = config
         self._finetuning_task_name = finetuning_task_name
+        self._export_format = export_format
+        self._model_name_or_path = model_name_or_path
+        self._export_output = export_output
+        self._batch_size = batch_size
+        self._seq_len = seq_len
+        self._benchmark_runs = benchmark_runs
 
     def run(self):
+        if self._export_format is not None:
+            self.export()
+            return
+        if self._tf_checkpoint is None or self._pytorch_dump_output is None:
+            raise ValueError("--tf_checkpoint and --pytorch_dump_output are required to convert a checkpoint")
+
         if self._model_type == "bert":
             try:
                 from transformers.convert_bert_original_tf_checkpoint_to_pytorch import (
@@ -142,3 +192,27 @@ class ConvertCommand(BaseTransformersCLICommand):
             convert_xlm_checkpoint_to_pytorch(self._tf_checkpoint, self._pytorch_dump_output)
         else:
             raise ValueError("--model_type should be selected in the list [bert, gpt, gpt2, transfo_xl, xlnet, xlm]")
+
+    def export(self):
+        if self._model_type not in ["bert", "albert"]:
+            raise ValueError("--model_type should be selected in the list [bert, albert] to export a model")
+        if self._model_name_or_path is None or self._export_output is None:
+            raise ValueError("--model_name_or_path and --export_output are required to export a model")
+
+        from transformers import AutoModelForSequenceClassification
+        from transformers.modeling_export import compare_latency, export_onnx, export_torchscript, load_onnxruntime
+
+        model = AutoModelForSequenceClassification.from_pretrained(self._model_name_or_path).eval()
+        if self._export_format == "onnx":
+            export_onnx(model, self._export_output, self._batch_size, self._seq_len)
+            exported = load_onnxruntime(self._export_output) if self._benchmark_runs > 0 else None
+        else:
+            exported = export_torchscript(model, self._export_output, self._batch_size, self._seq_len)
+
+        if self._benchmark_runs > 0 and exported is not None:
+            latencies = compare_latency(model, exported, self._batch_size, self._seq_len, self._benchmark_runs)
+            print(
+                "CPU latency (batch_size={}, seq_len={}): eager {:.2f} ms, exported {:.2f} ms ({:.2f}x)".format(
+                    self._batch_size, self._seq_len, latencies["eager"], latencies["exported"], latencies["speedup"]
+                )
+            )
@@ -2,6 +2,7 @@ from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from typing import Any, Dict, List, NewType, Tuple
 
+import numpy as np
 import torch
 from torch.nn.utils.rnn import pad_sequence
 
@@ -75,6 +76,51 @@ class DefaultDataCollator(DataCollator):
         return batch
 
 
+@dataclass
+class DataCollatorWithPadding(DefaultDataCollator):
+    """
+    Data collator for unpadded features (e.g. a `GlueDataset` built with `pad_to_max_length=False`):
+    - pads the list-valued attributes of every object to the longest `input_ids` of the batch,
+      with `pad_token_id` for `input_ids` and 0 for the others (`attention_mask`, `token_type_ids`)
+    - then collates them like `DefaultDataCollator`
+    """
+
+    pad_token_id: int = 0
+
+    def collate_batch(self, features: List[InputDataClass]) -> Dict[str, torch.Tensor]:
+        max_length = max(len(f.input_ids) for f in features)
+        return super().collate_batch([self._pad(f, max_length) for f in features])
+
+    def _pad(self, feature: InputDataClass, max_length: int) -> InputDataClass:
+        padded = {}
+        for k, v in vars(feature).items():
+            if k != "label_ids" and isinstance(v, list) and len(v) < max_length:
+                v = v + [self.pad_token_id if k == "input_ids" else 0] * (max_length - len(v))
+            padded[k] = v
+        return feature.__class__(**padded)
+
+
+@dataclass
+class DataCollatorForFrozenActivations(DataCollator):
+    """
+    Data collator for the (feature, hidden_states) items of a `FrozenActivationDataset`:
+    - collates the features with `collator`
+    - then replaces their `input_ids`, `token_type_ids` and `position_ids` by the `frozen_hidden_states` of the
+      batch, cut to its length
+    """
+
+    collator: DataCollator
+
+    def collate_batch(self, features: List[Tuple[InputDataClass, np.ndarray]]) -> Dict[str, torch.Tensor]:
+        batch = self.collator.collate_batch([feature for feature, _ in features])
+        length = batch.pop("input_ids").size(1)
+        batch.pop("token_type_ids", None)
+        batch.pop("position_ids", None)
+        hidden_states = np.stack([hidden_states[:length] for _, hidden_states in features])
+        batch["frozen_hidden_states"] = torch.from_numpy(hidden_states).float()
+        return batch
+
+
 @dataclass
 class DataCollatorForLanguageModeling(DataCollator):
     """
@@ -52,6 +52,9 @@ class GlueDataset(Dataset):
     """
     This will be superseded by a framework-agnostic approach
     soon.
+
+    With ``pad_to_max_length=False``, the features are only truncated to ``max_seq_length`` (and cached separately)
+    and must be collated with ``DataCollatorWithPadding``, as the Trainer does with ``--dynamic_padding``.
     """
 
     args: GlueDataTrainingArguments
@@ -67,6 +70,7 @@ class GlueDataset(Dataset):
         local_rank=-1,
         num_labels=None,
         label_noise=0,
+        pad_to_max_length=True,
     ):
         self.args = args
         processor = glue_processors[args.task_name]()
@@ -74,8 +78,12 @@ class GlueDataset(Dataset):
         # Load data features from cache or dataset file
         cached_features_file = os.path.join(
             args.data_dir,
-            "cached_{}_{}_{}_{}".format(
-                "dev" if evaluate else "train", tokenizer.__class__.__name__, str(args.max_seq_length), args.task_name,
+            "cached_{}_{}_{}_{}{}".format(
+                "dev" if evaluate else "train",
+                tokenizer.__class__.__name__,
+                str(args.max_seq_length),
+                args.task_name,
+                "" if pad_to_max_length else "_unpadded",
             ),
         )
         np.random.seed(1)
@@ -119,6 +127,7 @@ class GlueDataset(Dataset):
                     max_length=args.max_seq_length,
                     label_list=label_list,
                     output_mode=self.output_mode,
+                    pad_to_max_length=pad_to_max_length,
                 )
                 if local_rank in [-1, 0]:
                     start = time.time()
@@ -0,0 +1,103 @@
+import hashlib
+import logging
+import os
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data.dataloader import DataLoader
+from torch.utils.data.dataset import Dataset
+
+from .data_collator import DataCollator
+
+
+logger = logging.getLogger(__name__)
+
+
+class FrozenActivationDataset(Dataset):
+    """
+    A dataset of features with, for every feature, the hidden states of the frozen bottom of a model: the output of
+    ``model.encode_frozen`` (the embeddings and the ``config.frozen_layers`` first layers of an ``AlbertModel`` or a
+    ``BertModel``), so that fine-tuning only runs the layers above them. Its items are (feature, hidden_states) pairs,
+    collated by ``DataCollatorForFrozenActivations``.
+
+    The hidden states are computed once, in eval mode and without gradients, into a memory-mapped
+    ``frozen_activations-<fingerprint>.npy`` file of shape (num_features, max_length, hidden_size) in ``cache_dir``.
+    The fingerprint hashes the config and the weights of the frozen modules and the collated features, so that the
+    file is reused by the runs which would compute the same hidden states (e.g. the trials of a sweep).
+    """
+
+    def __init__(
+        self,
+        model,
+        dataset: Dataset,
+        data_collator: DataCollator,
+        cache_dir: str,
+        batch_size: int = 32,
+        device: Optional[torch.device] = None,
+        half: bool = False,
+    ):
+        self.dataset = dataset
+        device = device if device is not None else model.device
+        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=data_collator.collate_batch)
+        fingerprint, max_length = self._fingerprint(model, dataloader, half)
+        self.cache_file = os.path.join(cache_dir, "frozen_activations-{}.npy".format(fingerprint))
+
+        if os.path.exists(self.cache_file):
+            logger.info("Loading the frozen activations from cached file %s", self.cache_file)
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            start = time.time()
+            self._build(model, dataloader, max_length, device, np.float16 if half else np.float32)
+            logger.info(
+                "Saving the frozen activations into cached file %s [took %.3f s]", self.cache_file, time.time() - start
+            )
+        self.hidden_states = np.load(self.cache_file, mmap_mode="r")
+
+    @staticmethod
+    def _fingerprint(model, dataloader: DataLoader, half: bool) -> Tuple[str, int]:
+        """ Hash of what the cached hidden states depend on, and the length of the longest batch. """
+        sha = hashlib.sha1(model.config.to_json_string().encode())
+        sha.update(b"half" if half else b"full")
+        for module in model.frozen_modules():
+            for name, tensor in module.state_dict().items():
+                sha.update(name.encode())
+                sha.update(tensor.detach().cpu().float().numpy().tobytes())
+        max_length = 0
+        for batch in dataloader:
+            for name in sorted(batch):
+                sha.update(name.encode())
+                sha.update(batch[name].numpy().tobytes())
+            max_length = max(max_length, batch["input_ids"].size(1))
+        return sha.hexdigest()[:16], max_length
+
+    def _build(self, model, dataloader: DataLoader, max_length: int, device: torch.device, dtype):
+        shape = (len(self.dataset), max_length, model.config.hidden_size)
+        # written under a name of its own, so that neither an interrupted run nor a concurrent one (e.g. another
+        # trial of a sweep) leaves a partial cache file
+        partial_file = "{}.{}.partial.npy".format(self.cache_file[: -len(".npy")], os.getpid())
+        array = np.lib.format.open_memmap(partial_file, mode="w+", dtype=dtype, shape=shape)
+        training = model.training
+        model.eval()
+        start = 0
+        with torch.no_grad():
+            for batch in dataloader:
+                inputs = {
+                    name: batch[name].to(device)
+                    for name in ("input_ids", "attention_mask", "token_type_ids", "position_ids")
+                    if name in batch
+                }
+                hidden_states = model.encode_frozen(**inputs)
+                array[start : start + hidden_states.size(0), : hidden_states.size(1)] = hidden_states.cpu().numpy()
+                start += hidden_states.size(0)
+        model.train(training)
+        array.flush()
+        del array
+        os.replace(partial_file, self.cache_file)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, i):
+        return self.dataset[i], self.hidden_states[i]
@@ -38,6 +38,7 @@ def glue_convert_examples_to_features(
     task=None,
     label_list=None,
     output_mode=None,
+    pad_to_max_length=True,
 ):
     """
     Loads a data file into a list of ``InputFeatures``
@@ -49,6 +50,8 @@ def glue_convert_examples_to_features(
         task: GLUE task
         label_list: List of labels. Can be obtained from the processor using the ``processor.get_labels()`` method
         output_mode: String indicating the output mode. Either ``regression`` or ``classification``
+        pad_to_max_length: Pad the features to ``max_length``. Otherwise they are only truncated, and are padded per
+            batch by a collator like ``DataCollatorWithPadding``
 
     Returns:
         If the ``examples`` input is a ``tf.data.Dataset``, will return a ``tf.data.Dataset``
@@ -61,7 +64,13 @@ def glue_convert_examples_to_features(
             raise ValueError("When calling glue_convert_examples_to_features from TF, the task parameter is required.")
         return _tf_glue_convert_examples_to_features(examples, tokenizer, max_length=max_length, task=task)
     return _glue_convert_examples_to_features(
-        examples, tokenizer, max_length=max_length, task=task, label_list=label_list, output_mode=output_mode
+        examples,
+        tokenizer,
+        max_length=max_length,
+        task=task,
+        label_list=label_list,
+        output_mode=output_mode,
+        pad_to_max_length=pad_to_max_length,
     )
 
 
@@ -111,6 +120,7 @@ def _glue_convert_examples_to_features(
     task=None,
     label_list=None,
     output_mode=None,
+    pad_to_max_length=True,
 ):
     if max_length is None:
         max_length = tokenizer.max_len
@@ -136,7 +146,9 @@ def _glue_convert_examples_to_features(
     labels = [label_from_example(example) for example in examples]
 
     batch_encoding = tokenizer.batch_encode_plus(
-        [(example.text_a, example.text_b) for example in examples], max_length=max_length, pad_to_max_length=True,
+        [(example.text_a, example.text_b) for example in examples],
+        max_length=max_length,
+        pad_to_max_length=pad_to_max_length,
     )
 
     features = []
@@ -26,7 +26,22 @@ from torch.nn import CrossEntropyLoss, MSELoss
 
 from .configuration_albert import AlbertConfig
 from .file_utils import add_start_docstrings, add_start_docstrings_to_callable
-from .modeling_bert import ACT2FN, BertEmbeddings, BertSelfAttention, prune_linear_layer
+from .modeling_bert import (
+    ACT2FN,
+    BertEmbeddings,
+    BertSelfAttention,
+    LognormalAttentionSample,
+    WeibullAttentionSample,
+    _can_modify_inplace,
+    attention_sample_predict,
+    crop_to_longest,
+    head_transport_cost,
+    masked_transport_loss,
+    new_attention_noise_seed,
+    pack_tokens,
+    prune_linear_layer,
+    valid_token_index,
+)
 from .modeling_utils import PreTrainedModel
 from torch.autograd import Variable
 from torch.autograd import Function
@@ -203,6 +218,7 @@ class SinkhornDistance(nn.Module):
 
     Shape:
         - Input: :math:`(N, P_1, D_1)`, :math:`(N, P_2, D_2)`
+        - Masks (optional): :math:`(N, P_1)`, :math:`(N, P_2)`, 1 for the locations to transport and 0 for padding
         - Output: :math:`(N)` or :math:`()`, depending on `reduction`
     """
     def __init__(self, eps, max_iter, reduction='none'):
@@ -211,21 +227,17 @@ class SinkhornDistance(nn.Module):
         self.max_iter = max_iter
         self.reduction = reduction
 
-    def forward(self, x, y):
+    def forward(self, x, y, x_mask=None, y_mask=None):
         # The Sinkhorn algorithm takes as input three variables :
         C = self._cost_matrix(x, y)  # Wasserstein cost function
-        x_points = x.shape[-2]
-        y_points = y.shape[-2]
-        if x.dim() == 2:
-            batch_size = 1
-        else:
-            batch_size = x.shape[0]
+        if x_mask is None:
+            x_mask = torch.ones(x.shape[:-1], dtype=x.dtype, device=x.device)
+        if y_mask is None:
+            y_mask = torch.ones(y.shape[:-1], dtype=y.dtype, device=y.device)
 
-        # both marginals are fixed with equal weights
-        mu = torch.empty(batch_size, x_points, dtype=torch.float,
-                         requires_grad=False).fill_(1.0 / x_points).squeeze().cuda()
-        nu = torch.empty(batch_size, y_points, dtype=torch.float,
-                         requires_grad=False).fill_(1.0 / y_points).squeeze().cuda()
+        # both marginals are fixed with equal weights on the non-padding locations
+        mu = x_mask / x_mask.sum(-1, keepdim=True)
+        nu = y_mask / y_mask.sum(-1, keepdim=True)
 
         u = torch.zeros_like(mu)
         v = torch.zeros_like(nu)
@@ -267,7 +279,6 @@ class SinkhornDistance(nn.Module):
 
         x_col = x.unsqueeze(-2)
         y_lin = y.unsqueeze(-3)
-        print(x_col.shape, y_lin.shape)
         C = torch.sum((torch.abs(x_col - y_lin)) ** p, -1)
         return C
 
@@ -296,8 +307,73 @@ class AlbertEmbeddings(BertEmbeddings):
         self.token_type_embeddings = nn.Embedding(config.type_vocab_size, config.embedding_size)
         self.LayerNorm = torch.nn.LayerNorm(config.embedding_size, eps=config.layer_norm_eps)
 
+    @torch.no_grad()
+    def build_projection(self, mapping, dtype=None):
+        """
+        Projection table for inference: the (centered) word, position and token type embeddings multiplied by the
+        scale of the layer norm and by ``mapping`` (the embedding-to-hidden linear layer), stacked with the projected
+        bias of the layer norm. The position and token type rows are fused. :meth:`project` computes
+        ``mapping(LayerNorm(embeddings))`` from this table, of size (vocab + positions x token types + 1) x hidden,
+        stored in ``dtype`` (e.g. float16 to halve its memory).
+        """
+        weight = (mapping.weight * self.LayerNorm.weight).t()
+
+        def centered(embeddings):
+            return embeddings - embeddings.mean(-1, keepdim=True)
+
+        position_token_type = centered(self.position_embeddings.weight).unsqueeze(1) + centered(
+            self.token_type_embeddings.weight
+        ).unsqueeze(0)
+        table = torch.cat(
+            [
+                centered(self.word_embeddings.weight).matmul(weight),
+                position_token_type.view(-1, weight.size(0)).matmul(weight),
+                mapping(self.LayerNorm.bias).unsqueeze(0),
+            ]
+        )
+        return table.to(dtype or table.dtype)
+
+    def project(self, table, input_ids, token_type_ids=None, position_ids=None):
+        """
+        Eval-mode ``mapping(self(input_ids, token_type_ids, position_ids))`` from the table of
+        :meth:`build_projection`: as the layer norm is linear once its statistics are known, the projection of the
+        normalized sum is the sum of the projected rows, rescaled, plus the projected bias. Only the statistics are
+        computed in the embedding size and the [batch, length, embedding] x [embedding, hidden] matmul is replaced by
+        a single weighted ``embedding_bag`` of three rows per token.
+        """
+        input_shape = input_ids.size()
+        if position_ids is None:
+            position_ids = torch.arange(input_shape[1], dtype=torch.long, device=input_ids.device)
+            position_ids = position_ids.unsqueeze(0).expand(input_shape)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=input_ids.device)
+
+        embeddings = (
+            self.word_embeddings(input_ids)
+            + self.position_embeddings(position_ids)
+            + self.token_type_embeddings(token_type_ids)
+        )
+        centered_norm = (embeddings - embeddings.mean(-1, keepdim=True)).norm(dim=-1, keepdim=True)
+        inverse_std = torch.rsqrt(centered_norm.pow(2) / embeddings.size(-1) + self.LayerNorm.eps)
+
+        vocab_size = self.word_embeddings.num_embeddings
+        rows = torch.stack(
+            [
+                input_ids,
+                vocab_size + position_ids * self.token_type_embeddings.num_embeddings + token_type_ids,
+                torch.full_like(input_ids, table.size(0) - 1),
+            ],
+            dim=-1,
+        )
+        weights = torch.cat([inverse_std, inverse_std, torch.ones_like(inverse_std)], dim=-1).to(table.dtype)
+        projected = F.embedding_bag(rows.view(-1, 3), table, mode="sum", per_sample_weights=weights.view(-1, 3))
+        return projected.view(*input_shape, -1).to(embeddings.dtype)
+
+
 eps = 1e-20
 class AlbertAttention(BertSelfAttention):
+    gamma_att_as_softmax = True
+
     def __init__(self, config):
         super().__init__(config)
 
@@ -329,6 +405,7 @@ class AlbertAttention(BertSelfAttention):
         self.KL_backward = 0
         self.prior_att_weights = None
         self.att_weights = 0
+        self.att_noise_recompute = getattr(config, "att_noise_recompute", True)
 
         self.att_contextual_se = config.att_contextual_se
         self.att_se_hid_size = config.att_se_hid_size
@@ -353,9 +430,9 @@ class AlbertAttention(BertSelfAttention):
             self.se_linear10 = nn.Linear(self.att_se_hid_size, self.att_se_hid_size)
 
             #talking head
-            self.se_linear11 = nn.Linear(12, 12)
-            self.se_linear12 = nn.Linear(12, 12)
-            self.se_linear13 = nn.Linear(12, 12)
+            self.se_linear11 = nn.Linear(self.num_attention_heads, self.num_attention_heads)
+            self.se_linear12 = nn.Linear(self.num_attention_heads, self.num_attention_heads)
+            self.se_linear13 = nn.Linear(self.num_attention_heads, self.num_attention_heads)
 
             self.se_linear1.weight.data.normal_(0, np.sqrt(1 / self.attention_head_size))  # TODO: tune
             self.se_linear2.weight.data.normal_(0, np.sqrt(1.0 / self.att_se_hid_size))
@@ -485,6 +562,30 @@ class AlbertAttention(BertSelfAttention):
         return logits
 
 
+    def _act_transport(self, key_tokens, query_tokens, reverse=True):
+        """
+        Transport of the act alignment between the heads of the packed [N, H, d] keys and queries. With `reverse`,
+        the gradient reaching the keys and queries is flipped, as the alignment loss is minimized by the critic and
+        the navigator and maximized by the keys and queries. Returns the loss, the two maps and the cost.
+        """
+        if reverse:
+            key_tokens = GradReverse.apply(key_tokens, 1)
+            query_tokens = GradReverse.apply(query_tokens, 1)
+        real_out = self.critic_for(key_tokens)
+        fake_out = self.critic_for(query_tokens)
+
+        #Version 1
+        # cost = torch.cdist(real_out, fake_out, p=2)
+
+        #Version 2
+        cost = self.fast_cdist(real_out, fake_out)
+
+        n_x = self.navigator_for(key_tokens)
+        n_y= self.navigator_for(query_tokens)
+        d = torch.matmul(n_x, n_y.transpose(-1, -2))
+        errD, m_backward, m_forward = masked_transport_loss(cost, d, None, self.rho)
+        return errD, m_backward, m_forward, cost
+
     def fast_cdist(self, x1, x2):
         adjustment = x1.mean(-2, keepdim=True)
         x1 = x1 - adjustment
@@ -513,10 +614,12 @@ class AlbertAttention(BertSelfAttention):
             # Compute how many pruned heads are before the head and move the index accordingly
             head = head - sum(1 if h < head else 0 for h in self.pruned_heads)
             mask[head] = 0
+        head_index = mask[:, 0].eq(1).nonzero().view(-1)
         mask = mask.view(-1).contiguous().eq(1)
         index = torch.arange(len(mask))[mask].long()
 
         # Prune linear layers
+        self.prune_head_mixing(head_index)
         self.query = prune_linear_layer(self.query, index)
         self.key = prune_linear_layer(self.key, index)
         self.value = prune_linear_layer(self.value, index)
@@ -536,21 +639,14 @@ class AlbertAttention(BertSelfAttention):
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        if attention_mask is not None:
-            # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
-            attention_scores = attention_scores + attention_mask
+        sample_attention_mask = attention_mask
+        attention_mask, num_samples = self._split_sample_mask(input_ids, attention_mask)
 
-        # Normalize the attention scores to probabilities.
         eps = 1e-20
-        attention_probs = nn.Softmax(dim=-1)(attention_scores)
-        logprobs = torch.log(attention_probs + eps)
-
+        attention_scores, attention_probs, logprobs = self._attention_probs(query_layer, key_layer, attention_mask, eps)
 
         #Version 2
-        self.KL_backward =torch.ones_like(key_layer).cuda().mean()
+        self.KL_backward = key_layer.new_tensor(1.0)
 
         # talking head
         if self.adver_type == 'talking_head':
@@ -565,25 +661,42 @@ class AlbertAttention(BertSelfAttention):
             attention_probs = attention_probs_value
 
 
-        if self.training:
+        if self.attention_recorder is not None:
+            self.attention_recorder.record("attention", attention_probs)
+
+        if num_samples > 1:
+            # the projections and probabilities are shared, only the attention samples differ
+            attention_probs, query_layer, key_layer, value_layer = (
+                t.repeat(num_samples, 1, 1, 1) for t in (attention_probs, query_layer, key_layer, value_layer)
+            )
+            if logprobs is not None:
+                logprobs = logprobs.repeat(num_samples, 1, 1, 1)
+            attention_mask = sample_attention_mask
+
+        alignment_timer = self.alignment_timer
+        if alignment_timer is not None:
+            alignment_timer.start_alignment()
+        if self.training or self.alignment_statistics:
             if self.adver_type == 'mmd':
-                mmdloss = MMD_loss().cuda()
+                mmdloss = MMD_loss()
                 self.KL_backward = mmdloss(query_layer, key_layer.detach()).mean()
 
 
             if self.adver_type =='gan':
-                key_layer_reverse = GradReverse.apply(key_layer, 1)
-                query_layer_reverse = GradReverse.apply(query_layer, 1)
+                # the discriminator only sees the non-padding tokens
+                token_index = valid_token_index(attention_mask)
+                key_layer_reverse = GradReverse.apply(pack_tokens(key_layer, token_index), 1)
+                query_layer_reverse = GradReverse.apply(pack_tokens(query_layer, token_index), 1)
 
                 real_out = self.discriminator_for(key_layer_reverse)
-                real_label = Variable(torch.ones_like(real_out)).cuda().detach()
+                real_label = Variable(torch.ones_like(real_out)).detach()
                 # real_label_reverse = GradReverse.apply(real_label, 1)
 
                 d_loss_real = self.criterion(real_out, real_label)
                 fake_query = query_layer_reverse.detach()
                 fake_out = self.discriminator_for(fake_query)
 
-                fake_label = Variable(torch.zeros_like(fake_out)).cuda().detach()
+                fake_label = Variable(torch.zeros_like(fake_out)).detach()
                 # fake_label_reverse = GradReverse.apply(fake_label, 1)
                 d_loss_fake = self.criterion(fake_out, fake_label)
                 d_loss = d_loss_real + d_loss_fake
@@ -617,41 +730,22 @@ class AlbertAttention(BertSelfAttention):
 
             if self.adver_type =='act':
 
-                rho = self.rho
-                key_layer_reverse = GradReverse.apply(key_layer, 1)
-                query_layer_reverse = GradReverse.apply(query_layer, 1)
-                real_out = self.critic_for(key_layer_reverse)
-                fake_out = self.critic_for(query_layer_reverse)
-
-
-
-                #Version 1
-                # cost = torch.cdist(real_out, fake_out, p=2)
-
-                #Version 2
-
-                real_out_tran= real_out.permute(0, 2, 1, 3) #  transpose(1, 2).contiguous()
-                fake_out_tran= fake_out.permute(0, 2, 1, 3) #  transpose(1, 2).contiguous()
-
-                cost = self.fast_cdist(real_out_tran, fake_out_tran)
-
-
-
-                # Version 1
-                n_x = self.navigator_for(key_layer_reverse)
-                n_y= self.navigator_for(query_layer_reverse)
-                # d = torch.matmul(n_x, n_y.transpose(-1, -2))
-
-                # Version 2
-                n_x_tran = n_x.transpose(1, 2)
-                n_y_tran= n_y.transpose(1, 2)
-                d = torch.matmul(n_x_tran, n_y_tran.transpose(-1, -2))
-
-
-                m_backward = torch.nn.functional.softmax(d, dim=-2)  # backward transport map key
-                m_forward = torch.nn.functional.softmax(d, dim=-1)  # forward transport map query
-
-                errD = - ((1 - rho) * (cost * m_backward).sum(-2).mean() + rho * (cost * m_forward).sum(-1).mean())
+                # transport between the heads of each non-padding token, packed to [N, H, d]
+                token_index = valid_token_index(attention_mask)
+                key_tokens = pack_tokens(key_layer, token_index)
+                query_tokens = pack_tokens(query_layer, token_index)
+                errD, m_backward, m_forward, cost = self._act_transport(key_tokens, query_tokens)
+                if self.alignment_statistics:
+                    if self.training:
+                        # recomputed without the gradient reversal, so that a loss on the costs (e.g. matching the
+                        # ones of a teacher) reaches the keys and queries with its own sign
+                        _, m_backward, m_forward, cost = self._act_transport(key_tokens, query_tokens, False)
+                    self.head_alignment_cost = head_transport_cost(cost, m_backward, m_forward, self.rho, -1)
+
+                if self.attention_recorder is not None:
+                    self._record_transport_maps(
+                        m_forward, m_backward, packed_shape=(key_layer.size(0), key_layer.size(2)), token_index=token_index
+                    )
 
                 self.KL_backward = errD.mean()
 
@@ -660,10 +754,11 @@ class AlbertAttention(BertSelfAttention):
             if self.adver_type =='act_test':
 
                 rho = self.rho
-                key_layer_reverse = GradReverse.apply(key_layer, 1)
-                query_layer_reverse = GradReverse.apply(query_layer, 1)
-                real_out_old = self.critic_for(key_layer_reverse)
-                fake_out_old = self.critic_for(query_layer_reverse)
+                token_index = valid_token_index(attention_mask)
+                key_tokens = pack_tokens(key_layer, token_index)
+                query_tokens = pack_tokens(query_layer, token_index)
+                real_out_old = self.critic_for(GradReverse.apply(key_tokens, 1))
+                fake_out_old = self.critic_for(GradReverse.apply(query_tokens, 1))
 
                 #Version 1
                 # cost = torch.cdist(real_out, fake_out, p=2)
@@ -673,24 +768,19 @@ class AlbertAttention(BertSelfAttention):
                 real_out = GradReverse.apply(real_out_old, 1)
                 fake_out = GradReverse.apply(fake_out_old, 1)
 
-                real_out_tran= real_out.permute(0, 2, 1, 3) #  transpose(1, 2).contiguous()
-                fake_out_tran= fake_out.permute(0, 2, 1, 3) #  transpose(1, 2).contiguous()
-
-                cost = self.fast_cdist(real_out_tran, fake_out_tran)
-
-                # Version 1
-                n_x = self.navigator_for(key_layer)
-                n_y= self.navigator_for(query_layer)
-                # d = torch.matmul(n_x, n_y.transpose(-1, -2))
+                cost = self.fast_cdist(real_out, fake_out)
 
-                # Version 2
-                n_x_tran = n_x.transpose(1, 2)
-                n_y_tran= n_y.transpose(1, 2)
-                d = torch.matmul(n_x_tran, n_y_tran.transpose(-1, -2))
+                n_x = self.navigator_for(key_tokens)
+                n_y= self.navigator_for(query_tokens)
+                d = torch.matmul(n_x, n_y.transpose(-1, -2))
+                errD, m_backward, m_forward = masked_transport_loss(cost, d, None, rho)
+                if self.alignment_statistics:
+                    self.head_alignment_cost = head_transport_cost(cost, m_backward, m_forward, rho, -1)
 
-                m_backward = torch.nn.functional.softmax(d, dim=-2)  # backward transport map key
-                m_forward = torch.nn.functional.softmax(d, dim=-1)  # forward transport map query
-                errD = - ((1 - rho) * (cost * m_backward).sum(-2).mean() + rho * (cost * m_forward).sum(-1).mean())
+                if self.attention_recorder is not None:
+                    self._record_transport_maps(
+                        m_forward, m_backward, packed_shape=(key_layer.size(0), key_layer.size(2)), token_index=token_index
+                    )
 
                 self.KL_backward = errD.mean()
 
@@ -699,24 +789,19 @@ class AlbertAttention(BertSelfAttention):
                 eps = 0.01
                 max_iter = 100
 
-                batch_size = key_layer.shape[0]
-                num_dim = key_layer.shape[-1]
-                num_head = key_layer.shape[1]
-                num_key= key_layer.shape[2]
+                # one transport problem per (sequence, head), over the non-padding tokens of the sequence
+                token_index = valid_token_index(attention_mask)
+                ot_mask, ot_query, ot_key = crop_to_longest(attention_mask, token_index, query_layer, key_layer)
+                num_head, num_key, num_dim = ot_key.shape[1:]
 
-                query_layer = query_layer.reshape([-1, num_key, num_dim])
-                key_layer = key_layer.reshape([-1, num_key, num_dim])
+                ot_query = ot_query.reshape([-1, num_key, num_dim])
+                ot_key = ot_key.reshape([-1, num_key, num_dim])
+                token_mask = None
+                if token_index is not None:
+                    token_mask = (ot_mask[:, 0, -1] > -1.0).to(ot_key.dtype).repeat_interleave(num_head, dim=0)
 
-
-                # sinkloss= SinkhornDistance(eps, max_iter, reduction='mean').cuda()
-                # self.KL_backward= SinkhornDistance(eps, max_iter, reduction='mean')(query_layer, key_layer)[0]
-
-
-                #geomloss
-                loss = SamplesLoss(loss="sinkhorn", p=2, blur=.05)
-
-                L = loss(query_layer, key_layer)  # By default, use constant weights = 1/number of samples
-                self.KL_backward = L.mean()
+                sinkloss = SinkhornDistance(eps, max_iter, reduction='mean')
+                self.KL_backward = sinkloss(ot_query, ot_key, token_mask, token_mask)[0]
                 # self.KL_backward = self.fast_cdist(key_layer, query_layer).mean()
                 # Version 2
                 # l1 = spc.sinkhorn_loss(x, y, epsilon, n, niter)
@@ -731,52 +816,40 @@ class AlbertAttention(BertSelfAttention):
             if self.adver_type == 'combine':
 
                 rho = self.rho
-                real_out = key_layer
-                fake_out = query_layer
-                # Version 1
+                token_index = valid_token_index(attention_mask)
+
+                # Version 1: transport between the tokens of each sequence, cropped to the longest one and masked
+                pair_mask, real_out, fake_out = crop_to_longest(attention_mask, token_index, key_layer, query_layer)
                 # cost = torch.cdist(real_out, fake_out, p=2)
                 cost = self.fast_cdist(real_out, fake_out)
 
-                # Version 2
-
-                # real_out_head = self.critic_for_two(key_layer_reverse)
-                # fake_out_head = self.critic_for_two(query_layer_reverse)
-
-                real_out_head = key_layer
-                fake_out_head = query_layer
-
-                real_out_tran = real_out_head.permute(0, 2, 1, 3)  # transpose(1, 2).contiguous()
-                fake_out_tran = fake_out_head.permute(0, 2, 1, 3)  # transpose(1, 2).contiguous()
-
-                cost_head = self.fast_cdist(real_out_tran, fake_out_tran)
-
-                # Version 1
-                # n_x = self.navigator_for(key_layer_reverse)
-                # n_y = self.navigator_for(query_layer_reverse)
-
-                n_x = self.navigator_for(key_layer)
-                n_y = self.navigator_for(query_layer)
+                n_x = self.navigator_for(real_out)
+                n_y = self.navigator_for(fake_out)
                 d = torch.matmul(n_x, n_y.transpose(-1, -2))
+                err, m_backward, m_forward = masked_transport_loss(cost, d, pair_mask, rho)
 
-                # Version 2
-                # n_x_tran = self.navigator_for_two(key_layer_reverse)
-                # n_y_tran = self.navigator_for_two(query_layer_reverse)
-
-                n_x_tran = self.navigator_for_two(key_layer)
-                n_y_tran = self.navigator_for_two(query_layer)
+                # Version 2: transport between the heads of each non-padding token, packed to [N, H, d]
+                real_out_head = pack_tokens(key_layer, token_index)
+                fake_out_head = pack_tokens(query_layer, token_index)
+                cost_head = self.fast_cdist(real_out_head, fake_out_head)
 
-                n_x_tran = n_x_tran.transpose(1, 2)
-                n_y_tran = n_y_tran.transpose(1, 2)
+                n_x_tran = self.navigator_for_two(real_out_head)
+                n_y_tran = self.navigator_for_two(fake_out_head)
                 d_head = torch.matmul(n_x_tran, n_y_tran.transpose(-1, -2))
+                errHead, m_backward_head, m_forward_head = masked_transport_loss(cost_head, d_head, None, rho)
 
-                m_backward = torch.nn.functional.softmax(d, dim=-2)  # backward transport map key
-                m_forward = torch.nn.functional.softmax(d, dim=-1)  # forward transport map query
+                if self.attention_recorder is not None:
+                    self._record_transport_maps(m_forward, m_backward)
+                    self._record_transport_maps(
+                        m_forward_head, m_backward_head, "_head", (key_layer.size(0), key_layer.size(2)), token_index
+                    )
 
-                m_backward_head = torch.nn.functional.softmax(d_head, dim=-2)  # backward transport map key
-                m_forward_head = torch.nn.functional.softmax(d_head, dim=-1)  # forward transport map query
+                if self.alignment_statistics:
+                    self.head_alignment_cost = (
+                        head_transport_cost(cost, m_backward, m_forward, rho, 1, pair_mask)
+                        + head_transport_cost(cost_head, m_backward_head, m_forward_head, rho, -1)
+                    )
 
-                err = - ((1 - rho) * (cost * m_backward).sum(-2).mean() + rho * (cost * m_forward).sum(-1).mean())
-                errHead = - ((1 - rho) * (cost_head * m_backward_head).sum(-2).mean() + rho * (cost_head * m_forward_head).sum(-1).mean())
                 #Version 1
                 errD = err + errHead
                 # errD= torch.sigmoid(self.alpha_gamma) * err + (1-torch.sigmoid(self.alpha_gamma) * errHead)
@@ -805,9 +878,23 @@ class AlbertAttention(BertSelfAttention):
                 self.prior_att_weights = F.softmax(dot_mu, dim=-1)
                 self.mean_normal_prior = torch.log(self.prior_att_weights + eps) #- self.sigma_normal_prior ** 2 / 2
 
+        if alignment_timer is not None:
+            alignment_timer.stop_alignment()
+
+        context_layer = None
         if self.att_type == 'soft_weibull':
-            if self.training:
-                if 0:
+            if self.training or self.attention_sampling:
+                if self.att_noise_recompute:
+                    context_layer, self.KL_backward, out_weight = WeibullAttentionSample.apply(
+                        attention_probs,
+                        value_layer,
+                        self.alpha_gamma,
+                        new_attention_noise_seed(),
+                        float(self.k_weibull),
+                        float(self.beta_gamma),
+                        eps,
+                    )
+                elif 0:
                     self.alpha_gamma = attention_probs
                     if self.k_parameterization == 'blue':
                         k_weibull = 1.0 #todo
@@ -841,7 +928,17 @@ class AlbertAttention(BertSelfAttention):
                 out_weight = attention_probs
 
         elif self.att_type == 'soft_lognormal':
-            if self.training:
+            if (self.training or self.attention_sampling) and self.att_noise_recompute:
+                context_layer, self.KL_backward, out_weight = LognormalAttentionSample.apply(
+                    attention_probs,
+                    value_layer,
+                    self.mean_normal_prior,
+                    self.sigma_normal_prior,
+                    new_attention_noise_seed(),
+                    float(self.sigma_normal_posterior),
+                    eps,
+                )
+            elif self.training or self.attention_sampling:
                 mean_normal_posterior = logprobs - self.sigma_normal_posterior ** 2 / 2
                 out_weight = F.softmax(mean_normal_posterior + self.sigma_normal_posterior * torch.randn_like(logprobs), dim=-1)
                 KL = torch.log(self.sigma_normal_prior / self.sigma_normal_posterior + eps) + (
@@ -854,26 +951,32 @@ class AlbertAttention(BertSelfAttention):
 
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
-            out_weight = self.dropout(out_weight)
+            out_weight = F.dropout(
+                out_weight, self.dropout.p, self.training, inplace=_can_modify_inplace(out_weight)
+            )
 
         # Mask heads if we want to
         if head_mask is not None:
-            out_weight = out_weight * head_mask
+            if context_layer is not None:
+                # head_mask is constant over the last two dims, so it can be applied to the fused context
+                context_layer = context_layer * head_mask
+            if context_layer is None or self.output_attentions:
+                if _can_modify_inplace(out_weight):
+                    out_weight.mul_(head_mask)
+                else:
+                    out_weight = out_weight * head_mask
 
-        context_layer = torch.matmul(out_weight, value_layer)
+        if context_layer is None:
+            context_layer = torch.matmul(out_weight, value_layer)
 
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+        context_layer = context_layer.view(context_layer.size(0), context_layer.size(1), self.all_head_size)
 
-        # Should find a better way to do this
-        w = (
-            self.dense.weight.t()
-            .view(self.num_attention_heads, self.attention_head_size, self.hidden_size)
-            .to(context_layer.dtype)
-        )
-        b = self.dense.bias.to(context_layer.dtype)
-
-        projected_context_layer = torch.einsum("bfnd,ndh->bfh", context_layer, w) + b
+        # a plain call keeps the projection swappable (e.g. for a dynamically quantized linear)
+        projected_context_layer = self.dense(context_layer)
         projected_context_layer_dropout = self.dropout(projected_context_layer)
+        if num_samples > 1:
+            input_ids = input_ids.repeat(num_samples, 1, 1)
         layernormed_context_layer = self.LayerNorm(input_ids + projected_context_layer_dropout)
         return (layernormed_context_layer, out_weight) if self.output_attentions else (layernormed_context_layer,)
 
@@ -943,30 +1046,51 @@ class AlbertTransformer(nn.Module):
         self.embedding_hidden_mapping_in = nn.Linear(config.embedding_size, config.hidden_size)
         self.albert_layer_groups = nn.ModuleList([AlbertLayerGroup(config) for _ in range(config.num_hidden_groups)])
         self.KL_list = []
+        # hidden states after every early_exit_every iterations (the last one excluded), read by the exit classifiers
+        self.early_exit_every = getattr(config, "early_exit_every", 0)
+        self.exit_hidden_states = []
+
+    def group_index(self, i):
+        """ Index of the layer group run by the i-th iteration. """
+        return int(i / (self.config.num_hidden_layers / self.config.num_hidden_groups))
+
+    def layer_iteration(self, i, hidden_states, attention_mask=None, head_mask=None):
+        """ Runs the i-th of the ``num_hidden_layers`` iterations over the shared layer groups. """
+        # Number of layers in a hidden group
+        layers_per_group = int(self.config.num_hidden_layers / self.config.num_hidden_groups)
+
+        # Index of the hidden group
+        group_idx = self.group_index(i)
+
+        layer_group_output = self.albert_layer_groups[group_idx](
+            hidden_states,
+            attention_mask,
+            head_mask[group_idx * layers_per_group : (group_idx + 1) * layers_per_group],
+        )
+        self.KL_list.append(self.albert_layer_groups[group_idx].KL_inner_list)
+        return layer_group_output
 
-    def forward(self, hidden_states, attention_mask=None, head_mask=None):
-        hidden_states = self.embedding_hidden_mapping_in(hidden_states)
+    def forward(self, hidden_states, attention_mask=None, head_mask=None, embeddings_projected=False, start_layer=0):
+        """
+        Runs the iterations from ``start_layer`` on: with ``start_layer > 0``, ``hidden_states`` are the (projected)
+        outputs of the previous iterations, e.g. the cached activations of frozen layers.
+        """
+        if not embeddings_projected and start_layer == 0:
+            hidden_states = self.embedding_hidden_mapping_in(hidden_states)
 
         all_attentions = ()
 
         if self.output_hidden_states:
             all_hidden_states = (hidden_states,)
         self.KL_list = []
+        self.exit_hidden_states = []
 
-        for i in range(self.config.num_hidden_layers):
-            # Number of layers in a hidden group
-            layers_per_group = int(self.config.num_hidden_layers / self.config.num_hidden_groups)
-
-            # Index of the hidden group
-            group_idx = int(i / (self.config.num_hidden_layers / self.config.num_hidden_groups))
-
-            layer_group_output = self.albert_layer_groups[group_idx](
-                hidden_states,
-                attention_mask,
-                head_mask[group_idx * layers_per_group : (group_idx + 1) * layers_per_group],
-            )
+        for i in range(start_layer, self.config.num_hidden_layers):
+            layer_group_output = self.layer_iteration(i, hidden_states, attention_mask, head_mask)
             hidden_states = layer_group_output[0]
-            self.KL_list.append(self.albert_layer_groups[group_idx].KL_inner_list)
+            is_exit = self.early_exit_every and (i + 1) % self.early_exit_every == 0
+            if is_exit and i + 1 < self.config.num_hidden_layers:
+                self.exit_hidden_states.append(hidden_states)
 
             if self.output_attentions:
                 all_attentions = all_attentions + layer_group_output[-1]
@@ -1075,8 +1199,120 @@ class AlbertModel(AlbertPreTrainedModel):
         self.pooler = nn.Linear(config.hidden_size, config.hidden_size)
         self.pooler_activation = nn.Tanh()
 
+        # None, "full" or "half": in eval mode, use an embedding projection table (kept in float16 with "half")
+        self.embedding_projection_cache = getattr(config, "embedding_projection_cache", None)
+        if self.embedding_projection_cache not in (None, "full", "half"):
+            raise ValueError(
+                "embedding_projection_cache should be None, 'full' or 'half', got {}".format(
+                    self.embedding_projection_cache
+                )
+            )
+        self._embedding_projection = None
+
+        # number of bottom layer iterations whose activations can be cached, see encode_frozen
+        self.frozen_layers = getattr(config, "frozen_layers", 0)
+        if not 0 <= self.frozen_layers < config.num_hidden_layers:
+            raise ValueError(
+                "frozen_layers should be in [0, {}), got {}".format(config.num_hidden_layers, self.frozen_layers)
+            )
+        # the upper iterations would train the weights the cached activations were computed with
+        group_index = self.encoder.group_index
+        if self.frozen_layers > 0 and group_index(self.frozen_layers - 1) == group_index(self.frozen_layers):
+            raise ValueError(
+                "frozen_layers={} splits a layer group shared by frozen and trained iterations: it should be a "
+                "multiple of num_hidden_layers / num_hidden_groups = {}".format(
+                    self.frozen_layers, config.num_hidden_layers // config.num_hidden_groups
+                )
+            )
+
         self.init_weights()
 
+    def embedding_projection(self):
+        """
+        Cached :meth:`AlbertEmbeddings.build_projection` table, built on first use and after a change of
+        ``embedding_projection_cache`` or of device. The cache is dropped by training forwards; call
+        :meth:`clear_embedding_projection` after changing the weights in eval mode.
+        """
+        device = self.encoder.embedding_hidden_mapping_in.weight.device
+        key = (self.embedding_projection_cache, device)
+        if self._embedding_projection is None or self._embedding_projection[0] != key:
+            dtype = torch.float16 if self.embedding_projection_cache == "half" else None
+            projection = self.embeddings.build_projection(self.encoder.embedding_hidden_mapping_in, dtype=dtype)
+            self._embedding_projection = (key, projection)
+        return self._embedding_projection[1]
+
+    def clear_embedding_projection(self):
+        self._embedding_projection = None
+
+    def embed(self, input_ids=None, attention_mask=None, token_type_ids=None, position_ids=None, inputs_embeds=None):
+        """
+        Embeddings projected to the hidden size, of shape (batch_size, sequence_length, hidden_size), and the
+        additive attention mask of shape (batch_size, 1, 1, sequence_length) fed to the encoder layers.
+        """
+        if input_ids is not None:
+            input_shape = input_ids.size()
+        else:
+            input_shape = inputs_embeds.size()[:-1]
+        device = input_ids.device if input_ids is not None else inputs_embeds.device
+
+        if token_type_ids is None:
+            token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=device)
+        extended_attention_mask = self.extended_attention_mask(attention_mask, input_shape, device)
+
+        if self.training:
+            self.clear_embedding_projection()
+        if not self.training and self.embedding_projection_cache and inputs_embeds is None:
+            embedding_output = self.embeddings.project(
+                self.embedding_projection(), input_ids, token_type_ids=token_type_ids, position_ids=position_ids
+            )
+        else:
+            embedding_output = self.encoder.embedding_hidden_mapping_in(
+                self.embeddings(
+                    input_ids, position_ids=position_ids, token_type_ids=token_type_ids, inputs_embeds=inputs_embeds
+                )
+            )
+        return embedding_output, extended_attention_mask
+
+    def extended_attention_mask(self, attention_mask, input_shape, device):
+        """ Additive attention mask of shape (batch_size, 1, 1, sequence_length), from a (batch_size, sequence_length)
+        mask of the tokens to attend to (all of them if ``attention_mask`` is None). """
+        if attention_mask is None:
+            attention_mask = torch.ones(input_shape, device=device)
+        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+        extended_attention_mask = extended_attention_mask.to(dtype=torch.float32)  # fp16 compatibility
+        return (1.0 - extended_attention_mask) * -10000.0
+
+    def encode_frozen(self, input_ids=None, attention_mask=None, token_type_ids=None, position_ids=None):
+        """
+        Hidden states of shape (batch_size, sequence_length, hidden_size) after the embeddings and the
+        ``config.frozen_layers`` first layer iterations, to be fed back to :meth:`forward` as ``frozen_hidden_states``
+        which then only runs the following iterations. Call it in eval mode and without gradients to cache them.
+        """
+        hidden_states, extended_attention_mask = self.embed(input_ids, attention_mask, token_type_ids, position_ids)
+        head_mask = self.get_head_mask(None, self.config.num_hidden_layers)
+        self.encoder.KL_list = []
+        for i in range(self.frozen_layers):
+            hidden_states = self.encoder.layer_iteration(i, hidden_states, extended_attention_mask, head_mask)[0]
+        self.encoder.KL_list = []
+        return hidden_states
+
+    def frozen_modules(self):
+        """ The modules run by :meth:`encode_frozen`: the embeddings, their projection and the layer groups of the
+        ``config.frozen_layers`` first iterations. """
+        groups = sorted(set(self.encoder.group_index(i) for i in range(self.frozen_layers)))
+        return [self.embeddings, self.encoder.embedding_hidden_mapping_in] + [
+            self.encoder.albert_layer_groups[group] for group in groups
+        ]
+
+    def freeze_bottom_layers(self):
+        """ Stops the training of the parameters of :meth:`frozen_modules`. """
+        for module in self.frozen_modules():
+            module.requires_grad_(False)
+
+    def pool(self, hidden_states):
+        """ Pooled output: the pooler (and its activation) applied to the hidden state of the first token. """
+        return self.pooler_activation(self.pooler(hidden_states[:, 0]))
+
     def get_input_embeddings(self):
         return self.embeddings.word_embeddings
 
@@ -1116,8 +1352,13 @@ class AlbertModel(AlbertPreTrainedModel):
         position_ids=None,
         head_mask=None,
         inputs_embeds=None,
+        frozen_hidden_states=None,
     ):
         r"""
+        frozen_hidden_states (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, sequence_length, hidden_size)`, `optional`, defaults to :obj:`None`):
+            Output of :meth:`encode_frozen`, instead of :obj:`input_ids`: only the layer iterations above
+            ``config.frozen_layers`` are run.
+
     Return:
         :obj:`tuple(torch.FloatTensor)` comprising various elements depending on the configuration (:class:`~transformers.AlbertConfig`) and inputs:
         last_hidden_state (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, sequence_length, hidden_size)`):
@@ -1156,35 +1397,31 @@ class AlbertModel(AlbertPreTrainedModel):
 
         """
 
-        if input_ids is not None and inputs_embeds is not None:
+        if frozen_hidden_states is not None:
+            if input_ids is not None or inputs_embeds is not None:
+                raise ValueError("You cannot specify both frozen_hidden_states and input_ids or inputs_embeds")
+            embedding_output = frozen_hidden_states
+            extended_attention_mask = self.extended_attention_mask(
+                attention_mask, frozen_hidden_states.size()[:-1], frozen_hidden_states.device
+            )
+            start_layer = self.frozen_layers
+        elif input_ids is not None and inputs_embeds is not None:
             raise ValueError("You cannot specify both input_ids and inputs_embeds at the same time")
-        elif input_ids is not None:
-            input_shape = input_ids.size()
-        elif inputs_embeds is not None:
-            input_shape = inputs_embeds.size()[:-1]
-        else:
+        elif input_ids is None and inputs_embeds is None:
             raise ValueError("You have to specify either input_ids or inputs_embeds")
-
-        device = input_ids.device if input_ids is not None else inputs_embeds.device
-
-        if attention_mask is None:
-            attention_mask = torch.ones(input_shape, device=device)
-        if token_type_ids is None:
-            token_type_ids = torch.zeros(input_shape, dtype=torch.long, device=device)
-
-        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
-        extended_attention_mask = extended_attention_mask.to(dtype=torch.float32)  # fp16 compatibility
-        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        else:
+            embedding_output, extended_attention_mask = self.embed(
+                input_ids, attention_mask, token_type_ids, position_ids, inputs_embeds
+            )
+            start_layer = 0
         head_mask = self.get_head_mask(head_mask, self.config.num_hidden_layers)
-
-        embedding_output = self.embeddings(
-            input_ids, position_ids=position_ids, token_type_ids=token_type_ids, inputs_embeds=inputs_embeds
+        encoder_outputs = self.encoder(
+            embedding_output, extended_attention_mask, head_mask, embeddings_projected=True, start_layer=start_layer
         )
-        encoder_outputs = self.encoder(embedding_output, extended_attention_mask, head_mask=head_mask)
 
         sequence_output = encoder_outputs[0]
 
-        pooled_output = self.pooler_activation(self.pooler(sequence_output[:, 0]))
+        pooled_output = self.pool(sequence_output)
 
         outputs = (sequence_output, pooled_output) + encoder_outputs[
             1:
@@ -1318,6 +1555,14 @@ class AlbertForSequenceClassification(AlbertPreTrainedModel):
         self.dropout = nn.Dropout(config.classifier_dropout_prob)
         self.classifier = nn.Linear(config.hidden_size, self.config.num_labels)
 
+        # early exits: the (shared) pooler and classifier are applied every early_exit_every layer iterations; their
+        # losses are averaged in training and, in eval mode, examples whose prediction entropy is below
+        # early_exit_entropy stop there
+        self.early_exit_every = getattr(config, "early_exit_every", 0)
+        self.early_exit_entropy = getattr(config, "early_exit_entropy", 0.0)
+        # number of layer iterations run by each example of the last adaptive-depth forward
+        self.exit_layers = None
+
         self.init_weights()
 
     @add_start_docstrings_to_callable(ALBERT_INPUTS_DOCSTRING)
@@ -1330,6 +1575,7 @@ class AlbertForSequenceClassification(AlbertPreTrainedModel):
         head_mask=None,
         inputs_embeds=None,
         labels=None,
+        frozen_hidden_states=None,
     ):
         r"""
         labels (:obj:`torch.LongTensor` of shape :obj:`(batch_size,)`, `optional`, defaults to :obj:`None`):
@@ -1337,6 +1583,8 @@ class AlbertForSequenceClassification(AlbertPreTrainedModel):
             Indices should be in ``[0, ..., config.num_labels - 1]``.
             If ``config.num_labels == 1`` a regression loss is computed (Mean-Square loss),
             If ``config.num_labels > 1`` a classification loss is computed (Cross-Entropy).
+        frozen_hidden_states (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, sequence_length, hidden_size)`, `optional`, defaults to :obj:`None`):
+            Cached output of :meth:`AlbertModel.encode_frozen`, instead of :obj:`input_ids`.
 
     Returns:
         :obj:`tuple(torch.FloatTensor)` comprising various elements depending on the configuration (:class:`~transformers.AlbertConfig`) and inputs:
@@ -1370,6 +1618,12 @@ class AlbertForSequenceClassification(AlbertPreTrainedModel):
 
         """
 
+        early_exit = self.early_exit_every and self.early_exit_entropy > 0.0
+        if not self.training and early_exit and frozen_hidden_states is None:
+            return self.early_exit_forward(
+                input_ids, attention_mask, token_type_ids, position_ids, head_mask, inputs_embeds, labels
+            )
+
         outputs = self.albert(
             input_ids=input_ids,
             attention_mask=attention_mask,
@@ -1377,12 +1631,21 @@ class AlbertForSequenceClassification(AlbertPreTrainedModel):
             position_ids=position_ids,
             head_mask=head_mask,
             inputs_embeds=inputs_embeds,
+            frozen_hidden_states=frozen_hidden_states,
         )
 
         pooled_output = outputs[1]
 
         pooled_output = self.dropout(pooled_output)
         logits = self.classifier(pooled_output)
+        # logits of the intermediate exits, supervised with the final ones in training only: the eval loss is the
+        # one of the final logits
+        exit_logits = []
+        if self.training:
+            exit_logits = [
+                self.classifier(self.dropout(self.albert.pool(hidden_states)))
+                for hidden_states in self.albert.encoder.exit_hidden_states
+            ]
 
         outputs = (logits,) + outputs[2:]  # add hidden states and attention if they are here
 
@@ -1399,17 +1662,92 @@ class AlbertForSequenceClassification(AlbertPreTrainedModel):
 
             # torch.tensor() 后面没加 required gradient true 就会断gradient
             # outputs = outputs + (torch.tensor(KL).type_as(logits).cuda(),)
-            if self.num_labels == 1:
-                #  We are doing regression
-                loss_fct = MSELoss()
-                loss = loss_fct(logits.view(-1), labels.view(-1))
-            else:
-                loss_fct = CrossEntropyLoss()
-                loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
-            outputs = (loss,) + outputs
+            loss = sum(self.classification_loss(exit_logit, labels) for exit_logit in exit_logits + [logits])
+            outputs = (loss / (len(exit_logits) + 1),) + outputs
 
         return outputs  # (loss), logits, (hidden_states), (attentions)
 
+    def classification_loss(self, logits, labels):
+        if self.num_labels == 1:
+            #  We are doing regression
+            loss_fct = MSELoss()
+            return loss_fct(logits.view(-1), labels.view(-1))
+        loss_fct = CrossEntropyLoss()
+        return loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
+
+    def early_exit_forward(
+        self,
+        input_ids=None,
+        attention_mask=None,
+        token_type_ids=None,
+        position_ids=None,
+        head_mask=None,
+        inputs_embeds=None,
+        labels=None,
+    ):
+        """
+        Adaptive-depth eval forward: after every ``early_exit_every`` iterations of the shared layers, the pooled
+        classifier is applied to the examples still running, and those whose prediction entropy is below
+        ``early_exit_entropy`` keep these logits and are removed from the batch. The other ones run the following
+        iterations, up to ``num_hidden_layers``. The number of iterations run by each example is kept in
+        ``self.exit_layers``. Returns (loss), logits, (KL) as :meth:`forward`, without hidden states nor attentions.
+        """
+        if self.num_labels == 1:
+            raise ValueError("Entropy-based early exit needs a classification head (num_labels > 1)")
+
+        hidden_states, extended_attention_mask = self.albert.embed(
+            input_ids, attention_mask, token_type_ids, position_ids, inputs_embeds
+        )
+        num_hidden_layers = self.config.num_hidden_layers
+        head_mask = self.albert.get_head_mask(head_mask, num_hidden_layers)
+        encoder = self.albert.encoder
+        encoder.KL_list = []
+
+        batch_size = hidden_states.size(0)
+        logits = hidden_states.new_zeros(batch_size, self.num_labels)
+        exit_layers = torch.full((batch_size,), num_hidden_layers, dtype=torch.long, device=hidden_states.device)
+        running = torch.arange(batch_size, device=hidden_states.device)
+        for i in range(num_hidden_layers):
+            hidden_states = encoder.layer_iteration(i, hidden_states, extended_attention_mask, head_mask)[0]
+            if (i + 1) % self.early_exit_every != 0 and i + 1 < num_hidden_layers:
+                continue
+
+            step_logits = self.classifier(self.dropout(self.albert.pool(hidden_states)))
+            if i + 1 == num_hidden_layers:
+                logits[running] = step_logits
+                break
+            probs = F.softmax(step_logits, dim=-1)
+            exits = -(probs * torch.log(probs + 1e-20)).sum(-1) < self.early_exit_entropy
+            logits[running[exits]] = step_logits[exits]
+            exit_layers[running[exits]] = i + 1
+
+            # compact the batch to the examples still running
+            running = running[~exits]
+            if running.numel() == 0:
+                break
+            hidden_states = hidden_states[~exits]
+            extended_attention_mask = extended_attention_mask[~exits]
+        self.exit_layers = exit_layers
+
+        outputs = (logits,)
+        if labels is not None:
+            KL = 0
+            count = 0
+            for inner_list in encoder.KL_list:
+                for item in inner_list:
+                    KL = KL + item
+                    count = count + 1
+            outputs = (self.classification_loss(logits, labels), logits, KL / count)
+        return outputs
+
+    def predict_with_attention_samples(self, input_ids, attention_mask=None, token_type_ids=None, num_samples=8):
+        """
+        Draws ``num_samples`` variational attention samples in one batched forward pass and returns the mean class
+        probabilities of shape :obj:`(batch_size, num_labels)` and the predictive entropy of shape
+        :obj:`(batch_size,)`. See :func:`~transformers.modeling_bert.attention_sample_predict`.
+        """
+        return attention_sample_predict(self, input_ids, attention_mask, token_type_ids, num_samples)
+
 
 @add_start_docstrings(
     """Albert Model with a token classification head on top (a linear layer on top of
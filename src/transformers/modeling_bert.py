@@ -157,6 +157,253 @@ class GradReverse(Function):
 		grad_input = grad_output.neg() * ctx.beta
 		return grad_input, None
 
+
+def new_attention_noise_seed():
+    """ Draw a seed for the attention noise from the global torch RNG (so `set_seed` keeps runs reproducible). """
+    return int(torch.randint(2 ** 62, ()).item())
+
+
+def _noise_generator(device, seed):
+    generator = torch.Generator(device=device)
+    generator.manual_seed(seed)
+    return generator
+
+
+def _sum_to_shape(grad, shape):
+    """ Reduce a gradient computed on a broadcast tensor back to the shape of the original input. """
+    if grad.shape == shape:
+        return grad
+    while grad.dim() > len(shape):
+        grad = grad.sum(0)
+    for dim, size in enumerate(shape):
+        if size == 1 and grad.size(dim) != 1:
+            grad = grad.sum(dim, keepdim=True)
+    return grad
+
+
+def _can_modify_inplace(tensor):
+    """ Whether `tensor` can be overwritten without corrupting a buffer autograd saved for backward. """
+    return not (torch.is_grad_enabled() and tensor.requires_grad)
+
+
+def attention_softmax_(attention_scores, inplace=True):
+    """
+    Softmax over the last dimension of the attention scores. When autograd is not recording the scores (inference,
+    `torch.no_grad()`), the probabilities are written back into the scores buffer so that a layer only holds a
+    single [B, H, L, L] tensor.
+    """
+    if not (inplace and _can_modify_inplace(attention_scores)):
+        return F.softmax(attention_scores, dim=-1)
+    attention_scores.sub_(attention_scores.max(dim=-1, keepdim=True)[0]).exp_()
+    return attention_scores.div_(attention_scores.sum(dim=-1, keepdim=True))
+
+
+def valid_token_index(attention_mask):
+    """
+    `(batch_index, position_index)` of the non-padding tokens, recovered from the additive extended attention mask
+    (0 for the tokens to attend to, a large negative bias for padding). None when there is no mask.
+    """
+    if attention_mask is None:
+        return None
+    return (attention_mask[:, 0, -1] > -1.0).nonzero(as_tuple=True)
+
+
+def pack_tokens(layer, token_index):
+    """ Packs a [B, H, L, d] head-split layer into [N, H, d] for the N tokens of `token_index` (all if None). """
+    if token_index is None:
+        return layer.transpose(1, 2).reshape(-1, layer.size(1), layer.size(-1))
+    return layer[token_index[0], :, token_index[1]]
+
+
+def unpack_tokens(packed, token_index, batch_size, seq_len):
+    """ Inverse of `pack_tokens` for a [N, ...] per-token tensor: [B, L, ...] with zeros at the padding. """
+    if token_index is None:
+        return packed.view(batch_size, seq_len, *packed.shape[1:])
+    unpacked = packed.new_zeros((batch_size, seq_len) + packed.shape[1:])
+    unpacked[token_index] = packed
+    return unpacked
+
+
+def crop_to_longest(attention_mask, token_index, *layers):
+    """
+    Drops the trailing positions that are padding for every sequence of the batch from the [B, H, L, d] `layers`
+    and the extended attention mask.
+    """
+    if token_index is None:
+        return (attention_mask,) + layers
+    seq_len = int(token_index[1].max()) + 1
+    return (attention_mask[..., :seq_len],) + tuple(layer[:, :, :seq_len] for layer in layers)
+
+
+def masked_transport_loss(cost, d, attention_mask, rho):
+    """
+    Alignment loss between the keys (dim -2) and queries (dim -1) of one sequence, from the pairwise `cost` and the
+    navigator logits `d` of shape [B, H, L, L]. Padding tokens get no transport mass and are left out of the averages.
+    Returns the loss and the backward (over keys) and forward (over queries) transport maps.
+    """
+    if attention_mask is None:
+        m_backward = torch.nn.functional.softmax(d, dim=-2)
+        m_forward = torch.nn.functional.softmax(d, dim=-1)
+        err = -((1 - rho) * (cost * m_backward).sum(-2).mean() + rho * (cost * m_forward).sum(-1).mean())
+        return err, m_backward, m_forward
+
+    m_backward = torch.nn.functional.softmax(d + attention_mask.transpose(-1, -2), dim=-2)
+    m_forward = torch.nn.functional.softmax(d + attention_mask, dim=-1)
+    valid = (attention_mask[:, :, -1] > -1.0).to(cost.dtype)  # [B, 1, L]
+    num_valid = valid.sum() * cost.size(1)
+    backward_cost = ((cost * m_backward).sum(-2) * valid).sum() / num_valid
+    forward_cost = ((cost * m_forward).sum(-1) * valid).sum() / num_valid
+    err = -((1 - rho) * backward_cost + rho * forward_cost)
+    return err, m_backward, m_forward
+
+
+def head_transport_cost(cost, m_backward, m_forward, rho, head_dim, attention_mask=None):
+    """
+    Expected transport cost of every head, i.e. the alignment loss of `masked_transport_loss` (without its sign)
+    before it is averaged over the heads. `head_dim` is 1 for the token-level [B, H, L, L] maps, whose padding tokens
+    are left out with the extended `attention_mask`, and -1 for the packed head-level [N, H, H] maps. Returns [H].
+    """
+    per_head = (1 - rho) * (cost * m_backward).sum(-2) + rho * (cost * m_forward).sum(-1)
+    weights = torch.ones_like(per_head)
+    if attention_mask is not None:
+        weights = weights * (attention_mask[:, :, -1] > -1.0).to(per_head.dtype)
+    num_heads = per_head.size(head_dim)
+    per_head = per_head.transpose(head_dim, -1).reshape(-1, num_heads)
+    weights = weights.transpose(head_dim, -1).reshape(-1, num_heads)
+    return (per_head * weights).sum(0) / weights.sum(0)
+
+
+class WeibullAttentionSample(Function):
+    """
+    Reparameterized Weibull attention sample applied to the values, together with the mean KL term.
+
+    Autograd would keep the sampled weights, `log(attention_probs + eps)` and the other [B, H, L, L]
+    intermediates alive until backward. Here only `attention_probs` (already saved by the softmax that produced
+    it), the values and the RNG seed are kept: the log-probabilities, the uniform noise and the sample are
+    regenerated in backward, so the saved activations match plain softmax attention.
+    The attention weights are also returned, but are not differentiable.
+    """
+
+    @staticmethod
+    def _sample(logprobs, seed, k_weibull, eps):
+        generator = _noise_generator(logprobs.device, seed)
+        u_weibull = torch.rand(logprobs.shape, generator=generator, device=logprobs.device, dtype=logprobs.dtype)
+        noise = torch.log(-torch.log(1.0 - u_weibull + eps) + eps).div_(k_weibull)
+        return F.softmax(noise.add_(logprobs).sub_(math.lgamma(1 + 1.0 / k_weibull)), dim=-1)
+
+    @staticmethod
+    def forward(ctx, attention_probs, value_layer, alpha_gamma, seed, k_weibull, beta_gamma, eps=1e-20):
+        logprobs = torch.log(attention_probs + eps)
+        out_weight = WeibullAttentionSample._sample(logprobs, seed, k_weibull, eps)
+        context_layer = torch.matmul(out_weight, value_layer)
+
+        lgamma_k = math.lgamma(1 + 1.0 / k_weibull)
+        KL = -(
+            alpha_gamma * (logprobs - lgamma_k)
+            - np.euler_gamma * alpha_gamma / k_weibull
+            - beta_gamma * torch.exp(logprobs)
+            + alpha_gamma * math.log(beta_gamma + eps)
+            - torch.lgamma(alpha_gamma + eps)
+        )
+
+        ctx.save_for_backward(attention_probs, value_layer, alpha_gamma)
+        ctx.seed, ctx.k_weibull, ctx.beta_gamma, ctx.eps, ctx.numel = seed, k_weibull, beta_gamma, eps, KL.numel()
+        ctx.mark_non_differentiable(out_weight)
+        return context_layer, KL.mean(), out_weight
+
+    @staticmethod
+    def backward(ctx, grad_context, grad_kl, grad_out_weight):
+        attention_probs, value_layer, alpha_gamma = ctx.saved_tensors
+        logprobs = torch.log(attention_probs + ctx.eps)
+        out_weight = WeibullAttentionSample._sample(logprobs, ctx.seed, ctx.k_weibull, ctx.eps)
+
+        grad_value = torch.matmul(out_weight.transpose(-1, -2), grad_context)
+        grad_out = torch.matmul(grad_context, value_layer.transpose(-1, -2))
+        grad_out.sub_((grad_out * out_weight).sum(-1, keepdim=True)).mul_(out_weight)
+
+        grad_kl = grad_kl / ctx.numel
+        grad_logprobs = grad_out.add_(grad_kl * (ctx.beta_gamma * torch.exp(logprobs) - alpha_gamma))
+        grad_probs = grad_logprobs.div_(attention_probs + ctx.eps)
+
+        grad_alpha = None
+        if ctx.needs_input_grad[2]:
+            lgamma_k = math.lgamma(1 + 1.0 / ctx.k_weibull)
+            grad_alpha = -grad_kl * (
+                logprobs
+                - lgamma_k
+                - np.euler_gamma / ctx.k_weibull
+                + math.log(ctx.beta_gamma + ctx.eps)
+                - torch.digamma(alpha_gamma + ctx.eps)
+            )
+            grad_alpha = _sum_to_shape(grad_alpha, alpha_gamma.shape)
+        return grad_probs, grad_value, grad_alpha, None, None, None, None
+
+
+class LognormalAttentionSample(Function):
+    """
+    Reparameterized log-normal attention sample applied to the values, together with the mean KL term.
+
+    Same memory contract as :class:`WeibullAttentionSample`: the log-probabilities and the gaussian noise are
+    regenerated from `attention_probs` and the seed in backward instead of being kept by autograd.
+    """
+
+    @staticmethod
+    def _sample(logprobs, seed, sigma_normal_posterior):
+        generator = _noise_generator(logprobs.device, seed)
+        noise = torch.randn(logprobs.shape, generator=generator, device=logprobs.device, dtype=logprobs.dtype)
+        mean_normal_posterior = logprobs - sigma_normal_posterior ** 2 / 2
+        return F.softmax(noise.mul_(sigma_normal_posterior).add_(mean_normal_posterior), dim=-1)
+
+    @staticmethod
+    def forward(
+        ctx, attention_probs, value_layer, mean_normal_prior, sigma_normal_prior, seed, sigma_normal_posterior, eps=1e-20
+    ):
+        logprobs = torch.log(attention_probs + eps)
+        out_weight = LognormalAttentionSample._sample(logprobs, seed, sigma_normal_posterior)
+        context_layer = torch.matmul(out_weight, value_layer)
+
+        mean_normal_posterior = logprobs - sigma_normal_posterior ** 2 / 2
+        KL = (
+            torch.log(sigma_normal_prior / sigma_normal_posterior + eps)
+            + (sigma_normal_posterior ** 2 + (mean_normal_posterior - mean_normal_prior) ** 2)
+            / (2 * sigma_normal_prior ** 2)
+            - 0.5
+        )
+
+        ctx.save_for_backward(attention_probs, value_layer, mean_normal_prior, sigma_normal_prior)
+        ctx.seed, ctx.sigma_normal_posterior, ctx.eps, ctx.numel = seed, sigma_normal_posterior, eps, KL.numel()
+        ctx.mark_non_differentiable(out_weight)
+        return context_layer, KL.mean(), out_weight
+
+    @staticmethod
+    def backward(ctx, grad_context, grad_kl, grad_out_weight):
+        attention_probs, value_layer, mean_normal_prior, sigma_normal_prior = ctx.saved_tensors
+        sigma_normal_posterior = ctx.sigma_normal_posterior
+        logprobs = torch.log(attention_probs + ctx.eps)
+        out_weight = LognormalAttentionSample._sample(logprobs, ctx.seed, sigma_normal_posterior)
+
+        grad_value = torch.matmul(out_weight.transpose(-1, -2), grad_context)
+        grad_out = torch.matmul(grad_context, value_layer.transpose(-1, -2))
+        grad_out.sub_((grad_out * out_weight).sum(-1, keepdim=True)).mul_(out_weight)
+
+        grad_kl = grad_kl / ctx.numel
+        diff = logprobs - sigma_normal_posterior ** 2 / 2 - mean_normal_prior
+        grad_diff = grad_kl * diff / sigma_normal_prior ** 2
+        grad_probs = grad_out.add_(grad_diff).div_(attention_probs + ctx.eps)
+
+        grad_mean_prior = grad_sigma_prior = None
+        if ctx.needs_input_grad[2]:
+            grad_mean_prior = _sum_to_shape(-grad_diff, mean_normal_prior.shape)
+        if ctx.needs_input_grad[3]:
+            ratio = sigma_normal_prior / sigma_normal_posterior
+            grad_sigma_prior = grad_kl * (
+                1.0 / (sigma_normal_posterior * (ratio + ctx.eps))
+                - (sigma_normal_posterior ** 2 + diff ** 2) / sigma_normal_prior ** 3
+            )
+            grad_sigma_prior = _sum_to_shape(grad_sigma_prior, sigma_normal_prior.shape)
+        return grad_probs, grad_value, grad_mean_prior, grad_sigma_prior, None, None, None
+
+
 class BertEmbeddings(nn.Module):
     """Construct the embeddings from word, position and token_type embeddings.
     """
@@ -198,8 +445,17 @@ class BertEmbeddings(nn.Module):
 
 
 class BertSelfAttention(nn.Module):
+    # gamma_att samples from per-layer weights (w_1..w_3, b_1..b_3) and a layer index that BERT never defined, so the
+    # BERT layers reject it. AlbertAttention has no gamma_att sampler and runs it as plain softmax attention.
+    gamma_att_as_softmax = False
+
     def __init__(self, config):
         super().__init__()
+        if config.att_type == 'gamma_att' and not self.gamma_att_as_softmax:
+            raise ValueError(
+                "att_type='gamma_att' is not supported by the BERT models, use soft_attention, soft_weibull or "
+                "soft_lognormal"
+            )
         if config.hidden_size % config.num_attention_heads != 0 and not hasattr(config, "embedding_size"):
             raise ValueError(
                 "The hidden size (%d) is not a multiple of the number of attention "
@@ -230,6 +486,19 @@ class BertSelfAttention(nn.Module):
         self.KL_backward = 0
         self.prior_att_weights = None
         self.att_weights = 0
+        # regenerate the variational attention noise from a seed in backward instead of storing it
+        self.att_noise_recompute = getattr(config, "att_noise_recompute", True)
+        # set by AttentionRecorder.attach to dump a sample of the attention/transport maps
+        self.attention_recorder = None
+        # set by StepTimer.attach to time the alignment losses and the contextual priors apart from the attention
+        self.alignment_timer = None
+        # draw soft_weibull/soft_lognormal samples in eval mode too (Monte-Carlo inference)
+        self.attention_sampling = False
+        # run the act/combine alignment branches in eval mode too and keep their per-head transport cost (which
+        # stays differentiable in training, without the gradient reversal of the alignment loss, e.g. for
+        # distillation)
+        self.alignment_statistics = False
+        self.head_alignment_cost = None
 
         # self.att_contextual_se = config.att_contextual_se
         self.att_se_hid_size = config.att_se_hid_size
@@ -253,9 +522,9 @@ class BertSelfAttention(nn.Module):
             self.se_linear10 = nn.Linear(self.att_se_hid_size, self.att_se_hid_size)
 
             # talking head
-            self.se_linear11 = nn.Linear(12, 12)
-            self.se_linear12 = nn.Linear(12, 12)
-            self.se_linear13 = nn.Linear(12, 12)
+            self.se_linear11 = nn.Linear(self.num_attention_heads, self.num_attention_heads)
+            self.se_linear12 = nn.Linear(self.num_attention_heads, self.num_attention_heads)
+            self.se_linear13 = nn.Linear(self.num_attention_heads, self.num_attention_heads)
 
 
             self.se_linear1.weight.data.normal_(0, np.sqrt(1 / self.attention_head_size))  # TODO: tune
@@ -421,11 +690,103 @@ class BertSelfAttention(nn.Module):
         return res
 
 
+    def _combine_transport(self, key_layer, query_layer, attention_mask, token_index, reverse=True):
+        """
+        Transport of the combine alignment between the tokens of each sequence (Version 1) and between the heads of
+        each token (Version 2). With `reverse`, the gradient reaching the keys and queries is flipped, as the
+        alignment loss is minimized by the critics and navigators and maximized by the keys and queries. Returns the
+        loss and maps of both transports followed by their costs and the token mask of Version 1.
+        """
+        grad_reverse = (lambda x: GradReverse.apply(x, 1)) if reverse else (lambda x: x)
+
+        # Version 1: transport between the tokens of each sequence, cropped to the longest one and masked
+        pair_mask, pair_key, pair_query = crop_to_longest(attention_mask, token_index, key_layer, query_layer)
+        key_layer_reverse = grad_reverse(pair_key)
+        query_layer_reverse = grad_reverse(pair_query)
+        real_out = self.critic_for(key_layer_reverse)
+        fake_out = self.critic_for(query_layer_reverse)
+        # cost = torch.cdist(real_out, fake_out, p=2)
+        cost = self.fast_cdist(real_out, fake_out)
+
+        n_x = self.navigator_for(key_layer_reverse)
+        n_y = self.navigator_for(query_layer_reverse)
+        d = torch.matmul(n_x, n_y.transpose(-1, -2))
+        err, m_backward, m_forward = masked_transport_loss(cost, d, pair_mask, self.rho)
+
+        # Version 2: transport between the heads of each non-padding token, packed to [N, H, d]
+        key_tokens_reverse = grad_reverse(pack_tokens(key_layer, token_index))
+        query_tokens_reverse = grad_reverse(pack_tokens(query_layer, token_index))
+        real_out_head = self.critic_for_two(key_tokens_reverse)
+        fake_out_head = self.critic_for_two(query_tokens_reverse)
+        cost_head = self.fast_cdist(real_out_head, fake_out_head)
+
+        n_x_tran = self.navigator_for_two(key_tokens_reverse)
+        n_y_tran = self.navigator_for_two(query_tokens_reverse)
+        d_head = torch.matmul(n_x_tran, n_y_tran.transpose(-1, -2))
+        errHead, m_backward_head, m_forward_head = masked_transport_loss(cost_head, d_head, None, self.rho)
+        return err, m_backward, m_forward, errHead, m_backward_head, m_forward_head, cost, cost_head, pair_mask
+
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
+    def _needs_logprobs(self):
+        """ `log(attention_probs + eps)` is only read by the non-fused variational samplers. """
+        sampling = self.training or self.attention_sampling
+        return sampling and not self.att_noise_recompute and self.att_type in ('soft_weibull', 'soft_lognormal')
+
+    @staticmethod
+    def _split_sample_mask(hidden_states, attention_mask):
+        """
+        In a batched Monte-Carlo forward the attention mask is repeated for the S samples while the first layer still
+        receives the B un-repeated hidden states. Returns the mask for those B rows and S.
+        """
+        if attention_mask is None or attention_mask.size(0) == hidden_states.size(0):
+            return attention_mask, 1
+        return attention_mask[: hidden_states.size(0)], attention_mask.size(0) // hidden_states.size(0)
+
+    def _record_transport_maps(self, m_forward, m_backward, suffix="", packed_shape=None, token_index=None):
+        """
+        Hands transport maps to the attention recorder. Per-token head maps packed to [N, H, H] are unpacked to
+        [B, L, H, H] first, `packed_shape` being (B, L).
+        """
+        if packed_shape is not None:
+            m_forward = unpack_tokens(m_forward, token_index, *packed_shape)
+            m_backward = unpack_tokens(m_backward, token_index, *packed_shape)
+        self.attention_recorder.record("m_forward" + suffix, m_forward, per_head=packed_shape is None)
+        self.attention_recorder.record("m_backward" + suffix, m_backward, per_head=packed_shape is None)
+
+    def prune_head_mixing(self, head_index):
+        """ Keeps the `head_index` heads (among the current ones) in the talking-head layers, which mix the heads. """
+        for name in ("se_linear11", "se_linear12", "se_linear13"):
+            if hasattr(self, name):
+                layer = prune_linear_layer(getattr(self, name), head_index, dim=0)
+                setattr(self, name, prune_linear_layer(layer, head_index, dim=1))
+
+    def _attention_probs(self, query_layer, key_layer, attention_mask, eps):
+        """
+        Computes the masked attention scores in place and normalizes them, returning
+        `(attention_scores, attention_probs, logprobs)`. The raw scores are only returned when talking_head still
+        needs them and `logprobs` is None when nothing reads it.
+        """
+        # Take the dot product between "query" and "key" to get the raw attention scores.
+        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+        attention_scores.div_(math.sqrt(self.attention_head_size))
+        if attention_mask is not None:
+            # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
+            attention_scores.add_(attention_mask)
+
+        logprobs = None
+        if self._needs_logprobs():
+            # equal to log(attention_probs + eps); the clamp only bounds the masked positions
+            logprobs = F.log_softmax(attention_scores, dim=-1).clamp(min=math.log(eps))
+
+        # Normalize the attention scores to probabilities.
+        keep_scores = self.adver_type == 'talking_head'
+        attention_probs = attention_softmax_(attention_scores, inplace=not keep_scores)
+        return (attention_scores if keep_scores else None), attention_probs, logprobs
+
     def forward(
         self,
         hidden_states,
@@ -451,20 +812,14 @@ class BertSelfAttention(nn.Module):
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        if attention_mask is not None:
-            # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
-            attention_scores = attention_scores + attention_mask
+        sample_attention_mask = attention_mask
+        attention_mask, num_samples = self._split_sample_mask(hidden_states, attention_mask)
 
-        # Normalize the attention scores to probabilities.
         eps = 1e-20
-        attention_probs = nn.Softmax(dim=-1)(attention_scores)
+        attention_scores, attention_probs, logprobs = self._attention_probs(query_layer, key_layer, attention_mask, eps)
 
-        logprobs = torch.log(attention_probs + eps)
         # Version 2
-        self.KL_backward = torch.ones_like(key_layer).cuda().mean()
+        self.KL_backward = key_layer.new_tensor(1.0)
 
         # talking head
         if self.adver_type == 'talking_head':
@@ -483,13 +838,30 @@ class BertSelfAttention(nn.Module):
             attention_probs_value = attention_probs_value.permute(0, 3, 1, 2)
             attention_probs = attention_probs_value
 
-        if self.training:
+        if self.attention_recorder is not None:
+            self.attention_recorder.record("attention", attention_probs)
+
+        if num_samples > 1:
+            # the projections and probabilities are shared, only the attention samples differ
+            attention_probs, query_layer, key_layer, value_layer = (
+                t.repeat(num_samples, 1, 1, 1) for t in (attention_probs, query_layer, key_layer, value_layer)
+            )
+            if logprobs is not None:
+                logprobs = logprobs.repeat(num_samples, 1, 1, 1)
+            attention_mask = sample_attention_mask
+
+        alignment_timer = self.alignment_timer
+        if alignment_timer is not None:
+            alignment_timer.start_alignment()
+        if self.training or self.alignment_statistics:
             if self.adver_type == 'gan':
-                key_layer_reverse = GradReverse.apply(key_layer, 1)
-                query_layer_reverse = GradReverse.apply(query_layer, 1)
+                # the discriminator only sees the non-padding tokens
+                token_index = valid_token_index(attention_mask)
+                key_layer_reverse = GradReverse.apply(pack_tokens(key_layer, token_index), 1)
+                query_layer_reverse = GradReverse.apply(pack_tokens(query_layer, token_index), 1)
 
                 real_out = self.discriminator_for(key_layer_reverse)
-                real_label = Variable(torch.ones_like(real_out)).cuda().detach()
+                real_label = Variable(torch.ones_like(real_out)).detach()
                 # real_label_reverse = GradReverse.apply(real_label, 1)
 
                 # key_layer 的 size：torch.Size([2, 12, 512, 64])
@@ -497,7 +869,7 @@ class BertSelfAttention(nn.Module):
                 fake_query = query_layer_reverse.detach()
                 fake_out = self.discriminator_for(fake_query)
 
-                fake_label = Variable(torch.zeros_like(fake_out)).cuda().detach()
+                fake_label = Variable(torch.zeros_like(fake_out)).detach()
                 # fake_label_reverse = GradReverse.apply(fake_label, 1)
 
                 # import pdb
@@ -508,48 +880,27 @@ class BertSelfAttention(nn.Module):
                 self.KL_backward = d_loss.mean()
 
             if self.adver_type == 'combine':
-                rho = self.rho
-                key_layer_reverse = GradReverse.apply(key_layer, 1)
-                query_layer_reverse = GradReverse.apply(query_layer, 1)
-                real_out = self.critic_for(key_layer_reverse)
-                fake_out = self.critic_for(query_layer_reverse)
-                # Version 1
-                # cost = torch.cdist(real_out, fake_out, p=2)
-                cost = self.fast_cdist(real_out, fake_out)
-
-                # Version 2
+                token_index = valid_token_index(attention_mask)
+                transport = self._combine_transport(key_layer, query_layer, attention_mask, token_index)
+                err, m_backward, m_forward, errHead, m_backward_head, m_forward_head = transport[:6]
+
+                if self.attention_recorder is not None:
+                    self._record_transport_maps(m_forward, m_backward)
+                    self._record_transport_maps(
+                        m_forward_head, m_backward_head, "_head", (key_layer.size(0), key_layer.size(2)), token_index
+                    )
+
+                if self.alignment_statistics:
+                    if self.training:
+                        # recomputed without the gradient reversal, so that a loss on the costs (e.g. matching the
+                        # ones of a teacher) reaches the keys and queries with its own sign
+                        transport = self._combine_transport(key_layer, query_layer, attention_mask, token_index, False)
+                    _, m_backward, m_forward, _, m_backward_head, m_forward_head, cost, cost_head, pair_mask = transport
+                    self.head_alignment_cost = (
+                        head_transport_cost(cost, m_backward, m_forward, self.rho, 1, pair_mask)
+                        + head_transport_cost(cost_head, m_backward_head, m_forward_head, self.rho, -1)
+                    )
 
-                real_out_head = self.critic_for_two(key_layer_reverse)
-                fake_out_head = self.critic_for_two(query_layer_reverse)
-
-                real_out_tran = real_out_head.permute(0, 2, 1, 3)  # transpose(1, 2).contiguous()
-                fake_out_tran = fake_out_head.permute(0, 2, 1, 3)  # transpose(1, 2).contiguous()
-
-                cost_head = self.fast_cdist(real_out_tran, fake_out_tran)
-
-                # Version 1
-                n_x = self.navigator_for(key_layer_reverse)
-                n_y = self.navigator_for(query_layer_reverse)
-                d = torch.matmul(n_x, n_y.transpose(-1, -2))
-
-                # Version 2
-                n_x_tran = self.navigator_for_two(key_layer_reverse)
-                n_y_tran = self.navigator_for_two(query_layer_reverse)
-
-                n_x_tran = n_x_tran.transpose(1, 2)
-                n_y_tran = n_y_tran.transpose(1, 2)
-                d_head = torch.matmul(n_x_tran, n_y_tran.transpose(-1, -2))
-
-                # 现在的 倒数第一维和 倒数第二维 不一定对应的 是 i j， 要想清楚 两堆sample 是什么东西
-                m_backward = torch.nn.functional.softmax(d, dim=-2)  # backward transport map key
-                m_forward = torch.nn.functional.softmax(d, dim=-1)  # forward transport map query
-
-                m_backward_head = torch.nn.functional.softmax(d_head, dim=-2)  # backward transport map key
-                m_forward_head = torch.nn.functional.softmax(d_head, dim=-1)  # forward transport map query
-
-                err = - ((1 - rho) * (cost * m_backward).sum(-2).mean() + rho * (cost * m_forward).sum(-1).mean())
-                errHead = - ((1 - rho) * (cost_head * m_backward_head).sum(-2).mean() + rho * (
-                            cost_head * m_forward_head).sum(-1).mean())
                 # Version 1
                 errD = err + errHead
 
@@ -560,7 +911,7 @@ class BertSelfAttention(nn.Module):
                 self.KL_backward = errD.mean()
 
         if self.att_prior_type == 'contextual':
-            if self.att_type == 'soft_weibull' or self.att_type == 'gamma_att':
+            if self.att_type == 'soft_weibull':
                 if self.att_se_nonlinear == 'none':
                     dot_gamma = self.se_linear1(key_layer)
                 else:
@@ -581,9 +932,23 @@ class BertSelfAttention(nn.Module):
                 self.prior_att_weights = F.softmax(dot_mu, dim=-1)
                 self.mean_normal_prior = torch.log(self.prior_att_weights + eps)  # - self.sigma_normal_prior ** 2 / 2
 
+        if alignment_timer is not None:
+            alignment_timer.stop_alignment()
+
+        context_layer = None
         if self.att_type == 'soft_weibull':
-            if self.training:
-                if 0:
+            if self.training or self.attention_sampling:
+                if self.att_noise_recompute:
+                    context_layer, self.KL_backward, out_weight = WeibullAttentionSample.apply(
+                        attention_probs,
+                        value_layer,
+                        self.alpha_gamma,
+                        new_attention_noise_seed(),
+                        float(self.k_weibull),
+                        float(self.beta_gamma),
+                        eps,
+                    )
+                elif 0:
                     self.alpha_gamma = attention_probs
                     if self.k_parameterization == 'blue':
                         k_weibull = 1.0  # todo
@@ -620,65 +985,18 @@ class BertSelfAttention(nn.Module):
             else:
                 out_weight = attention_probs
 
-        if self.att_type == 'gamma_att':
-            if self.training:
-                # change
-                u_weibull = (0.90 - 0.10) * torch.rand_like(logprobs) + 0.10
-                scores_mid = torch.exp(logprobs) + 0.05
-                # scores_mid = torch.exp(logprobs2)
-                if laysa == 0:
-                    hidden_pre = torch.exp(logprobs)
-                    # hidden_pre = torch.exp(logprobs2)
-
-                hidden = torch.log(1 + torch.exp(torch.matmul(self.w_3, hidden_pre) + self.b_3) + eps) * self.beta_gamma
-
-                # k_weibull = (self.prior_gamma * (
-                #     torch.log(1 + torch.exp(torch.matmul(self.w_1, hidden) + self.b_1) + eps))) + scores_mid
-
-                k_weibull = (self.prior_gamma * (
-                    torch.log(1 + torch.exp(torch.matmul(self.w_1, hidden) + self.b_1) + eps))) + scores_mid
-                lambda_weibull = (self.beta_gamma * (
-                    torch.log(1 + torch.exp(torch.matmul(self.w_2, hidden) + self.b_2) + eps))) + \
-                                 (torch.exp(logprobs) / torch.exp(torch.lgamma(1 + 1.0 / k_weibull).type_as(u_weibull)))
-
-                sample_weibull = lambda_weibull * (-torch.log(1.0 - u_weibull + eps)) ** (1.0 / k_weibull)
-                out_weight = sample_weibull / (sample_weibull.sum(-1, keepdim=True) + eps)
-
-                # print(logprobs.size(), 'logprobs.size()')
-                KL = -(self.alpha_gamma * (logprobs - torch.lgamma(
-                    1 + 1.0 / k_weibull)) - np.euler_gamma * self.alpha_gamma / k_weibull \
-                       - self.beta_gamma * torch.exp(logprobs - torch.lgamma(1 + 1.0 / k_weibull) +
-                                                     torch.lgamma(1 + 1.0 / k_weibull)) + \
-                       self.alpha_gamma * torch.log(self.beta_gamma + eps) - torch.lgamma(self.alpha_gamma + eps))
-
-                self.KL_backward = KL.mean()
-                # print('111111111111', self.KL_backward)
-                self.hidden = hidden
-                self.sample_weibull = sample_weibull
-            else:
-                # out_weight = attention_probs
-                # change
-                u_weibull = (0.90 - 0.10) * torch.rand_like(logprobs) + 0.10
-                eps = 1e-20
-                scores_mid = torch.exp(logprobs) + 0.05
-                # scores_mid = torch.exp(logprobs2) + 0.05
-
-                if laysa == 0:
-                    hidden_pre = torch.exp(logprobs)
-                    # hidden_pre = torch.exp(logprobs2)
-                hidden = torch.log(1 + torch.exp(torch.matmul(self.w_3, hidden_pre) + self.b_3) + eps) * self.beta_gamma
-                k_weibull = (self.prior_gamma * (
-                    torch.log(1 + torch.exp(torch.matmul(self.w_1, hidden) + self.b_1) + eps))) + scores_mid
-                lambda_weibull = (self.beta_gamma * (
-                    torch.log(1 + torch.exp(torch.matmul(self.w_2, hidden) + self.b_2) + eps))) + \
-                                 (torch.exp(logprobs) / torch.exp(torch.lgamma(1 + 1.0 / k_weibull).type_as(u_weibull)))
-                att_map = lambda_weibull * (torch.exp(torch.lgamma(1 + 1.0 / k_weibull)))
-                out_weight = att_map / (att_map.sum(-1, keepdim=True) + eps)
-                self.hidden = out_weight
-                self.sample_weibull = out_weight
-
         elif self.att_type == 'soft_lognormal':
-            if self.training:
+            if (self.training or self.attention_sampling) and self.att_noise_recompute:
+                context_layer, self.KL_backward, out_weight = LognormalAttentionSample.apply(
+                    attention_probs,
+                    value_layer,
+                    self.mean_normal_prior,
+                    self.sigma_normal_prior,
+                    new_attention_noise_seed(),
+                    float(self.sigma_normal_posterior),
+                    eps,
+                )
+            elif self.training or self.attention_sampling:
                 mean_normal_posterior = logprobs - self.sigma_normal_posterior ** 2 / 2
                 out_weight = F.softmax(mean_normal_posterior + self.sigma_normal_posterior * torch.randn_like(logprobs),
                                        dim=-1)
@@ -693,13 +1011,23 @@ class BertSelfAttention(nn.Module):
 
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
-            out_weight = self.dropout(out_weight)
+            out_weight = F.dropout(
+                out_weight, self.dropout.p, self.training, inplace=_can_modify_inplace(out_weight)
+            )
 
         # Mask heads if we want to
         if head_mask is not None:
-            out_weight = out_weight * head_mask
+            if context_layer is not None:
+                # head_mask is constant over the last two dims, so it can be applied to the fused context
+                context_layer = context_layer * head_mask
+            if context_layer is None or self.output_attentions:
+                if _can_modify_inplace(out_weight):
+                    out_weight.mul_(head_mask)
+                else:
+                    out_weight = out_weight * head_mask
 
-        context_layer = torch.matmul(out_weight, value_layer)
+        if context_layer is None:
+            context_layer = torch.matmul(out_weight, value_layer)
 
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
@@ -741,10 +1069,12 @@ class BertAttention(nn.Module):
             # Compute how many pruned heads are before the head and move the index accordingly
             head = head - sum(1 if h < head else 0 for h in self.pruned_heads)
             mask[head] = 0
+        head_index = mask[:, 0].eq(1).nonzero().view(-1)
         mask = mask.view(-1).contiguous().eq(1)
         index = torch.arange(len(mask))[mask].long()
 
         # Prune linear layers
+        self.self.prune_head_mixing(head_index)
         self.self.query = prune_linear_layer(self.self.query, index)
         self.self.key = prune_linear_layer(self.self.key, index)
         self.self.value = prune_linear_layer(self.self.value, index)
@@ -770,7 +1100,9 @@ class BertAttention(nn.Module):
         # self.hidden_medium = self.self.hidden
         # self.sample_weibull_medium = self.self.sample_weibull
 
-
+        if self_outputs[0].size(0) != hidden_states.size(0):
+            # first layer of a batched Monte-Carlo forward, see BertSelfAttention._split_sample_mask
+            hidden_states = hidden_states.repeat(self_outputs[0].size(0) // hidden_states.size(0), 1, 1)
         attention_output = self.output(self_outputs[0], hidden_states)
         outputs = (attention_output,) + self_outputs[1:]  # add attentions if we output them
         return outputs
@@ -861,11 +1193,17 @@ class BertEncoder(nn.Module):
         head_mask=None,
         encoder_hidden_states=None,
         encoder_attention_mask=None,
+        start_layer=0,
     ):
+        """
+        Runs the layers from ``start_layer`` on: with ``start_layer > 0``, ``hidden_states`` are the outputs of the
+        previous ones, e.g. the cached activations of frozen layers.
+        """
         self.KL_inner_list = []
         all_hidden_states = ()
         all_attentions = ()
-        for i, layer_module in enumerate(self.layer):
+        for i in range(start_layer, len(self.layer)):
+            layer_module = self.layer[i]
             if self.output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
 
@@ -1084,8 +1422,41 @@ class BertModel(BertPreTrainedModel):
         self.encoder = BertEncoder(config)
         self.pooler = BertPooler(config)
 
+        # number of bottom layers whose activations can be cached, see encode_frozen
+        self.frozen_layers = getattr(config, "frozen_layers", 0)
+        if not 0 <= self.frozen_layers < config.num_hidden_layers:
+            raise ValueError(
+                "frozen_layers should be in [0, {}), got {}".format(config.num_hidden_layers, self.frozen_layers)
+            )
+
         self.init_weights()
 
+    def encode_frozen(self, input_ids=None, attention_mask=None, token_type_ids=None, position_ids=None):
+        """
+        Hidden states of shape (batch_size, sequence_length, hidden_size) after the embeddings and the
+        ``config.frozen_layers`` first layers, to be fed back to :meth:`forward` as ``frozen_hidden_states`` which then
+        only runs the following layers. Call it in eval mode and without gradients to cache them.
+        """
+        input_shape = input_ids.size()
+        if attention_mask is None:
+            attention_mask = torch.ones(input_shape, device=input_ids.device)
+        extended_attention_mask = self.get_extended_attention_mask(attention_mask, input_shape, input_ids.device)
+        head_mask = self.get_head_mask(None, self.config.num_hidden_layers)
+
+        hidden_states = self.embeddings(input_ids=input_ids, position_ids=position_ids, token_type_ids=token_type_ids)
+        for i in range(self.frozen_layers):
+            hidden_states = self.encoder.layer[i](hidden_states, extended_attention_mask, head_mask[i])[0]
+        return hidden_states
+
+    def frozen_modules(self):
+        """ The modules run by :meth:`encode_frozen`: the embeddings and the ``config.frozen_layers`` first layers. """
+        return [self.embeddings] + list(self.encoder.layer[: self.frozen_layers])
+
+    def freeze_bottom_layers(self):
+        """ Stops the training of the parameters of :meth:`frozen_modules`. """
+        for module in self.frozen_modules():
+            module.requires_grad_(False)
+
     def get_input_embeddings(self):
         return self.embeddings.word_embeddings
 
@@ -1111,8 +1482,13 @@ class BertModel(BertPreTrainedModel):
         inputs_embeds=None,
         encoder_hidden_states=None,
         encoder_attention_mask=None,
+        frozen_hidden_states=None,
     ):
         r"""
+        frozen_hidden_states (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, sequence_length, hidden_size)`, `optional`, defaults to :obj:`None`):
+            Output of :meth:`encode_frozen`, instead of :obj:`input_ids`: only the layers above
+            ``config.frozen_layers`` are run.
+
     Return:
         :obj:`tuple(torch.FloatTensor)` comprising various elements depending on the configuration (:class:`~transformers.BertConfig`) and inputs:
         last_hidden_state (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, sequence_length, hidden_size)`):
@@ -1153,17 +1529,22 @@ class BertModel(BertPreTrainedModel):
 
         """
 
-        if input_ids is not None and inputs_embeds is not None:
+        if frozen_hidden_states is not None:
+            if input_ids is not None or inputs_embeds is not None:
+                raise ValueError("You cannot specify both frozen_hidden_states and input_ids or inputs_embeds")
+            input_shape = frozen_hidden_states.size()[:-1]
+            device = frozen_hidden_states.device
+        elif input_ids is not None and inputs_embeds is not None:
             raise ValueError("You cannot specify both input_ids and inputs_embeds at the same time")
         elif input_ids is not None:
             input_shape = input_ids.size()
+            device = input_ids.device
         elif inputs_embeds is not None:
             input_shape = inputs_embeds.size()[:-1]
+            device = inputs_embeds.device
         else:
             raise ValueError("You have to specify either input_ids or inputs_embeds")
 
-        device = input_ids.device if input_ids is not None else inputs_embeds.device
-
         if attention_mask is None:
             attention_mask = torch.ones(input_shape, device=device)
         if token_type_ids is None:
@@ -1193,15 +1574,22 @@ class BertModel(BertPreTrainedModel):
         # and head_mask is converted to shape [num_hidden_layers x batch x num_heads x seq_length x seq_length]
         head_mask = self.get_head_mask(head_mask, self.config.num_hidden_layers)
 
-        embedding_output = self.embeddings(
-            input_ids=input_ids, position_ids=position_ids, token_type_ids=token_type_ids, inputs_embeds=inputs_embeds
-        )
+        if frozen_hidden_states is not None:
+            embedding_output = frozen_hidden_states
+        else:
+            embedding_output = self.embeddings(
+                input_ids=input_ids,
+                position_ids=position_ids,
+                token_type_ids=token_type_ids,
+                inputs_embeds=inputs_embeds,
+            )
         encoder_outputs = self.encoder(
             embedding_output,
             attention_mask=extended_attention_mask,
             head_mask=head_mask,
             encoder_hidden_states=encoder_hidden_states,
             encoder_attention_mask=encoder_extended_attention_mask,
+            start_layer=self.frozen_layers if frozen_hidden_states is not None else 0,
         )
         sequence_output = encoder_outputs[0]
         pooled_output = self.pooler(sequence_output)
@@ -1549,6 +1937,37 @@ class BertForNextSentencePrediction(BertPreTrainedModel):
         return outputs  # (next_sentence_loss), seq_relationship_score, (hidden_states), (attentions)
 
 
+def attention_sample_predict(model, input_ids, attention_mask=None, token_type_ids=None, num_samples=8):
+    """
+    Monte-Carlo prediction with the variational (soft_weibull/soft_lognormal) attention of a sequence classification
+    model. The S = `num_samples` attention samples are drawn in a single forward pass: the batch is repeated S times
+    after the embeddings and the first-layer query/key/value projections, which are shared by all samples.
+
+    Returns the mean class probabilities of shape (batch_size, num_labels) and the entropy of that mean (the
+    predictive entropy) of shape (batch_size,). Call it in eval mode so that dropout stays off.
+    """
+    if model.num_labels == 1:
+        raise ValueError("Monte-Carlo attention prediction needs a classification head (num_labels > 1)")
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+
+    attention_modules = [module for module in model.modules() if isinstance(module, BertSelfAttention)]
+    for module in attention_modules:
+        module.attention_sampling = True
+    try:
+        with torch.no_grad():
+            logits = model(
+                input_ids, attention_mask=attention_mask.repeat(num_samples, 1), token_type_ids=token_type_ids
+            )[0]
+    finally:
+        for module in attention_modules:
+            module.attention_sampling = False
+
+    probs = F.softmax(logits.view(num_samples, input_ids.size(0), -1), dim=-1).mean(0)
+    predictive_entropy = -(probs * torch.log(probs + 1e-20)).sum(-1)
+    return probs, predictive_entropy
+
+
 @add_start_docstrings(
     """Bert Model transformer with a sequence classification/regression head on top (a linear layer on top of
     the pooled output) e.g. for GLUE tasks. """,
@@ -1575,6 +1994,7 @@ class BertForSequenceClassification(BertPreTrainedModel):
         head_mask=None,
         inputs_embeds=None,
         labels=None,
+        frozen_hidden_states=None,
     ):
         r"""
         labels (:obj:`torch.LongTensor` of shape :obj:`(batch_size,)`, `optional`, defaults to :obj:`None`):
@@ -1582,6 +2002,8 @@ class BertForSequenceClassification(BertPreTrainedModel):
             Indices should be in :obj:`[0, ..., config.num_labels - 1]`.
             If :obj:`config.num_labels == 1` a regression loss is computed (Mean-Square loss),
             If :obj:`config.num_labels > 1` a classification loss is computed (Cross-Entropy).
+        frozen_hidden_states (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, sequence_length, hidden_size)`, `optional`, defaults to :obj:`None`):
+            Cached output of :meth:`BertModel.encode_frozen`, instead of :obj:`input_ids`.
 
     Returns:
         :obj:`tuple(torch.FloatTensor)` comprising various elements depending on the configuration (:class:`~transformers.BertConfig`) and inputs:
@@ -1624,6 +2046,7 @@ class BertForSequenceClassification(BertPreTrainedModel):
             position_ids=position_ids,
             head_mask=head_mask,
             inputs_embeds=inputs_embeds,
+            frozen_hidden_states=frozen_hidden_states,
         )
 
         pooled_output = outputs[1]
@@ -1635,10 +2058,9 @@ class BertForSequenceClassification(BertPreTrainedModel):
 
         KL = 0
         count = 0
-        for inner_list in self.bert.encoder.KL_inner_list:
-            for item in inner_list:
-                KL = KL + item
-                count = count + 1
+        for item in self.bert.encoder.KL_inner_list:
+            KL = KL + item
+            count = count + 1
         KL = KL / count
 
 
@@ -1657,6 +2079,14 @@ class BertForSequenceClassification(BertPreTrainedModel):
 
         return outputs  # (loss), logits, (hidden_states), (attentions)
 
+    def predict_with_attention_samples(self, input_ids, attention_mask=None, token_type_ids=None, num_samples=8):
+        """
+        Draws ``num_samples`` variational attention samples in one batched forward pass and returns the mean class
+        probabilities of shape :obj:`(batch_size, num_labels)` and the predictive entropy of shape
+        :obj:`(batch_size,)`. See :func:`~transformers.modeling_bert.attention_sample_predict`.
+        """
+        return attention_sample_predict(self, input_ids, attention_mask, token_type_ids, num_samples)
+
 
 @add_start_docstrings(
     """Bert Model with a multiple choice classification head on top (a linear layer on top of
@@ -0,0 +1,278 @@
+# coding=utf-8
+# Copyright 2020 The HuggingFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" TorchScript/ONNX export and int8 quantization of the (variational) attention BERT/ALBERT models for inference. """
+
+import copy
+import logging
+import math
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import torch
+from torch import Tensor, nn
+
+from .modeling_albert import AlbertAttention, AlbertLayer
+from .modeling_bert import BertIntermediate, BertOutput, BertSelfAttention, BertSelfOutput
+
+
+logger = logging.getLogger(__name__)
+
+# attention types whose eval-mode weights only depend on the current layer
+EXPORTABLE_ATT_TYPES = ("soft_attention", "soft_weibull", "soft_lognormal")
+
+
+class InferenceSelfAttention(nn.Module):
+    """
+    Eval-mode forward of a BertSelfAttention/AlbertAttention, specialized for its configuration: the attention
+    weights are the deterministic (mean) ones, the talking-head mixing is only kept when the layer uses it and the
+    alignment critics, priors and KL terms, which only matter for training, are dropped. For ALBERT, the output
+    projection and layer norm of the attention block are included.
+
+    The module writes no attributes in forward and is compatible with ``torch.jit.script``.
+    """
+
+    __constants__ = ["num_attention_heads", "attention_head_size", "all_head_size", "talking_head", "albert"]
+
+    def __init__(self, attention):
+        super().__init__()
+        self.num_attention_heads = attention.num_attention_heads
+        self.attention_head_size = attention.attention_head_size
+        self.all_head_size = self.num_attention_heads * self.attention_head_size
+        self.talking_head = attention.adver_type == "talking_head"
+        self.albert = isinstance(attention, AlbertAttention)
+
+        self.query = attention.query
+        self.key = attention.key
+        self.value = attention.value
+        self.se_linear11 = attention.se_linear11 if self.talking_head else nn.Identity()
+        self.se_linear12 = attention.se_linear12 if self.talking_head else nn.Identity()
+        self.dense = attention.dense if self.albert else nn.Identity()
+        self.LayerNorm = attention.LayerNorm if self.albert else nn.Identity()
+        # read by the surrounding layers, which collect the KL terms of training
+        self.KL_backward = 0.0
+
+    def transpose_for_scores(self, x: Tensor) -> Tensor:
+        x = x.view(x.size(0), x.size(1), self.num_attention_heads, self.attention_head_size)
+        return x.permute(0, 2, 1, 3)
+
+    def forward(
+        self,
+        hidden_states: Tensor,
+        attention_mask: Optional[Tensor] = None,
+        head_mask: Optional[Tensor] = None,
+        encoder_hidden_states: Optional[Tensor] = None,
+        encoder_attention_mask: Optional[Tensor] = None,
+    ) -> Tuple[Tensor]:
+        query_layer = self.transpose_for_scores(self.query(hidden_states))
+        if encoder_hidden_states is not None:
+            key_layer = self.transpose_for_scores(self.key(encoder_hidden_states))
+            value_layer = self.transpose_for_scores(self.value(encoder_hidden_states))
+            attention_mask = encoder_attention_mask
+        else:
+            key_layer = self.transpose_for_scores(self.key(hidden_states))
+            value_layer = self.transpose_for_scores(self.value(hidden_states))
+
+        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2)) / math.sqrt(self.attention_head_size)
+        if attention_mask is not None:
+            attention_scores = attention_scores + attention_mask
+        if self.talking_head:
+            attention_scores = self.se_linear11(attention_scores.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+        attention_probs = torch.softmax(attention_scores, dim=-1)
+        if self.talking_head:
+            attention_probs = self.se_linear12(attention_probs.permute(0, 2, 3, 1)).permute(0, 3, 1, 2)
+        if head_mask is not None:
+            attention_probs = attention_probs * head_mask
+
+        context_layer = torch.matmul(attention_probs, value_layer).permute(0, 2, 1, 3).contiguous()
+        context_layer = context_layer.view(context_layer.size(0), context_layer.size(1), self.all_head_size)
+        if self.albert:
+            context_layer = self.LayerNorm(hidden_states + self.dense(context_layer))
+        return (context_layer,)
+
+
+class InferenceWrapper(nn.Module):
+    """ Calls a model with positional (input_ids, attention_mask, token_type_ids) and returns its first output. """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)[0]
+
+
+def specialize_for_inference(model):
+    """
+    Returns an eval-mode copy of a BERT/ALBERT model whose attention layers are replaced by
+    :class:`InferenceSelfAttention` and which outputs neither attentions nor hidden states. Its forward no longer
+    branches on the attention configuration nor writes module attributes in the attention layers, so it can be
+    traced into a compact graph.
+    """
+    model = copy.deepcopy(model).eval()
+    attentions = [(name, module) for name, module in model.named_modules() if isinstance(module, BertSelfAttention)]
+    if not attentions:
+        raise ValueError("{} has no BERT/ALBERT attention layer to specialize".format(model.__class__.__name__))
+
+    for name, attention in attentions:
+        if attention.att_type not in EXPORTABLE_ATT_TYPES:
+            raise ValueError(
+                "Exporting att_type={} is not supported, use one of {} with any adver_type (talking_head is kept, "
+                "the other ones only add training losses)".format(attention.att_type, ", ".join(EXPORTABLE_ATT_TYPES))
+            )
+        *parent_names, child_name = name.split(".")
+        parent = model
+        for parent_name in parent_names:
+            parent = getattr(parent, parent_name)
+        setattr(parent, child_name, InferenceSelfAttention(attention))
+
+    for module in model.modules():
+        if hasattr(module, "output_attentions"):
+            module.output_attentions = False
+        if hasattr(module, "output_hidden_states"):
+            module.output_hidden_states = False
+    return model
+
+
+def dummy_inputs(config, batch_size: int = 1, seq_len: int = 128) -> Tuple[Tensor, Tensor, Tensor]:
+    input_ids = torch.randint(config.vocab_size, (batch_size, seq_len), dtype=torch.long)
+    return input_ids, torch.ones_like(input_ids), torch.zeros_like(input_ids)
+
+
+def export_torchscript(model, output_path: Optional[str] = None, batch_size: int = 1, seq_len: int = 128):
+    """
+    Traces the specialized model into a ``torch.jit.ScriptModule`` taking (input_ids, attention_mask,
+    token_type_ids) and returning the first output of the model, and saves it to ``output_path`` if given.
+    """
+    wrapper = InferenceWrapper(specialize_for_inference(model))
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, dummy_inputs(model.config, batch_size, seq_len))
+    if output_path is not None:
+        traced.save(output_path)
+        logger.info("TorchScript model saved in {}".format(output_path))
+    return traced
+
+
+def export_onnx(model, output_path: str, batch_size: int = 1, seq_len: int = 128, opset_version: int = 11):
+    """ Exports the specialized model to ONNX, with dynamic batch and sequence axes. """
+    wrapper = InferenceWrapper(specialize_for_inference(model))
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper,
+            dummy_inputs(model.config, batch_size, seq_len),
+            output_path,
+            input_names=input_names,
+            output_names=["output"],
+            dynamic_axes=dict({name: {0: "batch", 1: "sequence"} for name in input_names}, output={0: "batch"}),
+            opset_version=opset_version,
+        )
+    logger.info("ONNX model saved in {}".format(output_path))
+
+
+def load_onnxruntime(onnx_path: str):
+    """
+    Loads an ONNX graph saved by :func:`export_onnx` in a CPU ``onnxruntime`` session, wrapped in a callable taking
+    and returning tensors like the TorchScript export, or returns ``None`` if onnxruntime is not installed.
+    """
+    try:
+        import onnxruntime
+    except ImportError:
+        logger.warning(
+            "onnxruntime not installed, we won't run the ONNX model. "
+            "Install onnxruntime (pip install onnxruntime) to benchmark ONNX exports."
+        )
+        return None
+
+    session = onnxruntime.InferenceSession(onnx_path)
+    input_names = [node.name for node in session.get_inputs()]
+
+    def run(*inputs):
+        feed = {name: tensor.cpu().numpy() for name, tensor in zip(input_names, inputs)}
+        return torch.from_numpy(session.run(None, feed)[0])
+
+    return run
+
+
+def compare_latency(model, exported, batch_size: int = 1, seq_len: int = 128, num_runs: int = 10) -> Dict[str, float]:
+    """
+    Mean CPU latency, in milliseconds, of the eager model and of an exported model (a TorchScript module or the
+    onnxruntime session of :func:`load_onnxruntime`) taking (input_ids, attention_mask, token_type_ids), after one
+    warm-up call of each.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    inputs = dummy_inputs(model.config, batch_size, seq_len)
+    eager = InferenceWrapper(model)
+
+    latencies = {}
+    with torch.no_grad():
+        for name, module in (("eager", eager), ("exported", exported)):
+            module(*inputs)
+            start = time.perf_counter()
+            for _ in range(num_runs):
+                module(*inputs)
+            latencies[name] = (time.perf_counter() - start) / num_runs * 1000
+    latencies["speedup"] = latencies["eager"] / latencies["exported"]
+    return latencies
+
+
+def quantizable_linears(model) -> List[str]:
+    """
+    Names of the linear layers doing the inference compute of a BERT/ALBERT model: the query/key/value and output
+    projections of the attention and the feed-forward layers. The alignment critics, navigators and priors only run
+    in training and stay in float, as do the embeddings, the pooler and the classifier.
+    """
+    names = []
+    for name, module in model.named_modules():
+        if isinstance(module, BertSelfAttention):
+            children = ["query", "key", "value"] + (["dense"] if isinstance(module, AlbertAttention) else [])
+        elif isinstance(module, (BertSelfOutput, BertIntermediate, BertOutput)):
+            children = ["dense"]
+        elif isinstance(module, AlbertLayer):
+            children = ["ffn", "ffn_output"]
+        else:
+            continue
+        names += ["{}.{}".format(name, child) if name else child for child in children]
+    return names
+
+
+def alignment_modules(model) -> List[str]:
+    """
+    Names of the submodules of the BERT/ALBERT attention layers which only compute the alignment regularizer in
+    training (critics, navigators, priors), i.e. those that :class:`InferenceSelfAttention` drops.
+    """
+    names = []
+    for name, module in model.named_modules():
+        if isinstance(module, BertSelfAttention):
+            kept = ["query", "key", "value", "dropout", "dense", "LayerNorm"]
+            if module.adver_type == "talking_head":
+                kept += ["se_linear11", "se_linear12"]
+            names += [
+                "{}.{}".format(name, child) if name else child
+                for child, _ in module.named_children()
+                if child not in kept
+            ]
+    return names
+
+
+def quantize_dynamic(model, module_names: Optional[Iterable[str]] = None, inplace: bool = False):
+    """
+    Dynamically quantizes the ``module_names`` linear layers (by default :func:`quantizable_linears`) to int8 weights
+    for CPU inference. The names are stored in ``config.quantized_modules``, so that the model saved with
+    ``save_pretrained`` is re-quantized by ``from_pretrained`` before its int8 weights are loaded.
+    """
+    module_names = quantizable_linears(model) if module_names is None else list(module_names)
+    model = torch.quantization.quantize_dynamic(model, set(module_names), dtype=torch.qint8, inplace=inplace)
+    model.config.quantized_modules = module_names
+    return model
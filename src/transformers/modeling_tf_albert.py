@@ -22,7 +22,7 @@ import tensorflow as tf
 
 from .configuration_albert import AlbertConfig
 from .file_utils import add_start_docstrings, add_start_docstrings_to_callable
-from .modeling_tf_bert import ACT2FN, TFBertSelfAttention
+from .modeling_tf_bert import ACT2FN, TFBertSelfAttention, attention_kl_enabled
 from .modeling_tf_utils import TFPreTrainedModel, get_initializer, keras_serializable, shape_list
 from .tokenization_utils import BatchEncoding
 
@@ -235,6 +235,9 @@ class TFAlbertSelfOutput(tf.keras.layers.Layer):
 
 
 class TFAlbertAttention(TFBertSelfAttention):
+    # as in AlbertAttention, `combine` transports the raw keys/queries
+    combine_with_critics = False
+
     def __init__(self, config, **kwargs):
         super().__init__(config, **kwargs)
 
@@ -260,19 +263,7 @@ class TFAlbertAttention(TFBertSelfAttention):
         key_layer = self.transpose_for_scores(mixed_key_layer, batch_size)
         value_layer = self.transpose_for_scores(mixed_value_layer, batch_size)
 
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        # (batch size, num_heads, seq_len_q, seq_len_k)
-        attention_scores = tf.matmul(query_layer, key_layer, transpose_b=True)
-        # scale attention_scores
-        dk = tf.cast(shape_list(key_layer)[-1], tf.float32)
-        attention_scores = attention_scores / tf.math.sqrt(dk)
-
-        if attention_mask is not None:
-            # Apply the attention mask is (precomputed for all layers in TFBertModel call() function)
-            attention_scores = attention_scores + attention_mask
-
-        # Normalize the attention scores to probabilities.
-        attention_probs = tf.nn.softmax(attention_scores, axis=-1)
+        attention_probs, kl = self.attention_weights(query_layer, key_layer, attention_mask, training=training)
 
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
@@ -290,6 +281,8 @@ class TFAlbertAttention(TFBertSelfAttention):
         )  # (batch_size, seq_len_q, all_head_size)
 
         self_outputs = (context_layer, attention_probs) if self.output_attentions else (context_layer,)
+        if self.output_kl and training:
+            self_outputs = self_outputs + (kl,)
 
         hidden_states = self_outputs[0]
 
@@ -297,7 +290,7 @@ class TFAlbertAttention(TFBertSelfAttention):
         hidden_states = self.dropout(hidden_states, training=training)
         attention_output = self.LayerNorm(hidden_states + input_tensor)
 
-        # add attentions if we output them
+        # add attentions (and the KL term) if we output them
         outputs = (attention_output,) + self_outputs[1:]
         return outputs
 
@@ -346,6 +339,7 @@ class TFAlbertLayerGroup(tf.keras.layers.Layer):
 
         self.output_attentions = config.output_attentions
         self.output_hidden_states = config.output_hidden_states
+        self.output_kl = attention_kl_enabled(config)
         self.albert_layers = [
             TFAlbertLayer(config, name="albert_layers_._{}".format(i)) for i in range(config.inner_group_num)
         ]
@@ -355,6 +349,7 @@ class TFAlbertLayerGroup(tf.keras.layers.Layer):
 
         layer_hidden_states = ()
         layer_attentions = ()
+        layer_kl = ()
 
         for layer_index, albert_layer in enumerate(self.albert_layers):
             layer_output = albert_layer([hidden_states, attention_mask, head_mask[layer_index]], training=training)
@@ -366,12 +361,17 @@ class TFAlbertLayerGroup(tf.keras.layers.Layer):
             if self.output_hidden_states:
                 layer_hidden_states = layer_hidden_states + (hidden_states,)
 
+            if self.output_kl and training:
+                layer_kl = layer_kl + (layer_output[-1],)
+
         outputs = (hidden_states,)
         if self.output_hidden_states:
             outputs = outputs + (layer_hidden_states,)
         if self.output_attentions:
             outputs = outputs + (layer_attentions,)
-        # last-layer hidden state, (layer hidden states), (layer attentions)
+        if self.output_kl and training:
+            outputs = outputs + (layer_kl,)
+        # last-layer hidden state, (layer hidden states), (layer attentions), (layer KL terms)
         return outputs
 
 
@@ -382,6 +382,7 @@ class TFAlbertTransformer(tf.keras.layers.Layer):
         self.config = config
         self.output_attentions = config.output_attentions
         self.output_hidden_states = config.output_hidden_states
+        self.output_kl = attention_kl_enabled(config)
         self.embedding_hidden_mapping_in = tf.keras.layers.Dense(
             config.hidden_size,
             kernel_initializer=get_initializer(config.initializer_range),
@@ -397,6 +398,7 @@ class TFAlbertTransformer(tf.keras.layers.Layer):
 
         hidden_states = self.embedding_hidden_mapping_in(hidden_states)
         all_attentions = ()
+        all_kl = ()
 
         if self.output_hidden_states:
             all_hidden_states = (hidden_states,)
@@ -418,6 +420,10 @@ class TFAlbertTransformer(tf.keras.layers.Layer):
             )
             hidden_states = layer_group_output[0]
 
+            if self.output_kl and training:
+                all_kl = all_kl + layer_group_output[-1]
+                layer_group_output = layer_group_output[:-1]
+
             if self.output_attentions:
                 all_attentions = all_attentions + layer_group_output[-1]
 
@@ -429,8 +435,11 @@ class TFAlbertTransformer(tf.keras.layers.Layer):
             outputs = outputs + (all_hidden_states,)
         if self.output_attentions:
             outputs = outputs + (all_attentions,)
+        if all_kl:
+            # mean KL/alignment term over all the layer calls, as in AlbertForSequenceClassification
+            outputs = outputs + (tf.add_n(list(all_kl)) / len(all_kl),)
 
-        # last-layer hidden state, (all hidden states), (all attentions)
+        # last-layer hidden state, (all hidden states), (all attentions), (kl)
         return outputs
 
 
@@ -587,7 +596,7 @@ class TFAlbertMainLayer(tf.keras.layers.Layer):
 
         # add hidden_states and attentions if they are here
         outputs = (sequence_output, pooled_output,) + encoder_outputs[1:]
-        # sequence_output, pooled_output, (hidden_states), (attentions)
+        # sequence_output, pooled_output, (hidden_states), (attentions), (kl)
         return outputs
 
 
@@ -803,6 +812,8 @@ class TFAlbertForSequenceClassification(TFAlbertPreTrainedModel):
             :obj:`(batch_size, num_heads, sequence_length, sequence_length)`:
 
             Attentions weights after the attention softmax, used to compute the weighted average in the self-attention heads.
+        kl (:obj:`tf.Tensor` of shape :obj:`()`, `optional`, returned with ``training=True`` when ``config.att_type`` is a variational attention or ``config.adver_type`` an alignment loss):
+            KL (or alignment) term of the attention layers, averaged over the layers.
 
     Examples::
 
@@ -825,7 +836,7 @@ class TFAlbertForSequenceClassification(TFAlbertPreTrainedModel):
 
         outputs = (logits,) + outputs[2:]  # add hidden states and attention if they are here
 
-        return outputs  # logits, (hidden_states), (attentions)
+        return outputs  # logits, (hidden_states), (attentions), (kl)
 
 
 @add_start_docstrings(
@@ -17,6 +17,7 @@
 
 
 import logging
+import math
 
 import numpy as np
 import tensorflow as tf
@@ -89,6 +90,73 @@ ACT2FN = {
     "gelu_new": tf.keras.layers.Activation(gelu_new),
 }
 
+# activations of the contextual prior, critic and navigator MLPs (config.att_se_nonlinear)
+SE_NONLINEAR = {
+    "none": tf.identity,
+    "relu": tf.nn.relu,
+    "lrelu": lambda x: tf.nn.leaky_relu(x, alpha=0.1),
+    "tanh": tf.tanh,
+}
+
+ALIGNMENT_TYPES = ("gan", "act", "combine")
+# the other adver_type values of the PyTorch models (ot, mmd, act_test) are not ported
+TF_ADVER_TYPES = ("none", "talking_head") + ALIGNMENT_TYPES
+
+
+def attention_kl_enabled(config):
+    """ Whether the attention layers add a KL/alignment term to the outputs of the model in training mode. """
+    return (
+        getattr(config, "att_type", "soft_attention") in ("soft_weibull", "soft_lognormal")
+        or getattr(config, "adver_type", "none") in ALIGNMENT_TYPES
+    )
+
+
+@tf.custom_gradient
+def grad_reverse(x):
+    """ Identity in the forward pass, negates the gradient in the backward pass (GradReverse in modeling_bert). """
+
+    def grad(dy):
+        return -dy
+
+    return tf.identity(x), grad
+
+
+def fast_cdist(x1, x2):
+    """ Pairwise euclidean distances between the rows of `x1` and `x2` ([..., N, d] and [..., M, d]). """
+    adjustment = tf.reduce_mean(x1, axis=-2, keepdims=True)
+    x1 = x1 - adjustment
+    x2 = x2 - adjustment
+    x1_norm = tf.reduce_sum(tf.square(x1), axis=-1, keepdims=True)
+    x2_norm = tf.reduce_sum(tf.square(x2), axis=-1, keepdims=True)
+    x1_ = tf.concat([-2.0 * x1, x1_norm, tf.ones_like(x1_norm)], axis=-1)
+    x2_ = tf.concat([x2, tf.ones_like(x2_norm), x2_norm], axis=-1)
+    return tf.sqrt(tf.maximum(tf.matmul(x1_, x2_, transpose_b=True), 1e-30))
+
+
+def masked_mean(values, weights=None):
+    """ Mean of `values` weighted by the broadcastable 0/1 `weights` (plain mean if None). """
+    if weights is None:
+        return tf.reduce_mean(values)
+    weights = tf.broadcast_to(weights, tf.shape(values))
+    return tf.reduce_sum(values * weights) / tf.reduce_sum(weights)
+
+
+def transport_loss(cost, d, rho, attention_mask=None, weights=None):
+    """
+    Alignment loss between keys (dim -2) and queries (dim -1) from the pairwise `cost` and the navigator logits `d`.
+    With the additive `attention_mask`, padding tokens get no transport mass; `weights` masks the padding rows out of
+    the averages. Mirrors `masked_transport_loss` in modeling_bert with static shapes.
+    """
+    if attention_mask is None:
+        m_backward = tf.nn.softmax(d, axis=-2)
+        m_forward = tf.nn.softmax(d, axis=-1)
+    else:
+        m_backward = tf.nn.softmax(d + tf.linalg.matrix_transpose(attention_mask), axis=-2)
+        m_forward = tf.nn.softmax(d + attention_mask, axis=-1)
+    backward_cost = masked_mean(tf.reduce_sum(cost * m_backward, axis=-2), weights)
+    forward_cost = masked_mean(tf.reduce_sum(cost * m_forward, axis=-1), weights)
+    return -((1 - rho) * backward_cost + rho * forward_cost)
+
 
 class TFBertEmbeddings(tf.keras.layers.Layer):
     """Construct the embeddings from word, position and token_type embeddings.
@@ -194,6 +262,9 @@ class TFBertEmbeddings(tf.keras.layers.Layer):
 
 
 class TFBertSelfAttention(tf.keras.layers.Layer):
+    # the token-level `combine` transport runs on critic features of the gradient-reversed keys/queries
+    combine_with_critics = True
+
     def __init__(self, config, **kwargs):
         super().__init__(**kwargs)
         if config.hidden_size % config.num_attention_heads != 0:
@@ -220,22 +291,195 @@ class TFBertSelfAttention(tf.keras.layers.Layer):
 
         self.dropout = tf.keras.layers.Dropout(config.attention_probs_dropout_prob)
 
+        # Variational attention and alignment losses, see BertSelfAttention in modeling_bert. Every branch below is
+        # picked from the config (and the `training` flag) when the layer is traced, so the computation has static
+        # shapes and no data-dependent control flow and can be compiled with XLA.
+        self.att_type = getattr(config, "att_type", "soft_attention")
+        self.adver_type = getattr(config, "adver_type", "none")
+        self.att_prior_type = getattr(config, "att_prior_type", "constant")
+        self.rho = getattr(config, "rho", 0.5)
+        self.output_kl = attention_kl_enabled(config)
+
+        if self.adver_type not in TF_ADVER_TYPES:
+            raise ValueError(
+                "adver_type={} is not supported by the TF 2.0 models, use one of {}".format(
+                    self.adver_type, ", ".join(TF_ADVER_TYPES)
+                )
+            )
+        if self.adver_type != "none" and self.att_prior_type != "contextual":
+            raise ValueError("adver_type={} needs att_prior_type='contextual'".format(self.adver_type))
+
+        if self.att_type == "soft_weibull":
+            self.k_weibull = float(config.k_weibull)
+            self.alpha_gamma = float(config.alpha_gamma)
+            self.beta_gamma = float(config.beta_gamma)
+        elif self.att_type == "soft_lognormal":
+            self.sigma_normal_prior = float(config.sigma_normal_prior)
+            self.sigma_normal_posterior = float(config.sigma_normal_posterior)
+
+        if self.att_prior_type == "contextual":
+            # same names as the PyTorch modules, so that checkpoints convert both ways
+            self.att_se_hid_size = config.att_se_hid_size
+            self.se_nonlinear = SE_NONLINEAR[config.att_se_nonlinear]
+            self.dropout_two = tf.keras.layers.Dropout(config.attention_probs_dropout_prob)
+            self.highway_act = self._se_dense(self.attention_head_size, config, "highway_act")
+            self.highway_act_two = self._se_dense(self.attention_head_size, config, "highway_act_two")
+            self.se_linear1 = self._se_dense(self.att_se_hid_size, config, "se_linear1")
+            self.se_linear2 = self._se_dense(1, config, "se_linear2")
+            for i in range(3, 11):
+                name = "se_linear{}".format(i)
+                setattr(self, name, self._se_dense(self.att_se_hid_size, config, name))
+        if self.adver_type == "talking_head":
+            # mix the heads of the attention scores, then of the probabilities
+            self.se_linear11 = self._se_dense(self.num_attention_heads, config, "se_linear11")
+            self.se_linear12 = self._se_dense(self.num_attention_heads, config, "se_linear12")
+
+    @staticmethod
+    def _se_dense(units, config, name):
+        return tf.keras.layers.Dense(units, kernel_initializer=get_initializer(config.initializer_range), name=name)
+
+    def build(self, input_shape):
+        if self.att_prior_type == "parameter" and self.att_type in ("soft_weibull", "soft_lognormal"):
+            # the learned scalar prior of the KL (alpha_gamma of soft_weibull, sigma_normal_prior of soft_lognormal),
+            # under the name of the PyTorch parameter so that it converts with the other weights
+            name = "alpha_gamma" if self.att_type == "soft_weibull" else "sigma_normal_prior"
+            initializer = tf.keras.initializers.Constant(getattr(self, name))
+            setattr(self, name, self.add_weight(name, shape=[1], initializer=initializer))
+        if self.att_prior_type == "contextual":
+            # The critics and navigators only run in training: build them with the layer so that their weights
+            # exist when loading or converting a checkpoint after an inference call.
+            head_size, hid_size = self.attention_head_size, self.att_se_hid_size
+            sizes = {"highway_act": head_size, "highway_act_two": head_size, "se_linear2": hid_size}
+            for i in (4, 6, 8, 10):
+                sizes["se_linear{}".format(i)] = hid_size
+            for i in (1, 3, 5, 7, 9):
+                sizes["se_linear{}".format(i)] = head_size
+            for name, size in sizes.items():
+                layer = getattr(self, name)
+                with tf.name_scope(layer.name):
+                    layer.build([None, size])
+        super().build(input_shape)
+
     def transpose_for_scores(self, x, batch_size):
         x = tf.reshape(x, (batch_size, -1, self.num_attention_heads, self.attention_head_size))
         return tf.transpose(x, perm=[0, 2, 1, 3])
 
-    def call(self, inputs, training=False):
-        hidden_states, attention_mask, head_mask = inputs
+    def _highway(self, highway_act, x):
+        highway = highway_act(x)
+        return tf.sigmoid(highway) * tf.nn.relu(highway) + (1.0 - tf.sigmoid(highway)) * x
 
-        batch_size = shape_list(hidden_states)[0]
-        mixed_query_layer = self.query(hidden_states)
-        mixed_key_layer = self.key(hidden_states)
-        mixed_value_layer = self.value(hidden_states)
+    @staticmethod
+    def _normalize(x, eps=1e-6):
+        return x / (tf.norm(x, axis=-1, keepdims=True) + eps)
 
-        query_layer = self.transpose_for_scores(mixed_query_layer, batch_size)
-        key_layer = self.transpose_for_scores(mixed_key_layer, batch_size)
-        value_layer = self.transpose_for_scores(mixed_value_layer, batch_size)
+    def discriminator_for(self, x, training=False):
+        pred = self._highway(self.highway_act, x)
+        return self.se_linear2(self.se_nonlinear(self.se_linear1(self.dropout(pred, training=training))))
+
+    def critic_for(self, x, training=False):
+        pred = self._highway(self.highway_act, x)
+        pred = self.se_linear4(self.se_nonlinear(self.se_linear3(self.dropout(pred, training=training))))
+        return self._normalize(pred)
+
+    def critic_for_two(self, x, training=False):
+        pred = self._highway(self.highway_act_two, x)
+        pred = self.se_linear8(self.se_nonlinear(self.se_linear7(self.dropout_two(pred, training=training))))
+        return self._normalize(pred)
+
+    def navigator_for(self, x):
+        return self._normalize(self.se_linear6(self.se_nonlinear(self.se_linear5(x))))
+
+    def navigator_for_two(self, x):
+        return self._normalize(self.se_linear10(self.se_nonlinear(self.se_linear9(x))))
+
+    def alignment_loss(self, query_layer, key_layer, attention_mask, training=False):
+        """
+        The gan/act/combine alignment term between the [B, H, L, d] keys and queries. Padding tokens are weighted out
+        of the averages (and get no transport mass) instead of being gathered away, to keep the shapes static.
+        """
+        token_mask = None
+        if attention_mask is not None:
+            token_mask = tf.cast(attention_mask[:, 0, 0, :] > -1.0, key_layer.dtype)  # [B, L]
+        # per-token layout [B, L, H, d] for the losses between the heads of a token
+        key_tokens = tf.transpose(key_layer, perm=[0, 2, 1, 3])
+        query_tokens = tf.transpose(query_layer, perm=[0, 2, 1, 3])
+
+        if self.adver_type == "gan":
+            real_out = self.discriminator_for(grad_reverse(key_tokens), training=training)
+            fake_out = self.discriminator_for(tf.stop_gradient(query_tokens), training=training)
+            d_loss = tf.nn.sigmoid_cross_entropy_with_logits(
+                labels=tf.ones_like(real_out), logits=real_out
+            ) + tf.nn.sigmoid_cross_entropy_with_logits(labels=tf.zeros_like(fake_out), logits=fake_out)
+            return masked_mean(d_loss, None if token_mask is None else token_mask[:, :, None, None])
+
+        head_weights = None if token_mask is None else token_mask[:, :, None]
+        if self.adver_type == "act":
+            key_reverse = grad_reverse(key_tokens)
+            query_reverse = grad_reverse(query_tokens)
+            cost = fast_cdist(self.critic_for(key_reverse, training), self.critic_for(query_reverse, training))
+            d = tf.matmul(self.navigator_for(key_reverse), self.navigator_for(query_reverse), transpose_b=True)
+            return transport_loss(cost, d, self.rho, weights=head_weights)
+
+        # combine: transport between the tokens of each sequence and between the heads of each token
+        if self.combine_with_critics:
+            key_layer, query_layer = grad_reverse(key_layer), grad_reverse(query_layer)
+            key_tokens, query_tokens = grad_reverse(key_tokens), grad_reverse(query_tokens)
+            cost = fast_cdist(self.critic_for(key_layer, training), self.critic_for(query_layer, training))
+            cost_head = fast_cdist(
+                self.critic_for_two(key_tokens, training), self.critic_for_two(query_tokens, training)
+            )
+        else:
+            cost = fast_cdist(key_layer, query_layer)
+            cost_head = fast_cdist(key_tokens, query_tokens)
+        d = tf.matmul(self.navigator_for(key_layer), self.navigator_for(query_layer), transpose_b=True)
+        d_head = tf.matmul(self.navigator_for_two(key_tokens), self.navigator_for_two(query_tokens), transpose_b=True)
+        err = transport_loss(
+            cost, d, self.rho, attention_mask, None if token_mask is None else token_mask[:, tf.newaxis, :]
+        )
+        err_head = transport_loss(cost_head, d_head, self.rho, weights=head_weights)
+        return err + err_head
+
+    def contextual_prior(self, key_layer, attention_mask):
+        """ [B, H, 1, L] prior attention weights predicted from the keys. """
+        dot = self.se_linear2(self.se_nonlinear(self.se_linear1(key_layer)))
+        dot = tf.linalg.matrix_transpose(dot)
+        if attention_mask is not None:
+            dot = dot + attention_mask
+        return tf.nn.softmax(dot, axis=-1)
+
+    def sample_attention(self, logprobs, prior_weights=None, eps=1e-20):
+        """ Reparameterized soft_weibull/soft_lognormal attention sample and its mean KL to the prior. """
+        if self.att_type == "soft_weibull":
+            alpha_gamma = self.alpha_gamma if prior_weights is None else prior_weights * self.beta_gamma
+            lgamma_k = math.lgamma(1 + 1.0 / self.k_weibull)
+            u_weibull = tf.random.uniform(tf.shape(logprobs), dtype=logprobs.dtype)
+            gumbel = tf.math.log(-tf.math.log(1.0 - u_weibull + eps) + eps)
+            out_weight = tf.nn.softmax(logprobs - lgamma_k + gumbel / self.k_weibull, axis=-1)
+            kl = -(
+                alpha_gamma * (logprobs - lgamma_k)
+                - np.euler_gamma * alpha_gamma / self.k_weibull
+                - self.beta_gamma * tf.exp(logprobs)
+                + alpha_gamma * math.log(self.beta_gamma + eps)
+                - tf.math.lgamma(alpha_gamma + eps)
+            )
+        else:
+            mean_normal_prior = 0.0 if prior_weights is None else tf.math.log(prior_weights + eps)
+            sigma_prior, sigma_posterior = self.sigma_normal_prior, self.sigma_normal_posterior
+            mean_normal_posterior = logprobs - sigma_posterior ** 2 / 2
+            noise = tf.random.normal(tf.shape(logprobs), dtype=logprobs.dtype)
+            out_weight = tf.nn.softmax(mean_normal_posterior + sigma_posterior * noise, axis=-1)
+            kl = (
+                tf.math.log(sigma_prior / sigma_posterior + eps)
+                + (sigma_posterior ** 2 + (mean_normal_posterior - mean_normal_prior) ** 2) / (2 * sigma_prior ** 2)
+                - 0.5
+            )
+        return out_weight, tf.reduce_mean(kl)
 
+    def attention_weights(self, query_layer, key_layer, attention_mask, training=False):
+        """
+        Attention weights applied to the values, before dropout, and the KL/alignment term of the layer (None outside
+        of training or when the config enables neither).
+        """
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = tf.matmul(
             query_layer, key_layer, transpose_b=True
@@ -249,6 +493,42 @@ class TFBertSelfAttention(tf.keras.layers.Layer):
 
         # Normalize the attention scores to probabilities.
         attention_probs = tf.nn.softmax(attention_scores, axis=-1)
+        if self.adver_type == "talking_head":
+            # the Dense layers mix the heads, moved to the last axis: [B, L, L, H]
+            mixed_scores = self.se_linear11(tf.transpose(attention_scores, perm=[0, 2, 3, 1]))
+            mixed_probs = tf.nn.softmax(tf.transpose(mixed_scores, perm=[0, 3, 1, 2]), axis=-1)
+            mixed_probs = self.se_linear12(tf.transpose(mixed_probs, perm=[0, 2, 3, 1]))
+            attention_probs = tf.transpose(mixed_probs, perm=[0, 3, 1, 2])
+        if not training:
+            return attention_probs, None
+
+        kl = None
+        if self.adver_type in ALIGNMENT_TYPES:
+            kl = self.alignment_loss(query_layer, key_layer, attention_mask, training=training)
+        if self.att_type in ("soft_weibull", "soft_lognormal"):
+            eps = 1e-20
+            # equal to log(attention_probs + eps); the clamp only bounds the masked positions
+            logprobs = tf.maximum(tf.nn.log_softmax(attention_scores, axis=-1), math.log(eps))
+            prior_weights = None
+            if self.att_prior_type == "contextual":
+                prior_weights = self.contextual_prior(key_layer, attention_mask)
+            # as in PyTorch, the sampling KL replaces the alignment term
+            attention_probs, kl = self.sample_attention(logprobs, prior_weights, eps)
+        return attention_probs, kl
+
+    def call(self, inputs, training=False):
+        hidden_states, attention_mask, head_mask = inputs
+
+        batch_size = shape_list(hidden_states)[0]
+        mixed_query_layer = self.query(hidden_states)
+        mixed_key_layer = self.key(hidden_states)
+        mixed_value_layer = self.value(hidden_states)
+
+        query_layer = self.transpose_for_scores(mixed_query_layer, batch_size)
+        key_layer = self.transpose_for_scores(mixed_key_layer, batch_size)
+        value_layer = self.transpose_for_scores(mixed_value_layer, batch_size)
+
+        attention_probs, kl = self.attention_weights(query_layer, key_layer, attention_mask, training=training)
 
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
@@ -266,7 +546,9 @@ class TFBertSelfAttention(tf.keras.layers.Layer):
         )  # (batch_size, seq_len_q, all_head_size)
 
         outputs = (context_layer, attention_probs) if self.output_attentions else (context_layer,)
-        return outputs
+        if self.output_kl and training:
+            outputs = outputs + (kl,)
+        return outputs  # context, (attentions), (kl)
 
 
 class TFBertSelfOutput(tf.keras.layers.Layer):
@@ -363,6 +645,7 @@ class TFBertEncoder(tf.keras.layers.Layer):
         super().__init__(**kwargs)
         self.output_attentions = config.output_attentions
         self.output_hidden_states = config.output_hidden_states
+        self.output_kl = attention_kl_enabled(config)
         self.layer = [TFBertLayer(config, name="layer_._{}".format(i)) for i in range(config.num_hidden_layers)]
 
     def call(self, inputs, training=False):
@@ -370,6 +653,7 @@ class TFBertEncoder(tf.keras.layers.Layer):
 
         all_hidden_states = ()
         all_attentions = ()
+        all_kl = ()
         for i, layer_module in enumerate(self.layer):
             if self.output_hidden_states:
                 all_hidden_states = all_hidden_states + (hidden_states,)
@@ -379,6 +663,8 @@ class TFBertEncoder(tf.keras.layers.Layer):
 
             if self.output_attentions:
                 all_attentions = all_attentions + (layer_outputs[1],)
+            if self.output_kl and training:
+                all_kl = all_kl + (layer_outputs[-1],)
 
         # Add last layer
         if self.output_hidden_states:
@@ -389,7 +675,10 @@ class TFBertEncoder(tf.keras.layers.Layer):
             outputs = outputs + (all_hidden_states,)
         if self.output_attentions:
             outputs = outputs + (all_attentions,)
-        return outputs  # outputs, (hidden states), (attentions)
+        if all_kl:
+            # mean KL/alignment term over the layers, as in BertModel
+            outputs = outputs + (tf.add_n(list(all_kl)) / len(all_kl),)
+        return outputs  # outputs, (hidden states), (attentions), (kl)
 
 
 class TFBertPooler(tf.keras.layers.Layer):
@@ -576,7 +865,7 @@ class TFBertMainLayer(tf.keras.layers.Layer):
         outputs = (sequence_output, pooled_output,) + encoder_outputs[
             1:
         ]  # add hidden_states and attentions if they are here
-        return outputs  # sequence_output, pooled_output, (hidden_states), (attentions)
+        return outputs  # sequence_output, pooled_output, (hidden_states), (attentions), (kl)
 
 
 class TFBertPreTrainedModel(TFPreTrainedModel):
@@ -905,6 +1194,8 @@ class TFBertForSequenceClassification(TFBertPreTrainedModel):
             :obj:`(batch_size, num_heads, sequence_length, sequence_length)`:
 
             Attentions weights after the attention softmax, used to compute the weighted average in the self-attention heads.
+        kl (:obj:`tf.Tensor` of shape :obj:`()`, `optional`, returned with ``training=True`` when ``config.att_type`` is a variational attention or ``config.adver_type`` an alignment loss):
+            KL (or alignment) term of the attention layers, averaged over the layers.
 
     Examples::
 
@@ -927,7 +1218,7 @@ class TFBertForSequenceClassification(TFBertPreTrainedModel):
 
         outputs = (logits,) + outputs[2:]  # add hidden states and attention if they are here
 
-        return outputs  # logits, (hidden_states), (attentions)
+        return outputs  # logits, (hidden_states), (attentions), (kl)
 
 
 @add_start_docstrings(
@@ -619,6 +619,12 @@ class PreTrainedModel(nn.Module, ModuleUtilsMixin):
         # Instantiate model.
         model = cls(config, *model_args, **model_kwargs)
 
+        # int8 checkpoints: swap in the quantized linear layers before loading their weights
+        if getattr(config, "quantized_modules", None):
+            from .modeling_export import quantize_dynamic
+
+            model = quantize_dynamic(model, config.quantized_modules, inplace=True)
+
         if state_dict is None and not from_tf:
             try:
                 state_dict = torch.load(resolved_archive_file, map_location="cpu")
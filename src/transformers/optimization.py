@@ -102,9 +102,23 @@ class AdamW(Optimizer):
         eps (float): Adams epsilon. Default: 1e-6
         weight_decay (float): Weight decay. Default: 0.0
         correct_bias (bool): can be set to False to avoid correcting bias in Adam (e.g. like in Bert TF repository). Default True.
+        foreach (bool): update the parameters of every group (with the same device and dtype) with multi-tensor
+            ops, i.e. a few ops per group instead of per parameter, with the same results. Default False.
+        max_grad_norm (float): if set, ``step`` first clips the gradients of all the parameters to this global
+            norm, like ``torch.nn.utils.clip_grad_norm_``, with multi-tensor ops if ``foreach``. Default None.
     """
 
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-6, weight_decay=0.0, correct_bias=True):
+    def __init__(
+        self,
+        params,
+        lr=1e-3,
+        betas=(0.9, 0.999),
+        eps=1e-6,
+        weight_decay=0.0,
+        correct_bias=True,
+        foreach=False,
+        max_grad_norm=None,
+    ):
         if lr < 0.0:
             raise ValueError("Invalid learning rate: {} - should be >= 0.0".format(lr))
         if not 0.0 <= betas[0] < 1.0:
@@ -113,8 +127,13 @@ class AdamW(Optimizer):
             raise ValueError("Invalid beta parameter: {} - should be in [0.0, 1.0[".format(betas[1]))
         if not 0.0 <= eps:
             raise ValueError("Invalid epsilon value: {} - should be >= 0.0".format(eps))
+        if foreach and not hasattr(torch, "_foreach_addcdiv_"):
+            logger.warning("This version of PyTorch has no multi-tensor ops, AdamW updates the parameters one by one")
+            foreach = False
         defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, correct_bias=correct_bias)
         super().__init__(params, defaults)
+        self.foreach = foreach
+        self.max_grad_norm = max_grad_norm
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -127,12 +146,15 @@ class AdamW(Optimizer):
         if closure is not None:
             loss = closure()
 
+        if self.max_grad_norm is not None:
+            self._clip_grad_norm()
+
         for group in self.param_groups:
+            params = []
             for p in group["params"]:
                 if p.grad is None:
                     continue
-                grad = p.grad.data
-                if grad.is_sparse:
+                if p.grad.is_sparse:
                     raise RuntimeError("Adam does not support sparse gradients, please consider SparseAdam instead")
 
                 state = self.state[p]
@@ -145,34 +167,92 @@ class AdamW(Optimizer):
                     # Exponential moving average of squared gradient values
                     state["exp_avg_sq"] = torch.zeros_like(p.data)
 
-                exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
-                beta1, beta2 = group["betas"]
-
                 state["step"] += 1
+                params.append(p)
 
-                # Decay the first and second moment running average coefficient
-                # In-place operations to update the averages at the same time
-                exp_avg.mul_(beta1).add_(1.0 - beta1, grad)
-                exp_avg_sq.mul_(beta2).addcmul_(1.0 - beta2, grad, grad)
-                denom = exp_avg_sq.sqrt().add_(group["eps"])
-
-                step_size = group["lr"]
-                if group["correct_bias"]:  # No bias correction for Bert
-                    bias_correction1 = 1.0 - beta1 ** state["step"]
-                    bias_correction2 = 1.0 - beta2 ** state["step"]
-                    step_size = step_size * math.sqrt(bias_correction2) / bias_correction1
-
-                p.data.addcdiv_(-step_size, exp_avg, denom)
-
-                # Just adding the square of the weights to the loss function is *not*
-                # the correct way of using L2 regularization/weight decay with Adam,
-                # since that will interact with the m and v parameters in strange ways.
-                #
-                # Instead we want to decay the weights in a manner that doesn't interact
-                # with the m/v parameters. This is equivalent to adding the square
-                # of the weights to the loss with plain (non-momentum) SGD.
-                # Add weight decay at the end (fixed version)
-                if group["weight_decay"] > 0.0:
-                    p.data.add_(-group["lr"] * group["weight_decay"], p.data)
+            if self.foreach:
+                for same_device_params in _group_by_device_and_dtype(params):
+                    self._foreach_update(group, same_device_params)
+            else:
+                for p in params:
+                    self._update(group, p)
 
         return loss
+
+    def _step_size(self, group, step):
+        step_size = group["lr"]
+        if group["correct_bias"]:  # No bias correction for Bert
+            beta1, beta2 = group["betas"]
+            bias_correction1 = 1.0 - beta1 ** step
+            bias_correction2 = 1.0 - beta2 ** step
+            step_size = step_size * math.sqrt(bias_correction2) / bias_correction1
+        return step_size
+
+    def _update(self, group, p):
+        grad = p.grad.data
+        state = self.state[p]
+        exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+        beta1, beta2 = group["betas"]
+
+        # Decay the first and second moment running average coefficient
+        # In-place operations to update the averages at the same time
+        exp_avg.mul_(beta1).add_(grad, alpha=1.0 - beta1)
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1.0 - beta2)
+        denom = exp_avg_sq.sqrt().add_(group["eps"])
+
+        p.data.addcdiv_(exp_avg, denom, value=-self._step_size(group, state["step"]))
+
+        # Just adding the square of the weights to the loss function is *not*
+        # the correct way of using L2 regularization/weight decay with Adam,
+        # since that will interact with the m and v parameters in strange ways.
+        #
+        # Instead we want to decay the weights in a manner that doesn't interact
+        # with the m/v parameters. This is equivalent to adding the square
+        # of the weights to the loss with plain (non-momentum) SGD.
+        # Add weight decay at the end (fixed version)
+        if group["weight_decay"] > 0.0:
+            p.data.add_(p.data, alpha=-group["lr"] * group["weight_decay"])
+
+    def _foreach_update(self, group, params):
+        # same ops as _update, each on the list of parameters
+        data = [p.data for p in params]
+        grads = [p.grad.data for p in params]
+        exp_avgs = [self.state[p]["exp_avg"] for p in params]
+        exp_avg_sqs = [self.state[p]["exp_avg_sq"] for p in params]
+        beta1, beta2 = group["betas"]
+
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1.0 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1.0 - beta2)
+        denoms = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_add_(denoms, group["eps"])
+
+        step_sizes = [-self._step_size(group, self.state[p]["step"]) for p in params]
+        torch._foreach_addcdiv_(data, exp_avgs, denoms, step_sizes)
+
+        if group["weight_decay"] > 0.0:
+            torch._foreach_add_(data, data, alpha=-group["lr"] * group["weight_decay"])
+
+    def _clip_grad_norm(self):
+        params = [p for group in self.param_groups for p in group["params"] if p.grad is not None]
+        if not self.foreach:
+            torch.nn.utils.clip_grad_norm_(params, self.max_grad_norm)
+            return
+        # the norm of the per-tensor norms, then a single multiplication per group of tensors
+        grad_groups = [[p.grad.data for p in group] for group in _group_by_device_and_dtype(params)]
+        if not grad_groups:
+            return
+        device = grad_groups[0][0].device
+        norms = [norm.to(device) for grads in grad_groups for norm in torch._foreach_norm(grads)]
+        total_norm = torch.linalg.vector_norm(torch.stack(norms))
+        clip_coef = torch.clamp(self.max_grad_norm / (total_norm + 1e-6), max=1.0)
+        for grads in grad_groups:
+            torch._foreach_mul_(grads, clip_coef.to(grads[0].device))
+
+
+def _group_by_device_and_dtype(params):
+    groups = {}
+    for p in params:
+        groups.setdefault((p.device, p.dtype), []).append(p)
+    return list(groups.values())
@@ -1,23 +1,39 @@
+import copy
+import dataclasses
+import itertools
 import json
 import logging
 import os
 import random
 import re
 import shutil
+import threading
+import time
+import traceback
 from contextlib import contextmanager
 from pathlib import Path
+from queue import Empty, Queue
 from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 
 import numpy as np
 import torch
 from torch import nn
 from torch.utils.data.dataloader import DataLoader
-from torch.utils.data.dataset import Dataset
+from torch.utils.data.dataset import Dataset, Subset
 from torch.utils.data.distributed import DistributedSampler
-from torch.utils.data.sampler import RandomSampler
+from torch.utils.data.sampler import BatchSampler, RandomSampler
 from tqdm.auto import tqdm, trange
 
-from .data.data_collator import DataCollator, DefaultDataCollator
+from .attention_store import AttentionRecorder
+from .data.data_collator import (
+    DataCollator,
+    DataCollatorForFrozenActivations,
+    DataCollatorWithPadding,
+    DefaultDataCollator,
+)
+from .data.frozen_activations import FrozenActivationDataset
+from .data.grouped_batch_sampler import GroupedBatchSampler, create_lengths_groups
+from .file_utils import WEIGHTS_NAME
 from .modeling_utils import PreTrainedModel
 from .optimization import AdamW, get_linear_schedule_with_warmup
 from .training_args import TrainingArguments
@@ -97,6 +113,450 @@ class EvalPrediction(NamedTuple):
     label_ids: np.ndarray
 
 
+class StreamingMetrics:
+    """
+    Base class for a ``compute_metrics`` accumulated over the evaluation batches, so that the trainer does not need
+    to keep all the predictions: :meth:`update` is called with the :class:`EvalPrediction` of every batch (after a
+    :meth:`reset`) and :meth:`compute` returns the metrics. It can also be called like a plain ``compute_metrics``.
+    """
+
+    def reset(self):
+        raise NotImplementedError
+
+    def update(self, p: EvalPrediction):
+        raise NotImplementedError
+
+    def compute(self) -> Dict:
+        raise NotImplementedError
+
+    def __call__(self, p: EvalPrediction) -> Dict:
+        self.reset()
+        self.update(p)
+        return self.compute()
+
+
+class PredictionBuffer:
+    """
+    Output array of the prediction loop, preallocated for ``num_examples`` rows when the first batch gives its
+    trailing shape and dtype, in RAM or in a memory-mapped ``.npy`` file at ``path``. In RAM, it grows geometrically
+    if the batches hold more examples than announced.
+    """
+
+    def __init__(self, num_examples: int, path: Optional[str] = None):
+        self.num_examples = num_examples
+        self.path = path
+        self.array: Optional[np.ndarray] = None
+        self.size = 0
+
+    def add(self, batch: np.ndarray):
+        if self.array is None:
+            shape = (max(self.num_examples, len(batch)),) + batch.shape[1:]
+            if self.path is None:
+                self.array = np.empty(shape, dtype=batch.dtype)
+            else:
+                self.array = np.lib.format.open_memmap(self.path, mode="w+", dtype=batch.dtype, shape=shape)
+        elif self.size + len(batch) > len(self.array):
+            if self.path is not None:
+                raise ValueError("More predictions than the {} examples of {}".format(len(self.array), self.path))
+            size = max(2 * len(self.array), self.size + len(batch))
+            array = np.empty((size,) + self.array.shape[1:], dtype=self.array.dtype)
+            array[: self.size] = self.array[: self.size]
+            self.array = array
+        self.array[self.size : self.size + len(batch)] = batch
+        self.size += len(batch)
+
+    def result(self) -> Optional[np.ndarray]:
+        if self.array is None:
+            return None
+        if isinstance(self.array, np.memmap):
+            self.array.flush()
+        return self.array[: self.size]
+
+
+class BackgroundPrefetcher:
+    """
+    Iterates over a DataLoader from a background thread, which collates the next ``depth`` batches and copies them to
+    ``device`` (on a side CUDA stream) while the current step runs on the main thread.
+    """
+
+    _END = object()
+
+    def __init__(self, dataloader: DataLoader, device: torch.device, depth: int = 2):
+        self.dataloader = dataloader
+        self.device = device
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _produce(self, queue: Queue, stop: threading.Event):
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        try:
+            for batch in self.dataloader:
+                if stop.is_set():
+                    return
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+                    stream.synchronize()
+                else:
+                    batch = {k: v.to(self.device) for k, v in batch.items()}
+                queue.put(batch)
+            queue.put(self._END)
+        except Exception as e:
+            queue.put(e)
+
+    def __iter__(self):
+        queue = Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(queue, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = queue.get()
+                if batch is self._END:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                if self.device.type == "cuda":
+                    # the batch was allocated on the side stream and is used on the current one
+                    for v in batch.values():
+                        v.record_stream(torch.cuda.current_stream(self.device))
+                yield batch
+        finally:
+            stop.set()
+            # unblock a producer waiting on a full queue
+            while thread.is_alive():
+                while not queue.empty():
+                    queue.get()
+                thread.join(timeout=0.1)
+
+
+class ResumableBatchSampler(BatchSampler):
+    """
+    Batch sampler of the training DataLoader, which can resume an epoch from a checkpoint. ``set_epoch`` is called at
+    the start of every epoch and records ``epoch_rng_state``, the state of the random sampler's generator. After
+    ``resume(rng_state, num_batches)``, the next epoch restores it and skips its first ``num_batches`` batches by only
+    drawing their indices, without loading nor collating them.
+    """
+
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.sampler = batch_sampler.sampler
+        self.generator = getattr(self.sampler, "generator", None)
+        self.epoch_rng_state = None
+        self.resume_state = None
+        self.skip_batches = 0
+
+    def resume(self, rng_state: Optional[torch.Tensor], num_batches: int):
+        self.resume_state = (rng_state, num_batches)
+
+    def set_epoch(self, epoch: int):
+        # a DistributedSampler shuffles with its seed and the epoch
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+        rng_state, self.skip_batches = self.resume_state or (None, 0)
+        self.resume_state = None
+        if self.generator is not None:
+            if rng_state is not None:
+                self.generator.set_state(rng_state)
+            self.epoch_rng_state = self.generator.get_state()
+
+    def __iter__(self):
+        # no state change here: a DataLoader iterator may call iter() more than once before drawing any batch
+        return itertools.islice(iter(self.batch_sampler), self.skip_batches, None)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+def _to_cpu(obj):
+    """ Copy of a (nested dict/list/tuple of) state in CPU memory, sharing no tensor with the original. """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes the checkpoints of ``Trainer.train`` from a background thread. ``save`` only snapshots the model,
+    optimizer, scheduler (and sampler) states to CPU memory; the thread writes them into a temporary dir, renamed to
+    the checkpoint dir once complete (so an interrupted save never leaves a partial checkpoint), then calls ``rotate``.
+    At most one save is in flight: ``save`` first waits for the previous one.
+    """
+
+    def __init__(self, rotate: Callable[[], None]):
+        self.rotate = rotate
+        self.queue = Queue()
+        self.exception = None
+        self.thread = threading.Thread(target=self._consume, daemon=True)
+        self.thread.start()
+
+    def save(
+        self,
+        output_dir: str,
+        model: PreTrainedModel,
+        optimizer,
+        scheduler,
+        args: TrainingArguments,
+        sampler_state: Optional[Dict] = None,
+    ):
+        self.wait()
+        config = copy.deepcopy(model.config)
+        config.architectures = [model.__class__.__name__]
+        files = {
+            WEIGHTS_NAME: _to_cpu(model.state_dict()),
+            "training_args.bin": args,
+            "optimizer.pt": _to_cpu(optimizer.state_dict()),
+            "scheduler.pt": _to_cpu(scheduler.state_dict()),
+        }
+        if sampler_state is not None:
+            files["sampler.pt"] = _to_cpu(sampler_state)
+        self.queue.put((output_dir, config, files))
+
+    def wait(self):
+        """ Blocks until the pending save is written, and raises its exception if it failed. """
+        self.queue.join()
+        if self.exception is not None:
+            exception, self.exception = self.exception, None
+            raise exception
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _consume(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self.exception = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, output_dir: str, config, files: Dict):
+        # not matched by Trainer._sorted_checkpoints
+        tmp_dir = os.path.join(os.path.dirname(output_dir), ".tmp-" + os.path.basename(output_dir))
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        config.save_pretrained(tmp_dir)
+        for name, obj in files.items():
+            torch.save(obj, os.path.join(tmp_dir, name))
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        os.rename(tmp_dir, output_dir)
+        logger.info("Saving model checkpoint, optimizer and scheduler states to %s", output_dir)
+        self.rotate()
+
+
+def _stratified_subsample(dataset: Dataset, size: int, seed: int) -> List[int]:
+    """
+    Indices of ``size`` examples of ``dataset`` with the proportions of its labels: the examples are sorted by label
+    (in random order within a label) and one is drawn from each of ``size`` equal slices.
+    """
+    if size >= len(dataset):
+        return list(range(len(dataset)))
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(len(dataset))
+    labels = [getattr(dataset[i], "label", None) for i in order]
+    if None not in labels:
+        order = order[np.argsort(labels, kind="stable")]
+    return sorted(int(rng.choice(stratum)) for stratum in np.array_split(order, size))
+
+
+class AsyncEvaluator:
+    """
+    Runs ``Trainer.evaluate`` in a worker process, forked with a CPU copy of the model, on the snapshots of the
+    weights sent by ``submit``, so that the training loop does not wait for the evaluations. ``results`` returns the
+    metrics of the evaluations finished since its last call, with the step they were submitted at.
+    """
+
+    def __init__(self, trainer: "Trainer"):
+        if torch.cuda.is_initialized():
+            raise RuntimeError(
+                "async_evaluation forks its worker, which cannot inherit the CUDA context initialized in this process: "
+                "start the training before anything runs on the GPU (e.g. not under distributed training on GPUs), or "
+                "evaluate synchronously"
+            )
+        context = torch.multiprocessing.get_context("fork")
+        self.requests, self.responses = context.Queue(), context.Queue()
+        self.pending = 0
+        model = copy.deepcopy(trainer.model).cpu()
+        self.process = context.Process(
+            target=self._work, args=(trainer, model, self.requests, self.responses), daemon=True
+        )
+        self.process.start()
+
+    @staticmethod
+    def _work(trainer: "Trainer", model: PreTrainedModel, requests, responses):
+        # the trainer is the worker's copy, without the threads of the training process (e.g. of its SummaryWriter),
+        # which are not forked
+        trainer.model = model
+        trainer.tb_writer = None
+        trainer.args = dataclasses.replace(
+            trainer.args,
+            no_cuda=True,
+            local_rank=-1,
+            dataloader_num_workers=0,
+            dataloader_persistent_workers=False,
+            background_prefetch_batches=0,
+            predictions_memmap_dir=None,
+        )
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            step, prefix, state_dict, indices = request
+            try:
+                model.load_state_dict(state_dict)
+                eval_dataset = trainer.eval_dataset if indices is None else Subset(trainer.eval_dataset, indices)
+                metrics = {key: float(value) for key, value in trainer.evaluate(eval_dataset).items()}
+                responses.put((step, prefix, metrics))
+            except Exception:
+                responses.put((step, prefix, RuntimeError("Evaluation failed:\n" + traceback.format_exc())))
+
+    def submit(self, step: int, prefix: str, model: PreTrainedModel, indices: Optional[List[int]] = None):
+        """ Evaluates the current weights of ``model`` on the eval dataset, or on its ``indices``. """
+        self.requests.put((step, prefix, _to_cpu(model.state_dict()), indices))
+        self.pending += 1
+
+    def results(self, wait: bool = False) -> Dict[str, float]:
+        logs = {}
+        while self.pending > 0:
+            try:
+                step, prefix, metrics = self.responses.get(block=wait)
+            except Empty:
+                break
+            self.pending -= 1
+            if isinstance(metrics, Exception):
+                raise metrics
+            logs.update((prefix + key, value) for key, value in metrics.items())
+            logs[prefix + "step"] = step
+        return logs
+
+    def close(self) -> Dict[str, float]:
+        """ Waits for the pending evaluations and stops the worker, returns their metrics. """
+        logs = self.results(wait=True)
+        self.requests.put(None)
+        self.process.join()
+        return logs
+
+
+class StepTimer:
+    """
+    Wall-clock time of the phases of the training steps, and number of samples and (non-padding) tokens trained on,
+    since the last logging step. The training loop calls ``lap(phase)`` at the end of every phase: data loading,
+    host-to-device copy, forward, backward, gradient clipping and optimizer step and the rest (scheduler, logging,
+    checkpointing). The time the attention layers spend on the alignment (the whole adversarial/transport branch, with
+    its critics, navigators, token packing, transport maps and costs) and on the contextual priors is split from the
+    forward of the model: the layers call :meth:`start_alignment` and :meth:`stop_alignment` around it.
+
+    On GPU, the device is synchronized at every lap and around the alignment computations, so that the kernels are
+    timed in their own phase: this slows the training down.
+    """
+
+    PHASES = ("data", "h2d", "forward_task", "forward_alignment", "backward", "optimizer", "other")
+
+    def __init__(self, device: torch.device):
+        self.synchronize = device.type == "cuda"
+        self.layers = []
+        self._alignment_depth, self._alignment_start, self._alignment_seconds = 0, 0.0, 0.0
+        self.reset()
+
+    def attach(self, model: nn.Module) -> "StepTimer":
+        from .modeling_bert import BertSelfAttention
+
+        self.layers = [module for module in model.modules() if isinstance(module, BertSelfAttention)]
+        for module in self.layers:
+            module.alignment_timer = self
+        return self
+
+    def close(self):
+        for module in self.layers:
+            module.alignment_timer = None
+        self.layers = []
+
+    def reset(self):
+        self.seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.steps, self.samples, self.tokens = 0, 0, 0
+        self.last = self.start = self._now()
+
+    def _now(self) -> float:
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def start_alignment(self):
+        if self._alignment_depth == 0:
+            self._alignment_start = self._now()
+        self._alignment_depth += 1
+
+    def stop_alignment(self):
+        self._alignment_depth -= 1
+        if self._alignment_depth == 0:
+            self._alignment_seconds += self._now() - self._alignment_start
+
+    def count(self, inputs: Dict[str, torch.Tensor]):
+        """ Counts the samples and tokens of a (CPU) batch. """
+        input_ids = inputs["input_ids"] if "input_ids" in inputs else inputs["frozen_hidden_states"][..., 0]
+        self.samples += input_ids.size(0)
+        attention_mask = inputs.get("attention_mask")
+        self.tokens += int(attention_mask.sum()) if attention_mask is not None else input_ids.numel()
+
+    def lap(self, phase: str):
+        now = self._now()
+        seconds = now - self.last
+        if phase == "forward":
+            self.seconds["forward_alignment"] += self._alignment_seconds
+            self.seconds["forward_task"] += seconds - self._alignment_seconds
+        else:
+            self.seconds[phase] += seconds
+            if phase == "optimizer":
+                self.steps += 1
+        self._alignment_seconds = 0.0
+        self.last = now
+
+    def logs(self) -> Dict[str, float]:
+        """ Mean seconds of every phase per optimizer step and throughput since the last reset, then resets. """
+        elapsed = self._now() - self.start
+        logs = {"step_seconds_" + phase: seconds / max(self.steps, 1) for phase, seconds in self.seconds.items()}
+        logs["samples_per_second"] = self.samples / elapsed
+        logs["tokens_per_second"] = self.tokens / elapsed
+        self.reset()
+        return logs
+
+
+class AllReduceCounter:
+    """
+    Number of all-reduce calls and of all-reduced bytes of the gradient buckets of a DistributedDataParallel model.
+    Set as ``Trainer.allreduce_counter`` before training, it is registered as the communication hook of the model:
+    the buckets are all-reduced and averaged as by the default hook, and counted.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+
+    @staticmethod
+    def hook(counter, bucket):
+        # not annotated: DistributedDataParallel rejects the annotations other than its own types
+        from torch.distributed.algorithms.ddp_comm_hooks.default_hooks import allreduce_hook
+
+        buffer = bucket.buffer()
+        counter.calls += 1
+        counter.bytes += buffer.numel() * buffer.element_size()
+        return allreduce_hook(None, bucket)
+
+
 class PredictionOutput(NamedTuple):
     predictions: np.ndarray
     label_ids: Optional[np.ndarray]
@@ -109,6 +569,8 @@ class TrainOutput(NamedTuple):
 
 
 PREFIX_CHECKPOINT_DIR = "checkpoint"
+# the losses returned by Trainer._training_step, in that order
+LOGGED_LOSSES = ("loss", "task_loss", "alignment_loss")
 
 
 class Trainer:
@@ -125,6 +587,12 @@ class Trainer:
     compute_metrics: Optional[Callable[[EvalPrediction], Dict]] = None
     prediction_loss_only: bool
     tb_writer: Optional["SummaryWriter"] = None
+    # set by train with --step_timing
+    _step_timer: Optional[StepTimer] = None
+    # built by get_train_dataloader for models with config.frozen_layers
+    _frozen_train_dataset: Optional[FrozenActivationDataset] = None
+    # counts the all-reduces of the gradients in distributed training, when set before train
+    allreduce_counter: Optional[AllReduceCounter] = None
 
     def __init__(
         self,
@@ -149,6 +617,8 @@ class Trainer:
         self.args = args
         if data_collator is not None:
             self.data_collator = data_collator
+        elif self.args.dynamic_padding:
+            self.data_collator = DataCollatorWithPadding(pad_token_id=model.config.pad_token_id or 0)
         else:
             self.data_collator = DefaultDataCollator()
         self.train_dataset = train_dataset
@@ -175,17 +645,57 @@ class Trainer:
     def get_train_dataloader(self) -> DataLoader:
         if self.train_dataset is None:
             raise ValueError("Trainer: training requires a train_dataset.")
-        train_sampler = (
-            RandomSampler(self.train_dataset) if self.args.local_rank == -1 else DistributedSampler(self.train_dataset)
-        )
+        if self.args.local_rank == -1:
+            # own generator, whose state is saved with the checkpoints
+            generator = torch.Generator()
+            generator.manual_seed(self.args.seed)
+            train_sampler = RandomSampler(self.train_dataset, generator=generator)
+        else:
+            train_sampler = DistributedSampler(self.train_dataset, seed=self.args.seed)
+        if self.args.dynamic_padding:
+            # batches of similar lengths, so that little of them is padding
+            lengths = [len(feature.input_ids) for feature in self.train_dataset]
+            groups = create_lengths_groups(lengths, k=max(lengths))
+            batch_sampler = GroupedBatchSampler(train_sampler, groups, self.args.train_batch_size)
+        else:
+            batch_sampler = BatchSampler(train_sampler, self.args.train_batch_size, drop_last=True)
+        if getattr(self.model.config, "frozen_layers", 0) > 0:
+            # same indices, with the cached activations of the frozen layers instead of the input ids
+            dataset = self.get_frozen_train_dataset()
+            collate_fn = DataCollatorForFrozenActivations(self.data_collator).collate_batch
+        else:
+            dataset = self.train_dataset
+            collate_fn = self.data_collator.collate_batch
         return DataLoader(
-            self.train_dataset,
-            batch_size=self.args.train_batch_size,
-            sampler=train_sampler,
-            drop_last=True,
-            collate_fn=self.data_collator.collate_batch,
+            dataset,
+            batch_sampler=ResumableBatchSampler(batch_sampler),
+            collate_fn=collate_fn,
+            **self._dataloader_kwargs(),
         )
 
+    def get_frozen_train_dataset(self) -> FrozenActivationDataset:
+        """
+        The training set with the activations of the frozen bottom layers of the model (``config.frozen_layers``),
+        computed on the first call or read from the cache of a previous run in ``args.frozen_activations_dir`` (by
+        default the output dir). In distributed training, the first process computes them for the others.
+        """
+        if self._frozen_train_dataset is None:
+            base_model = self.model.base_model
+            if not hasattr(base_model, "encode_frozen"):
+                raise ValueError("frozen_layers is only supported by ALBERT and BERT models")
+            base_model.to(self.args.device)
+            with torch_distributed_zero_first(self.args.local_rank):
+                self._frozen_train_dataset = FrozenActivationDataset(
+                    base_model,
+                    self.train_dataset,
+                    self.data_collator,
+                    self.args.frozen_activations_dir or self.args.output_dir,
+                    batch_size=self.args.eval_batch_size,
+                    device=self.args.device,
+                    half=self.args.frozen_activations_half,
+                )
+        return self._frozen_train_dataset
+
     def get_eval_dataloader(self, eval_dataset: Optional[Dataset] = None) -> DataLoader:
         if eval_dataset is None and self.eval_dataset is None:
             raise ValueError("Trainer: evaluation requires an eval_dataset.")
@@ -194,6 +704,7 @@ class Trainer:
             batch_size=self.args.eval_batch_size,
             shuffle=False,
             collate_fn=self.data_collator.collate_batch,
+            **self._dataloader_kwargs(),
         )
 
     def get_test_dataloader(self, test_dataset: Dataset) -> DataLoader:
@@ -203,8 +714,24 @@ class Trainer:
             batch_size=self.args.eval_batch_size,
             shuffle=False,
             collate_fn=self.data_collator.collate_batch,
+            **self._dataloader_kwargs(),
         )
 
+    def _dataloader_kwargs(self) -> Dict:
+        kwargs = dict(num_workers=self.args.dataloader_num_workers, pin_memory=self.args.dataloader_pin_memory)
+        # only defined with worker processes
+        if self.args.dataloader_num_workers > 0:
+            kwargs.update(
+                prefetch_factor=self.args.dataloader_prefetch_factor,
+                persistent_workers=self.args.dataloader_persistent_workers,
+            )
+        return kwargs
+
+    def _prefetch(self, dataloader: DataLoader):
+        if self.args.background_prefetch_batches > 0:
+            return BackgroundPrefetcher(dataloader, self.args.device, depth=self.args.background_prefetch_batches)
+        return dataloader
+
     def get_optimizers(
         self, num_training_steps: int
     ) -> Tuple[torch.optim.Optimizer, torch.optim.lr_scheduler.LambdaLR]:
@@ -212,15 +739,28 @@ class Trainer:
         no_decay = ["bias", "LayerNorm.weight"]
         optimizer_grouped_parameters = [
             {
-                "params": [p for n, p in self.model.named_parameters() if not any(nd in n for nd in no_decay)],
+                "params": [
+                    p
+                    for n, p in self.model.named_parameters()
+                    if p.requires_grad and not any(nd in n for nd in no_decay)
+                ],
                 "weight_decay": self.args.weight_decay,
             },
             {
-                "params": [p for n, p in self.model.named_parameters() if any(nd in n for nd in no_decay)],
+                "params": [
+                    p for n, p in self.model.named_parameters() if p.requires_grad and any(nd in n for nd in no_decay)
+                ],
                 "weight_decay": 0.0,
             },
         ]
-        optimizer = AdamW(optimizer_grouped_parameters, lr=self.args.learning_rate, eps=self.args.adam_epsilon)
+        optimizer = AdamW(
+            optimizer_grouped_parameters,
+            lr=self.args.learning_rate,
+            eps=self.args.adam_epsilon,
+            foreach=self.args.foreach_optimizer,
+            # apex clips its master params
+            max_grad_norm=self.args.max_grad_norm if self.args.foreach_optimizer and not self.args.fp16 else None,
+        )
         scheduler = get_linear_schedule_with_warmup(
             optimizer, num_warmup_steps=self.args.warmup_steps, num_training_steps=num_training_steps
         )
@@ -245,7 +785,15 @@ class Trainer:
                 (Optional) Local path to model if model to train has been instantiated from a local path
                 If present, we will try reloading the optimizer/scheduler states from there.
         """
+        evaluator = None
+        if self.args.evaluate_during_training and self.args.async_evaluation and self.args.local_rank in [-1, 0]:
+            # forked before this process initializes CUDA, e.g. to cache the activations of frozen layers
+            evaluator = AsyncEvaluator(self)
+
         train_dataloader = self.get_train_dataloader()
+        if getattr(self.model.config, "frozen_layers", 0) > 0:
+            # the frozen layers only run once, to cache their activations
+            self.model.base_model.freeze_bottom_layers()
 
         if self.args.max_steps > 0:
             t_total = self.args.max_steps
@@ -270,6 +818,27 @@ class Trainer:
 
         model = self.model
         model.to(self.args.device)
+
+        attention_recorder = None
+        if self.args.attention_store_dir is not None:
+            attention_recorder = AttentionRecorder(
+                os.path.join(self.args.attention_store_dir, "rank-{}".format(max(self.args.local_rank, 0))),
+                sample_rate=self.args.attention_store_rate,
+                store_format=self.args.attention_store_format,
+                top_k=self.args.attention_store_top_k,
+                seed=self.args.seed,
+            ).attach(self.model)
+
+        checkpoint_writer = None
+        if self.args.async_checkpointing and self.args.local_rank in [-1, 0]:
+            checkpoint_writer = AsyncCheckpointWriter(rotate=self._rotate_checkpoints)
+
+        if self.args.step_timing and self.args.local_rank in [-1, 0]:
+            self._step_timer = StepTimer(self.args.device).attach(self.model)
+        profiler, profile_range = None, None
+        if self.args.profile_steps is not None and self.args.local_rank in [-1, 0]:
+            profile_range = tuple(int(step) for step in self.args.profile_steps.split("-"))
+
         if self.args.fp16:
             if not is_apex_available():
                 raise ImportError("Please install apex from https://www.github.com/nvidia/apex to use fp16 training.")
@@ -281,12 +850,15 @@ class Trainer:
 
         # Distributed training (should be after apex fp16 initialization)
         if self.args.local_rank != -1:
+            on_gpu = self.args.device.type == "cuda"
             model = torch.nn.parallel.DistributedDataParallel(
                 model,
-                device_ids=[self.args.local_rank],
-                output_device=self.args.local_rank,
-                find_unused_parameters=True,
+                device_ids=[self.args.local_rank] if on_gpu else None,
+                output_device=self.args.local_rank if on_gpu else None,
+                find_unused_parameters=self.args.ddp_find_unused_parameters,
             )
+            if self.allreduce_counter is not None:
+                model.register_comm_hook(self.allreduce_counter, AllReduceCounter.hook)
 
         if self.tb_writer is not None:
             self.tb_writer.add_text("args", self.args.to_json_string())
@@ -329,21 +901,55 @@ class Trainer:
                 global_step = 0
                 logger.info("  Starting fine-tuning.")
 
-        tr_loss = 0.0
-        logging_loss = 0.0
+        batch_sampler = train_dataloader.batch_sampler
+        if not isinstance(batch_sampler, ResumableBatchSampler):
+            batch_sampler = None
+        # batches of the first epoch skipped by the sampler, without being loaded
+        resumed_batches = 0
+        if global_step > 0 and batch_sampler is not None:
+            sampler_file = os.path.join(model_path, "sampler.pt")
+            if os.path.isfile(sampler_file):
+                sampler_state = torch.load(sampler_file)
+                epochs_trained, resumed_batches = sampler_state["epoch"], sampler_state["num_batches"]
+                batch_sampler.resume(sampler_state["rng_state"], resumed_batches)
+            else:
+                # checkpoint without sampler state: same number of batches, in a new order
+                resumed_batches = steps_trained_in_current_epoch * self.args.gradient_accumulation_steps
+                batch_sampler.resume(None, resumed_batches)
+            steps_trained_in_current_epoch = 0
+
+        # running sums of (loss, task_loss, alignment_loss), kept on the device and only read at logging steps
+        tr_losses = torch.zeros(3, device=self.args.device)
+        logging_losses = [0.0, 0.0, 0.0]
         model.zero_grad()
+        if self._step_timer is not None:
+            self._step_timer.reset()
         train_iterator = trange(
             epochs_trained, int(num_train_epochs), desc="Epoch", disable=self.args.local_rank not in [-1, 0],
         )
         for epoch in train_iterator:
-            epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=self.args.local_rank not in [-1, 0])
-            for step, inputs in enumerate(epoch_iterator):
+            if batch_sampler is not None:
+                batch_sampler.set_epoch(epoch)
+            epoch_iterator = tqdm(
+                self._prefetch(train_dataloader),
+                desc="Iteration",
+                initial=resumed_batches,
+                disable=self.args.local_rank not in [-1, 0],
+            )
+            for step, inputs in enumerate(epoch_iterator, start=resumed_batches):
 
                 # Skip past any already trained steps if resuming training
                 if steps_trained_in_current_epoch > 0:
                     steps_trained_in_current_epoch -= 1
                     continue
 
+                if self._step_timer is not None:
+                    self._step_timer.lap("data")
+                    self._step_timer.count(inputs)
+                if profiler is None and profile_range is not None:
+                    if profile_range[0] <= global_step + 1 <= profile_range[1]:
+                        profiler = self._start_profiler()
+
                 # tr_loss += self._dis_training_step(model, inputs, optimizer, global_step)
                 #
                 # if (step + 1) % self.args.gradient_accumulation_steps == 0 or (
@@ -361,47 +967,67 @@ class Trainer:
                 #     model.zero_grad()
 
 
-                tr_loss += self._training_step(model, inputs, optimizer, global_step)
+                if attention_recorder is not None:
+                    attention_recorder.global_step = global_step
+                optimizer_step = (step + 1) % self.args.gradient_accumulation_steps == 0 or (
+                    # last step in epoch but step is always smaller than gradient_accumulation_steps
+                    len(epoch_iterator) <= self.args.gradient_accumulation_steps
+                    and (step + 1) == len(epoch_iterator)
+                )
+                if optimizer_step or self.args.local_rank == -1 or self.args.ddp_sync_every_micro_batch:
+                    tr_losses += self._training_step(model, inputs, optimizer, global_step)
+                else:
+                    # the gradients accumulated over the micro-batches are all-reduced once, by the last backward
+                    with model.no_sync():
+                        tr_losses += self._training_step(model, inputs, optimizer, global_step)
 
-                if (step + 1) % self.args.gradient_accumulation_steps == 0 or (
-                        # last step in epoch but step is always smaller than gradient_accumulation_steps
-                        len(epoch_iterator) <= self.args.gradient_accumulation_steps
-                        and (step + 1) == len(epoch_iterator)
-                ):
+                if optimizer_step:
                     if self.args.fp16:
                         torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), self.args.max_grad_norm)
-                    else:
+                    elif getattr(optimizer, "max_grad_norm", None) is None:
                         torch.nn.utils.clip_grad_norm_(model.parameters(), self.args.max_grad_norm)
+                    # else the optimizer clips the gradients in its step
 
                     optimizer.step()
+                    if self._step_timer is not None:
+                        self._step_timer.lap("optimizer")
                     scheduler.step()
                     model.zero_grad()
                     global_step += 1
 
+                    if profiler is not None and global_step >= profile_range[1]:
+                        self._stop_profiler(profiler, profile_range)
+                        profiler, profile_range = None, None
+
+                    logging_step = (self.args.logging_steps > 0 and global_step % self.args.logging_steps == 0) or (
+                        global_step == 1 and self.args.logging_first_step
+                    )
+                    if logging_step and self.args.local_rank != -1:
+                        # the running sums of every process are replaced by their average, which the next
+                        # reductions keep on averaging, so that the logged losses are those of the global batch
+                        torch.distributed.all_reduce(tr_losses)
+                        tr_losses /= torch.distributed.get_world_size()
+
                     if self.args.local_rank in [-1, 0]:
-                        if (self.args.logging_steps > 0 and global_step % self.args.logging_steps == 0) or (
-                            global_step == 1 and self.args.logging_first_step
-                        ):
+                        if logging_step:
                             logs = {}
                             if self.args.evaluate_during_training:
-                                results = self.evaluate()
-                                for key, value in results.items():
-                                    eval_key = "eval_{}".format(key)
-                                    logs[eval_key] = value
-
-                            loss_scalar = (tr_loss - logging_loss) / self.args.logging_steps
-                            learning_rate_scalar = scheduler.get_last_lr()[0]
-                            logs["learning_rate"] = learning_rate_scalar
-                            logs["loss"] = loss_scalar
-                            logging_loss = tr_loss
-
-                            if self.tb_writer:
-                                for k, v in logs.items():
-                                    self.tb_writer.add_scalar(k, v, global_step)
-                            if is_wandb_available():
-                                wandb.log(logs, step=global_step)
-
-                            epoch_iterator.write(json.dumps({**logs, **{"step": global_step}}))
+                                if attention_recorder is not None:
+                                    # the dev-set forwards are not training steps
+                                    attention_recorder.recording = False
+                                logs.update(self._evaluate_during_training(global_step, evaluator))
+                                if attention_recorder is not None:
+                                    attention_recorder.recording = True
+
+                            losses = tr_losses.tolist()
+                            for key, value, logged_value in zip(LOGGED_LOSSES, losses, logging_losses):
+                                logs[key] = (value - logged_value) / self.args.logging_steps
+                            logs["learning_rate"] = scheduler.get_last_lr()[0]
+                            logging_losses = losses
+                            if self._step_timer is not None:
+                                logs.update(self._step_timer.logs())
+
+                            self._log(logs, global_step, epoch_iterator)
 
                         if self.args.save_steps > 0 and global_step % self.args.save_steps == 0:
                             # In all cases (even distributed/parallel), self.model is always a reference
@@ -412,31 +1038,123 @@ class Trainer:
                                 assert model is self.model
                             # Save model checkpoint
                             output_dir = os.path.join(self.args.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{global_step}")
-                            self.save_model(output_dir)
-                            self._rotate_checkpoints()
-                            torch.save(optimizer.state_dict(), os.path.join(output_dir, "optimizer.pt"))
-                            torch.save(scheduler.state_dict(), os.path.join(output_dir, "scheduler.pt"))
-                            logger.info("Saving optimizer and scheduler states to %s", output_dir)
-
+                            sampler_state = None
+                            if batch_sampler is not None:
+                                # where to resume the data order
+                                sampler_state = {
+                                    "epoch": epoch,
+                                    "num_batches": step + 1,
+                                    "rng_state": batch_sampler.epoch_rng_state,
+                                }
+                            if checkpoint_writer is not None:
+                                checkpoint_writer.save(
+                                    output_dir, self.model, optimizer, scheduler, self.args, sampler_state
+                                )
+                            else:
+                                self.save_model(output_dir)
+                                self._rotate_checkpoints()
+                                torch.save(optimizer.state_dict(), os.path.join(output_dir, "optimizer.pt"))
+                                torch.save(scheduler.state_dict(), os.path.join(output_dir, "scheduler.pt"))
+                                if sampler_state is not None:
+                                    torch.save(sampler_state, os.path.join(output_dir, "sampler.pt"))
+                                logger.info("Saving optimizer and scheduler states to %s", output_dir)
+
+                if self._step_timer is not None:
+                    self._step_timer.lap("other")
                 if self.args.max_steps > 0 and global_step > self.args.max_steps:
                     epoch_iterator.close()
                     break
+            resumed_batches = 0
             if self.args.max_steps > 0 and global_step > self.args.max_steps:
                 train_iterator.close()
                 break
 
+        if profiler is not None:
+            self._stop_profiler(profiler, (profile_range[0], global_step))
+        if self._step_timer is not None:
+            self._step_timer.close()
+            self._step_timer = None
+        if evaluator is not None:
+            logs = evaluator.close()
+            if logs:
+                self._log(logs, global_step)
+        if checkpoint_writer is not None:
+            checkpoint_writer.close()
         if self.tb_writer:
             self.tb_writer.close()
+        if attention_recorder is not None:
+            attention_recorder.close()
+
+        if self.args.local_rank != -1:
+            torch.distributed.all_reduce(tr_losses)
+            tr_losses /= torch.distributed.get_world_size()
 
         logger.info("\n\nTraining completed. Do not forget to share your model on huggingface.co/models =)\n\n")
-        return TrainOutput(global_step, tr_loss / global_step)
+        return TrainOutput(global_step, tr_losses[0].item() / global_step)
+
+    def _start_profiler(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.args.device.type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        profiler = torch.profiler.profile(activities=activities)
+        profiler.__enter__()
+        return profiler
+
+    def _stop_profiler(self, profiler, profile_range: Tuple[int, int]):
+        profiler.__exit__(None, None, None)
+        trace_dir = self.args.logging_dir or self.args.output_dir
+        os.makedirs(trace_dir, exist_ok=True)
+        trace_file = os.path.join(trace_dir, "trace-steps-{}-{}.json".format(*profile_range))
+        profiler.export_chrome_trace(trace_file)
+        logger.info("Chrome trace of the training steps %d to %d saved in %s", *profile_range, trace_file)
+
+    def _log(self, logs: Dict[str, float], global_step: int, iterator: Optional[tqdm] = None) -> None:
+        if self.tb_writer:
+            for k, v in logs.items():
+                self.tb_writer.add_scalar(k, v, global_step)
+        if is_wandb_available():
+            wandb.log(logs, step=global_step)
 
-    def _training_step(
-        self, model: nn.Module, inputs: Dict[str, torch.Tensor], optimizer: torch.optim.Optimizer, global_step: int
-    ) -> float:
-        model.train()
-        for k, v in inputs.items():
-            inputs[k] = v.to(self.args.device)
+        output = json.dumps({**logs, **{"step": global_step}})
+        if iterator is not None:
+            iterator.write(output)
+        else:
+            logger.info(output)
+
+    def _evaluate_during_training(self, global_step: int, evaluator: Optional[AsyncEvaluator] = None) -> Dict:
+        """
+        Evaluation of a logging step: on the full eval dataset or, with ``eval_subsample_size``, on its stratified
+        subsample but every ``full_eval_steps``. Returns the metrics, prefixed with eval_ (or eval_subsample_). With an
+        ``evaluator``, the evaluation is only submitted (a subsample one is dropped while another one runs) and the
+        metrics of the evaluations finished since the previous logging step are returned, with their eval_step.
+        """
+        full = self.args.eval_subsample_size <= 0 or (
+            self.args.full_eval_steps > 0 and global_step % self.args.full_eval_steps == 0
+        )
+        indices = None
+        if not full:
+            if getattr(self, "_eval_subsample", None) is None:
+                self._eval_subsample = _stratified_subsample(
+                    self.eval_dataset, self.args.eval_subsample_size, self.args.seed
+                )
+            indices = self._eval_subsample
+        prefix = "eval_" if full else "eval_subsample_"
+
+        if evaluator is None:
+            eval_dataset = self.eval_dataset if full else Subset(self.eval_dataset, indices)
+            return {prefix + key: value for key, value in self.evaluate(eval_dataset).items()}
+        logs = evaluator.results()
+        if full or evaluator.pending == 0:
+            evaluator.submit(global_step, prefix, self.model, indices)
+        return logs
+
+    def _compute_loss(
+        self, model: nn.Module, inputs: Dict[str, torch.Tensor], global_step: int
+    ) -> Tuple[torch.Tensor, Tuple]:
+        """
+        Training loss of one batch, i.e. the task loss plus the attention KL term once it is enabled, returned with
+        the model outputs. Subclasses can override it to add their own terms.
+        """
         # model.module.albert.encoder.albert_layer_groups[0].albert_layers[0].attention.opt_type = 'gen_opti'
         outputs = model(**inputs)
         loss = outputs[0]  # model outputs are always tuple in transformers (see doc)
@@ -457,25 +1175,49 @@ class Trainer:
             loss = loss+ self.args.att_kl * KL
             # import pdb
             # pdb.set_trace()
+        return loss, outputs
 
+    def _training_step(
+        self, model: nn.Module, inputs: Dict[str, torch.Tensor], optimizer: torch.optim.Optimizer, global_step: int
+    ) -> torch.Tensor:
+        """
+        Backward pass of one batch. Returns the detached (loss, task_loss, alignment_loss) of the batch, i.e. the
+        training loss, the model's own loss (``outputs[0]``) and its attention KL term (``outputs[-1]``), on the
+        device: reading them waits for the step to finish, which the training loop only does at logging steps.
+        """
+        model.train()
+        for k, v in inputs.items():
+            inputs[k] = v.to(self.args.device)
+        timer = self._step_timer
+        if timer is not None:
+            timer.lap("h2d")
+        loss, outputs = self._compute_loss(model, inputs, global_step)
+        if timer is not None:
+            timer.lap("forward")
 
         if self.args.n_gpu > 1:
             loss = loss.mean()  # mean() to average on multi-gpu parallel training
+        losses = torch.stack(
+            [torch.as_tensor(output, device=loss.device).detach().mean() for output in (loss, outputs[0], outputs[-1])]
+        )
         if self.args.gradient_accumulation_steps > 1:
             loss = loss / self.args.gradient_accumulation_steps
+            losses = losses / self.args.gradient_accumulation_steps
 
         if self.args.fp16:
             with amp.scale_loss(loss, optimizer) as scaled_loss:
                 scaled_loss.backward()
         else:
             loss.backward()
+        if timer is not None:
+            timer.lap("backward")
 
 
         # for name, parms in model.named_parameters():
         #     print('-->name:', name, '-->grad_requirs:', parms.requires_grad, \
         #           ' -->grad_value:', parms.grad)
 
-        return loss.item()
+        return losses
 
     def _dis_training_step(
         self, model: nn.Module, inputs: Dict[str, torch.Tensor], optimizer: torch.optim.Optimizer, global_step: int
@@ -484,7 +1226,8 @@ class Trainer:
         for k, v in inputs.items():
             inputs[k] = v.to(self.args.device)
         # 进入到attention layer model.module.albert.encoder.albert_layer_groups[0].albert_layers[0].attention
-        model.module.albert.encoder.albert_layer_groups[0].albert_layers[0].attention.opt_type = 'dis_opti'
+        unwrapped_model = model.module if hasattr(model, "module") else model
+        unwrapped_model.albert.encoder.albert_layer_groups[0].albert_layers[0].attention.opt_type = 'dis_opti'
         outputs = model(**inputs)
         # model.module.xxblock.xxlyaer.cccsd.opt_type = ''
         loss = outputs[0]  # model outputs are always tuple in transformers (see doc)
@@ -617,7 +1360,12 @@ class Trainer:
         """
         eval_dataloader = self.get_eval_dataloader(eval_dataset)
 
-        output = self._prediction_loop(eval_dataloader, description="Evaluation")
+        # the predictions are not returned, streaming metrics do not need them either
+        output = self._prediction_loop(
+            eval_dataloader,
+            description="Evaluation",
+            keep_predictions=not isinstance(self.compute_metrics, StreamingMetrics),
+        )
         return output.metrics
 
     def predict(self, test_dataset: Dataset) -> PredictionOutput:
@@ -631,12 +1379,19 @@ class Trainer:
         return self._prediction_loop(test_dataloader, description="Prediction")
 
     def _prediction_loop(
-        self, dataloader: DataLoader, description: str, prediction_loss_only: Optional[bool] = None
+        self,
+        dataloader: DataLoader,
+        description: str,
+        prediction_loss_only: Optional[bool] = None,
+        keep_predictions: bool = True,
     ) -> PredictionOutput:
         """
         Prediction/evaluation loop, shared by `evaluate()` and `predict()`.
 
-        Works both with or without labels.
+        Works both with or without labels. The predictions and labels are written into arrays preallocated for the
+        dataset, the predictions into a memory-mapped ``<description>_predictions.npy`` in
+        ``args.predictions_memmap_dir`` if set. With ``keep_predictions=False`` they are not kept at all, which only
+        leaves the per-batch updates of a :class:`StreamingMetrics` ``compute_metrics``.
         """
 
         prediction_loss_only = prediction_loss_only if prediction_loss_only is not None else self.prediction_loss_only
@@ -652,11 +1407,22 @@ class Trainer:
         logger.info("  Num examples = %d", len(dataloader.dataset))
         logger.info("  Batch size = %d", dataloader.batch_size)
         eval_losses: List[float] = []
-        preds: np.ndarray = None
-        label_ids: np.ndarray = None
+        num_examples = len(dataloader.dataset)
+        predictions_path = None
+        if self.args.predictions_memmap_dir is not None:
+            os.makedirs(self.args.predictions_memmap_dir, exist_ok=True)
+            predictions_path = os.path.join(
+                self.args.predictions_memmap_dir, "{}_predictions.npy".format(description.lower())
+            )
+        preds = PredictionBuffer(num_examples, predictions_path)
+        label_ids = PredictionBuffer(num_examples)
+        streaming_metrics = self.compute_metrics if isinstance(self.compute_metrics, StreamingMetrics) else None
+        has_streamed_labels = False
+        if streaming_metrics is not None:
+            streaming_metrics.reset()
         model.eval()
 
-        for inputs in tqdm(dataloader, desc=description):
+        for inputs in tqdm(self._prefetch(dataloader), desc=description):
             has_labels = any(inputs.get(k) is not None for k in ["labels", "masked_lm_labels"])
 
             for k, v in inputs.items():
@@ -671,17 +1437,20 @@ class Trainer:
                     logits = outputs[0]
 
             if not prediction_loss_only:
-                if preds is None:
-                    preds = logits.detach().cpu().numpy()
-                else:
-                    preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-                if inputs.get("labels") is not None:
-                    if label_ids is None:
-                        label_ids = inputs["labels"].detach().cpu().numpy()
-                    else:
-                        label_ids = np.append(label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
-
-        if self.compute_metrics is not None and preds is not None and label_ids is not None:
+                batch_preds = logits.detach().cpu().numpy()
+                batch_label_ids = inputs["labels"].detach().cpu().numpy() if inputs.get("labels") is not None else None
+                if keep_predictions:
+                    preds.add(batch_preds)
+                    if batch_label_ids is not None:
+                        label_ids.add(batch_label_ids)
+                if streaming_metrics is not None and batch_label_ids is not None:
+                    streaming_metrics.update(EvalPrediction(predictions=batch_preds, label_ids=batch_label_ids))
+                    has_streamed_labels = True
+
+        preds, label_ids = preds.result(), label_ids.result()
+        if streaming_metrics is not None and has_streamed_labels:
+            metrics = streaming_metrics.compute()
+        elif self.compute_metrics is not None and preds is not None and label_ids is not None:
             metrics = self.compute_metrics(EvalPrediction(predictions=preds, label_ids=label_ids))
         else:
             metrics = {}
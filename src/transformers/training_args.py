@@ -1,6 +1,7 @@
 import dataclasses
 import json
 import logging
+import os
 from dataclasses import dataclass, field
 from typing import Any, Dict, Optional, Tuple
 
@@ -44,6 +45,28 @@ class TrainingArguments:
     evaluate_during_training: bool = field(
         default=False, metadata={"help": "Run evaluation during training at each logging step."},
     )
+    eval_subsample_size: int = field(
+        default=0,
+        metadata={
+            "help": "If > 0, evaluation during training runs on a fixed subsample of the dev set of this size, "
+            "stratified by label, but every full_eval_steps."
+        },
+    )
+    full_eval_steps: int = field(
+        default=0,
+        metadata={
+            "help": "With eval_subsample_size, evaluate the full dev set every X updates steps (checked at the "
+            "logging steps, 0: never)."
+        },
+    )
+    async_evaluation: bool = field(
+        default=False,
+        metadata={
+            "help": "Run the evaluations during training in a worker process on a CPU snapshot of the weights, and "
+            "log their metrics once they are done. The worker is forked, so CUDA must not be initialized when the "
+            "training starts (e.g. it is under distributed training on GPUs)."
+        },
+    )
 
     per_gpu_train_batch_size: int = field(default=8, metadata={"help": "Batch size per GPU/CPU for training."})
     per_gpu_eval_batch_size: int = field(default=8, metadata={"help": "Batch size per GPU/CPU for evaluation."})
@@ -56,6 +79,13 @@ class TrainingArguments:
     weight_decay: float = field(default=0.0, metadata={"help": "Weight decay if we apply some."})
     adam_epsilon: float = field(default=1e-8, metadata={"help": "Epsilon for Adam optimizer."})
     max_grad_norm: float = field(default=1.0, metadata={"help": "Max gradient norm."})
+    foreach_optimizer: bool = field(
+        default=False,
+        metadata={
+            "help": "Update the parameters with the multi-tensor (foreach) AdamW, which also clips the gradients in "
+            "its step (unless with fp16)."
+        },
+    )
 
     num_train_epochs: float = field(default=3.0, metadata={"help": "Total number of training epochs to perform."})
     max_steps: int = field(
@@ -67,6 +97,20 @@ class TrainingArguments:
     logging_dir: Optional[str] = field(default=None, metadata={"help": "Tensorboard log dir."})
     logging_first_step: bool = field(default=False, metadata={"help": "Log and eval the first global_step"})
     logging_steps: int = field(default=500, metadata={"help": "Log every X updates steps."})
+    step_timing: bool = field(
+        default=False,
+        metadata={
+            "help": "Log the mean time of the phases of the training steps (data, host-to-device copy, forward of the "
+            "task and of the alignment modules, backward, optimizer, other) and the samples and tokens per second."
+        },
+    )
+    profile_steps: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Range of update steps, e.g. 10-20, to record with torch.profiler into a chrome trace saved in "
+            "the logging dir (or the output dir)."
+        },
+    )
     save_steps: int = field(default=500, metadata={"help": "Save checkpoint every X updates steps."})
     save_total_limit: Optional[int] = field(
         default=None,
@@ -80,6 +124,14 @@ class TrainingArguments:
     no_cuda: bool = field(default=False, metadata={"help": "Avoid using CUDA even if it is available"})
     seed: int = field(default=42, metadata={"help": "random seed for initialization"})
 
+    async_checkpointing: bool = field(
+        default=False,
+        metadata={
+            "help": "Snapshot the checkpoints to CPU memory and write (and rotate) them from a background thread "
+            "instead of pausing training."
+        },
+    )
+
     fp16: bool = field(
         default=False,
         metadata={"help": "Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit"},
@@ -94,8 +146,30 @@ class TrainingArguments:
         },
     )
     local_rank: int = field(default=-1, metadata={"help": "For distributed training: local_rank"})
+    ddp_backend: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "For distributed training: torch.distributed backend, by default nccl on GPUs and gloo on CPUs "
+            "(with --no_cuda or without CUDA)."
+        },
+    )
+    ddp_find_unused_parameters: bool = field(
+        default=True,
+        metadata={
+            "help": "For distributed training: whether DistributedDataParallel looks for the parameters without "
+            "gradient after every forward, as the alignment modules before kl_start_step. Only disable it "
+            "(--no-ddp_find_unused_parameters) if every trainable parameter gets a gradient at every step."
+        },
+    )
+    ddp_sync_every_micro_batch: bool = field(
+        default=False,
+        metadata={
+            "help": "For distributed training with gradient accumulation: all-reduce the gradients after the backward "
+            "of every micro-batch, instead of only once per optimization step (no_sync)."
+        },
+    )
 
-    att_type: str = field(default='gamma_att', metadata={"help": "soft_attention, soft_weibull, soft_lognormal, gamma_att"})
+    att_type: str = field(default='gamma_att', metadata={"help": "soft_attention, soft_weibull, soft_lognormal, gamma_att (ALBERT only, runs as soft_attention)"})
 
     # opt_type: str = field(default='dis_opti', metadata={"help": "optimizing type"})
 
@@ -149,6 +223,113 @@ class TrainingArguments:
 
     k_parameterization: str = field(default='blue', metadata={"help": "parameterization for k"})
 
+    att_noise_recompute: bool = field(
+        default=True,
+        metadata={
+            "help": "Regenerate the soft_weibull/soft_lognormal attention noise from a seed in backward "
+            "instead of keeping it (and the sampled attention) alive for autograd."
+        },
+    )
+
+    dataloader_num_workers: int = field(
+        default=0, metadata={"help": "Number of DataLoader worker processes collating the batches (0: main process)."}
+    )
+
+    dataloader_pin_memory: bool = field(
+        default=False, metadata={"help": "Collate the batches into pinned memory, for faster copies to the GPU."}
+    )
+
+    dataloader_prefetch_factor: int = field(
+        default=2, metadata={"help": "Batches loaded in advance by each DataLoader worker."}
+    )
+
+    dataloader_persistent_workers: bool = field(
+        default=False, metadata={"help": "Keep the DataLoader workers alive across epochs and evaluations."}
+    )
+
+    background_prefetch_batches: int = field(
+        default=0,
+        metadata={
+            "help": "If > 0, a background thread collates up to this many batches ahead and copies them to the "
+            "device while the current step runs."
+        },
+    )
+
+    dynamic_padding: bool = field(
+        default=False,
+        metadata={
+            "help": "Pad every batch to its longest sequence instead of max_seq_length, and group the training "
+            "examples into batches of similar lengths."
+        },
+    )
+
+    predictions_memmap_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Stream the predictions of evaluate()/predict() into memory-mapped <description>_predictions.npy "
+            "files in this dir instead of keeping them in RAM."
+        },
+    )
+
+    embedding_projection_cache: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "ALBERT inference: project the factorized embeddings through cached vocab x hidden tables "
+            "(full) or float16 ones (half) instead of a matmul per forward."
+        },
+    )
+
+    early_exit_every: int = field(
+        default=0,
+        metadata={
+            "help": "ALBERT sequence classification: also apply the classifier every this many layer iterations, "
+            "averaging the losses of these exits with the final one."
+        },
+    )
+
+    early_exit_entropy: float = field(
+        default=0.0,
+        metadata={
+            "help": "With early_exit_every, examples whose prediction entropy at an exit is below this threshold "
+            "stop there in evaluation (0 runs all the layers)."
+        },
+    )
+
+    frozen_layers: int = field(
+        default=0,
+        metadata={
+            "help": "ALBERT/BERT: freeze the embeddings and this many bottom layers, whose activations on the "
+            "training set are computed once and memory-mapped, and only train the layers above them."
+        },
+    )
+
+    frozen_activations_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Dir of the cached activations of the frozen layers (default: output_dir), reused by the runs "
+            "with the same frozen weights, config and training set."
+        },
+    )
+
+    frozen_activations_half: bool = field(
+        default=False, metadata={"help": "Cache the activations of the frozen layers in float16."}
+    )
+
+    attention_store_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "If set, record a sample of the attention and transport maps during training in this dir."},
+    )
+
+    attention_store_rate: float = field(
+        default=0.01, metadata={"help": "Fraction of the training examples whose maps are recorded."}
+    )
+
+    attention_store_format: str = field(
+        default="float16", metadata={"help": "float16 (dense maps) or topk (top-k entries of every row)."}
+    )
+
+    attention_store_top_k: int = field(default=32, metadata={"help": "Entries kept per row with the topk format."})
+
 
     @property
     def train_batch_size(self) -> int:
@@ -158,11 +339,22 @@ class TrainingArguments:
     def eval_batch_size(self) -> int:
         return self.per_gpu_eval_batch_size * max(1, self.n_gpu)
 
+    def __post_init__(self):
+        # torchrun (and torch.distributed.launch --use_env) pass the local rank in the environment
+        if self.local_rank == -1 and "LOCAL_RANK" in os.environ:
+            self.local_rank = int(os.environ["LOCAL_RANK"])
+
     @cached_property
     @torch_required
     def _setup_devices(self) -> Tuple["torch.device", int]:
         logger.info("PyTorch: setting up devices")
-        if self.no_cuda:
+        if self.local_rank != -1 and (self.no_cuda or not torch.cuda.is_available()):
+            # Multi-process CPU training: one process per host (or per socket), synchronized by gloo
+            if not torch.distributed.is_initialized():
+                torch.distributed.init_process_group(backend=self.ddp_backend or "gloo")
+            device = torch.device("cpu")
+            n_gpu = 0
+        elif self.no_cuda:
             device = torch.device("cpu")
             n_gpu = 0
         elif self.local_rank == -1:
@@ -173,7 +365,8 @@ class TrainingArguments:
         else:
             # Here, we'll use torch.distributed.
             # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
-            torch.distributed.init_process_group(backend="nccl")
+            if not torch.distributed.is_initialized():
+                torch.distributed.init_process_group(backend=self.ddp_backend or "nccl")
             device = torch.device("cuda", self.local_rank)
             n_gpu = 1
         return device, n_gpu
@@ -0,0 +1,89 @@
+import tempfile
+import unittest
+
+from transformers import is_torch_available
+
+from .utils import VARIATIONAL_ATTENTION_CONFIG, require_torch
+
+
+if is_torch_available():
+    import torch
+    from transformers import AlbertConfig, AlbertModel, AttentionRecorder, AttentionStore
+
+
+@require_torch
+class AttentionStoreTest(unittest.TestCase):
+    def get_model(self):
+        torch.manual_seed(0)
+        config = AlbertConfig(
+            vocab_size=99,
+            embedding_size=16,
+            hidden_size=32,
+            num_hidden_layers=3,
+            num_attention_heads=4,
+            intermediate_size=37,
+            output_attentions=True,
+        )
+        config.update(VARIATIONAL_ATTENTION_CONFIG)
+        return AlbertModel(config).eval()
+
+    def test_float16_round_trip(self):
+        model = self.get_model()
+        input_ids = torch.randint(99, (2, 7))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recorder = AttentionRecorder(tmp_dir, sample_rate=1.0, layers=[0, 2], heads=[1, 3]).attach(model)
+            with torch.no_grad():
+                attentions = model(input_ids)[-1]
+            recorder.close()
+
+            store = AttentionStore(tmp_dir)
+            self.assertEqual(len(store), 4)
+            for layer in (0, 2):
+                for row in (0, 1):
+                    (position,) = store.select(kind="attention", layer=layer, row=row)
+                    expected = attentions[layer][row, [1, 3]].numpy()
+                    self.assertEqual(store[position].shape, (2, 7, 7))
+                    self.assertTrue(abs(store[position] - expected).max() < 1e-3)
+
+    def test_topk_keeps_largest_entries(self):
+        model = self.get_model()
+        input_ids = torch.randint(99, (1, 9))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recorder = AttentionRecorder(tmp_dir, sample_rate=1.0, store_format="topk", top_k=3).attach(model)
+            with torch.no_grad():
+                attentions = model(input_ids)[-1]
+            recorder.close()
+
+            store = AttentionStore(tmp_dir)
+            self.assertEqual(len(store), 3)
+            dense = store[store.select(layer=1)[0]]
+            expected = attentions[1][0]
+            self.assertEqual(int((dense != 0).sum(-1).max()), 3)
+            top = expected.topk(3, dim=-1)
+            recovered = torch.from_numpy(dense).gather(-1, top.indices)
+            self.assertTrue((recovered - top.values).abs().max() < 1e-3)
+
+    def test_nothing_recorded_at_zero_rate(self):
+        model = self.get_model()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recorder = AttentionRecorder(tmp_dir, sample_rate=0.0).attach(model)
+            with torch.no_grad():
+                model(torch.randint(99, (4, 5)))
+            recorder.close()
+            self.assertEqual(len(AttentionStore(tmp_dir)), 0)
+
+    def test_paused_forwards_are_not_recorded(self):
+        model = self.get_model()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            recorder = AttentionRecorder(tmp_dir, sample_rate=1.0, layers=[0]).attach(model)
+            with torch.no_grad():
+                model(torch.randint(99, (2, 5)))
+                recorder.recording = False
+                model(torch.randint(99, (4, 5)))
+                recorder.recording = True
+                model(torch.randint(99, (2, 5)))
+            recorder.close()
+
+            store = AttentionStore(tmp_dir)
+            recorded = [(entry["forward"], entry["row"]) for entry in store.index]
+            self.assertEqual(recorded, [(0, 0), (0, 1), (1, 0), (1, 1)])
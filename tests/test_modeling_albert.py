@@ -20,10 +20,12 @@ from transformers import is_torch_available
 
 from .test_configuration_common import ConfigTester
 from .test_modeling_common import ModelTesterMixin, ids_tensor
-from .utils import require_torch, slow, torch_device
+from .utils import VARIATIONAL_ATTENTION_CONFIG, require_torch, slow, torch_device
 
 
 if is_torch_available():
+    import torch
+    import torch.nn.functional as F
     from transformers import (
         AlbertConfig,
         AlbertModel,
@@ -269,3 +271,150 @@ class AlbertModelTest(ModelTesterMixin, unittest.TestCase):
         for model_name in list(ALBERT_PRETRAINED_MODEL_ARCHIVE_MAP.keys())[:1]:
             model = AlbertModel.from_pretrained(model_name)
             self.assertIsNotNone(model)
+
+
+@require_torch
+class AlbertAttentionSamplePredictTest(unittest.TestCase):
+    def get_model(self, **kwargs):
+        torch.manual_seed(0)
+        config = AlbertConfig(
+            vocab_size=99,
+            embedding_size=16,
+            hidden_size=32,
+            num_hidden_layers=3,
+            num_attention_heads=4,
+            intermediate_size=37,
+            num_labels=3,
+            initializer_range=0.3,
+        )
+        config.update(VARIATIONAL_ATTENTION_CONFIG)
+        config.update(kwargs)
+        return AlbertForSequenceClassification(config).eval()
+
+    def test_noiseless_samples_match_deterministic_forward(self):
+        model = self.get_model(att_type="soft_lognormal", sigma_normal_posterior=1e-4)
+        input_ids = ids_tensor([3, 7], 99)
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[1, 5:] = 0
+        probs, entropy = model.predict_with_attention_samples(input_ids, attention_mask, num_samples=4)
+        with torch.no_grad():
+            expected = F.softmax(model(input_ids, attention_mask=attention_mask)[0], dim=-1)
+        self.assertTrue(torch.allclose(probs, expected, atol=1e-4))
+        self.assertTrue(torch.allclose(entropy, -(expected * expected.log()).sum(-1), atol=1e-4))
+
+    def test_gamma_att_is_softmax_attention(self):
+        input_ids = ids_tensor([3, 7], 99)
+        model = self.get_model(att_type="gamma_att").train()
+        attention = model.albert.encoder.albert_layer_groups[0].albert_layers[0].attention
+        self.assertFalse(attention._needs_logprobs())
+        torch.manual_seed(1)
+        logits = model(input_ids)[0]
+        expected = self.get_model(att_type="soft_attention").train()
+        torch.manual_seed(1)
+        self.assertTrue(torch.allclose(logits, expected(input_ids)[0]))
+
+
+@require_torch
+class AlbertEmbeddingProjectionTest(unittest.TestCase):
+    def test_projected_embeddings_match_forward(self):
+        torch.manual_seed(0)
+        config = AlbertConfig(vocab_size=99, embedding_size=16, hidden_size=48, num_attention_heads=12)
+        config.update(VARIATIONAL_ATTENTION_CONFIG)
+        model = AlbertModel(config).eval()
+        input_ids = ids_tensor([3, 7], 99)
+        token_type_ids = ids_tensor([3, 7], 2)
+        with torch.no_grad():
+            expected = model(input_ids, token_type_ids=token_type_ids)[0]
+            for cache, atol in (("full", 1e-5), ("half", 1e-2)):
+                model.embedding_projection_cache = cache
+                output = model(input_ids, token_type_ids=token_type_ids)[0]
+                self.assertTrue(torch.allclose(output, expected, atol=atol), cache)
+
+        model.train()(input_ids)
+        self.assertIsNone(model._embedding_projection)
+
+
+@require_torch
+class AlbertEarlyExitTest(unittest.TestCase):
+    def test_exits_are_supervised_and_compacted(self):
+        torch.manual_seed(0)
+        config = AlbertConfig(vocab_size=99, embedding_size=16, hidden_size=48, num_hidden_layers=4,
+                              num_attention_heads=12, num_labels=3, early_exit_every=2)
+        config.update(VARIATIONAL_ATTENTION_CONFIG)
+        model = AlbertForSequenceClassification(config).train()
+        input_ids = ids_tensor([6, 7], 99)
+        labels = ids_tensor([6], 3)
+        model(input_ids, labels=labels)[0].backward()
+        self.assertEqual(len(model.albert.encoder.exit_hidden_states), 1)
+
+        model.eval()
+        with torch.no_grad():
+            full_depth = model(input_ids)[0]
+            # the exits are not part of the eval loss
+            eval_loss = model(input_ids, labels=labels)[0]
+            self.assertTrue(torch.allclose(eval_loss, torch.nn.functional.cross_entropy(full_depth, labels)))
+            first_exit = model.classifier(model.albert.pool(model.albert.encoder.exit_hidden_states[0]))
+            probs = first_exit.softmax(-1)
+            entropy = -(probs * probs.log()).sum(-1)
+            model.early_exit_entropy = entropy.median().item()
+            logits = model(input_ids)[0]
+
+        exits = entropy < model.early_exit_entropy
+        self.assertTrue(exits.any() and not exits.all())
+        self.assertEqual(model.exit_layers.tolist(), [2 if exit else 4 for exit in exits.tolist()])
+        self.assertTrue(torch.allclose(logits[exits], first_exit[exits], atol=1e-5))
+        self.assertTrue(torch.allclose(logits[~exits], full_depth[~exits], atol=1e-5))
+
+
+@require_torch
+class AlbertAlignmentPaddingTest(unittest.TestCase):
+    def alignment_loss(self, adver_type, input_ids, attention_mask):
+        torch.manual_seed(0)
+        config = AlbertConfig(
+            vocab_size=99,
+            embedding_size=16,
+            hidden_size=48,
+            num_hidden_layers=2,
+            num_attention_heads=12,
+            intermediate_size=37,
+            hidden_dropout_prob=0.0,
+            attention_probs_dropout_prob=0.0,
+        )
+        config.update(VARIATIONAL_ATTENTION_CONFIG)
+        config.update({"adver_type": adver_type, "att_prior_type": "contextual"})
+        model = AlbertModel(config).train()
+        model(input_ids, attention_mask=attention_mask)
+        return model.encoder.albert_layer_groups[0].albert_layers[0].attention.KL_backward
+
+    def test_padding_does_not_change_alignment_loss(self):
+        input_ids = ids_tensor([1, 5], 99)
+        padded_ids = torch.cat([input_ids, torch.zeros_like(input_ids[:, :3])], dim=1)
+        padded_mask = torch.ones_like(padded_ids)
+        padded_mask[:, 5:] = 0
+        for adver_type in ("act", "act_test", "combine", "ot"):
+            expected = self.alignment_loss(adver_type, input_ids, torch.ones_like(input_ids))
+            loss = self.alignment_loss(adver_type, padded_ids, padded_mask)
+            self.assertTrue(torch.allclose(loss, expected, atol=1e-5), adver_type)
+
+    def test_alignment_statistics_and_pruning(self):
+        input_ids = ids_tensor([2, 5], 99)
+        for adver_type in ("talking_head", "combine"):
+            torch.manual_seed(0)
+            config = AlbertConfig(
+                vocab_size=99, embedding_size=16, hidden_size=48, num_hidden_layers=2, num_attention_heads=12,
+            )
+            config.update(VARIATIONAL_ATTENTION_CONFIG)
+            config.update({"adver_type": adver_type, "att_prior_type": "contextual"})
+            model = AlbertModel(config).eval()
+            attention = model.encoder.albert_layer_groups[0].albert_layers[0].attention
+            attention.alignment_statistics = adver_type == "combine"
+            with torch.no_grad():
+                model(input_ids)
+            if adver_type == "combine":
+                self.assertEqual(attention.head_alignment_cost.shape, (12,))
+
+            model.prune_heads({0: [0, 3, 5]})
+            self.assertEqual(attention.se_linear11.weight.shape, (9, 9))
+            with torch.no_grad():
+                sequence_output = model(input_ids)[0]
+            self.assertEqual(sequence_output.shape, (2, 5, 48))
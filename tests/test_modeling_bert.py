@@ -20,10 +20,15 @@ from transformers import is_torch_available
 
 from .test_configuration_common import ConfigTester
 from .test_modeling_common import ModelTesterMixin, floats_tensor, ids_tensor
-from .utils import require_torch, slow, torch_device
+from .utils import VARIATIONAL_ATTENTION_CONFIG, require_torch, slow, torch_device
 
 
 if is_torch_available():
+    import math
+
+    import numpy as np
+    import torch
+    import torch.nn.functional as F
     from transformers import (
         BertConfig,
         BertModel,
@@ -35,7 +40,11 @@ if is_torch_available():
         BertForTokenClassification,
         BertForMultipleChoice,
     )
-    from transformers.modeling_bert import BERT_PRETRAINED_MODEL_ARCHIVE_MAP
+    from transformers.modeling_bert import (
+        BERT_PRETRAINED_MODEL_ARCHIVE_MAP,
+        LognormalAttentionSample,
+        WeibullAttentionSample,
+    )
 
 
 class BertModelTester:
@@ -497,3 +506,134 @@ class BertModelTest(ModelTesterMixin, unittest.TestCase):
         for model_name in list(BERT_PRETRAINED_MODEL_ARCHIVE_MAP.keys())[:1]:
             model = BertModel.from_pretrained(model_name)
             self.assertIsNotNone(model)
+
+
+@require_torch
+class VariationalAttentionSampleTest(unittest.TestCase):
+    """ The seeded autograd functions must match plain autograd run on the same noise. """
+
+    eps = 1e-20
+
+    def _inputs(self):
+        torch.manual_seed(0)
+        attention_probs = torch.softmax(torch.randn(2, 3, 5, 5, dtype=torch.double), dim=-1).requires_grad_()
+        value_layer = torch.randn(2, 3, 5, 4, dtype=torch.double, requires_grad=True)
+        return attention_probs, value_layer
+
+    def _noise(self, attention_probs, seed, gaussian):
+        generator = torch.Generator().manual_seed(seed)
+        sample = torch.randn if gaussian else torch.rand
+        return sample(attention_probs.shape, generator=generator, dtype=attention_probs.dtype)
+
+    def _check(self, fused, reference, inputs):
+        grad_context = torch.randn_like(fused[0])
+        fused_grads = torch.autograd.grad(
+            (fused[0] * grad_context).sum() + 3 * fused[1], inputs, allow_unused=True
+        )
+        reference_grads = torch.autograd.grad(
+            (reference[0] * grad_context).sum() + 3 * reference[1], inputs, allow_unused=True
+        )
+        self.assertTrue(torch.allclose(fused[0], reference[0]))
+        self.assertTrue(torch.allclose(fused[1], reference[1]))
+        for fused_grad, reference_grad in zip(fused_grads, reference_grads):
+            self.assertTrue(torch.allclose(fused_grad, reference_grad))
+
+    def test_weibull_matches_autograd(self):
+        attention_probs, value_layer = self._inputs()
+        logprobs = torch.log(attention_probs + self.eps)
+        alpha_gamma = torch.tensor([0.7], dtype=torch.double, requires_grad=True)
+        k_weibull, beta_gamma, seed = 5.0, 1.3, 1234
+
+        fused = WeibullAttentionSample.apply(
+            attention_probs, value_layer, alpha_gamma, seed, k_weibull, beta_gamma, self.eps
+        )
+
+        u_weibull = self._noise(attention_probs, seed, gaussian=False)
+        lgamma_k = math.lgamma(1 + 1.0 / k_weibull)
+        out_weight = F.softmax(
+            logprobs - lgamma_k + 1.0 / k_weibull * torch.log(-torch.log(1.0 - u_weibull + self.eps) + self.eps), dim=-1
+        )
+        KL = -(
+            alpha_gamma * (logprobs - lgamma_k)
+            - np.euler_gamma * alpha_gamma / k_weibull
+            - beta_gamma * torch.exp(logprobs)
+            + alpha_gamma * math.log(beta_gamma + self.eps)
+            - torch.lgamma(alpha_gamma + self.eps)
+        )
+        reference = (torch.matmul(out_weight, value_layer), KL.mean())
+
+        self._check(fused, reference, (attention_probs, value_layer, alpha_gamma))
+        self.assertTrue(torch.allclose(fused[2], out_weight))
+
+    def test_lognormal_matches_autograd(self):
+        attention_probs, value_layer = self._inputs()
+        logprobs = torch.log(attention_probs + self.eps)
+        mean_normal_prior = torch.randn(2, 3, 1, 5, dtype=torch.double, requires_grad=True)
+        sigma_normal_prior = torch.tensor([0.8], dtype=torch.double, requires_grad=True)
+        sigma_normal_posterior, seed = 0.5, 4321
+
+        fused = LognormalAttentionSample.apply(
+            attention_probs, value_layer, mean_normal_prior, sigma_normal_prior, seed, sigma_normal_posterior, self.eps
+        )
+
+        noise = self._noise(attention_probs, seed, gaussian=True)
+        mean_normal_posterior = logprobs - sigma_normal_posterior ** 2 / 2
+        out_weight = F.softmax(mean_normal_posterior + sigma_normal_posterior * noise, dim=-1)
+        KL = (
+            torch.log(sigma_normal_prior / sigma_normal_posterior + self.eps)
+            + (sigma_normal_posterior ** 2 + (mean_normal_posterior - mean_normal_prior) ** 2)
+            / (2 * sigma_normal_prior ** 2)
+            - 0.5
+        )
+        reference = (torch.matmul(out_weight, value_layer), KL.mean())
+
+        self._check(fused, reference, (attention_probs, value_layer, mean_normal_prior, sigma_normal_prior))
+
+
+@require_torch
+class AttentionSamplePredictTest(unittest.TestCase):
+    def get_model(self, **kwargs):
+        torch.manual_seed(0)
+        config = BertConfig(
+            vocab_size=99,
+            hidden_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            intermediate_size=37,
+            num_labels=3,
+            initializer_range=0.3,
+        )
+        config.update(VARIATIONAL_ATTENTION_CONFIG)
+        config.update(kwargs)
+        return BertForSequenceClassification(config).eval()
+
+    def get_inputs(self):
+        input_ids = ids_tensor([3, 7], 99)
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[2, 4:] = 0
+        return input_ids, attention_mask
+
+    def test_noiseless_samples_match_deterministic_forward(self):
+        model = self.get_model(att_type="soft_lognormal", sigma_normal_posterior=1e-4)
+        input_ids, attention_mask = self.get_inputs()
+        probs, entropy = model.predict_with_attention_samples(input_ids, attention_mask, num_samples=4)
+        with torch.no_grad():
+            expected = F.softmax(model(input_ids, attention_mask=attention_mask)[0], dim=-1)
+        self.assertTrue(torch.allclose(probs, expected, atol=1e-4))
+        self.assertTrue(torch.allclose(entropy, -(expected * expected.log()).sum(-1), atol=1e-4))
+
+    def test_gamma_att_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.get_model(att_type="gamma_att")
+
+    def test_samples_differ(self):
+        model = self.get_model(att_type="soft_weibull", k_weibull=2.0)
+        input_ids, attention_mask = self.get_inputs()
+        probs, entropy = model.predict_with_attention_samples(input_ids, attention_mask, num_samples=8)
+        self.assertEqual(probs.shape, (3, 3))
+        self.assertEqual(entropy.shape, (3,))
+        self.assertTrue(torch.allclose(probs.sum(-1), torch.ones(3)))
+        with torch.no_grad():
+            deterministic = F.softmax(model(input_ids, attention_mask=attention_mask)[0], dim=-1)
+        self.assertFalse(torch.allclose(probs, deterministic, atol=1e-4))
+        self.assertFalse(any(getattr(module, "attention_sampling", False) for module in model.modules()))
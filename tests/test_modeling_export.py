@@ -0,0 +1,119 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+
+from transformers import is_torch_available
+
+from .utils import VARIATIONAL_ATTENTION_CONFIG, require_torch
+
+
+_onnxruntime_available = importlib.util.find_spec("onnxruntime") is not None
+
+
+if is_torch_available():
+    import torch
+    from transformers import AlbertConfig, AlbertForSequenceClassification, BertConfig, BertForSequenceClassification
+    from transformers.modeling_bert import BertSelfAttention
+    from transformers.modeling_export import (
+        InferenceSelfAttention,
+        compare_latency,
+        export_onnx,
+        export_torchscript,
+        load_onnxruntime,
+        quantizable_linears,
+        quantize_dynamic,
+        specialize_for_inference,
+    )
+
+
+@require_torch
+class ModelExportTest(unittest.TestCase):
+    def get_models(self, **kwargs):
+        config_kwargs = dict(vocab_size=99, hidden_size=48, num_hidden_layers=2, num_attention_heads=12, num_labels=3)
+        for config_class, model_class in (
+            (AlbertConfig, AlbertForSequenceClassification),
+            (BertConfig, BertForSequenceClassification),
+        ):
+            torch.manual_seed(0)
+            config = config_class(output_attentions=True, **config_kwargs)
+            config.update(VARIATIONAL_ATTENTION_CONFIG)
+            config.update(kwargs)
+            model = model_class(config).eval()
+            model.prune_heads({0: [1, 2]})
+            yield model
+
+    def get_inputs(self, batch_size, seq_len):
+        input_ids = torch.randint(99, (batch_size, seq_len))
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[-1, seq_len // 2 :] = 0
+        return input_ids, attention_mask, torch.zeros_like(input_ids)
+
+    def test_specialized_model_matches_eager(self):
+        inputs = self.get_inputs(2, 9)
+        for kwargs in (
+            {"att_type": "soft_weibull", "adver_type": "combine"},
+            {"adver_type": "talking_head", "att_prior_type": "contextual"},
+            {"att_type": "soft_lognormal"},
+        ):
+            for model in self.get_models(**kwargs):
+                with torch.no_grad():
+                    expected = model(*inputs)[0]
+                    specialized = specialize_for_inference(model)(*inputs)
+                self.assertFalse(any(isinstance(output, tuple) for output in specialized))
+                self.assertTrue(torch.allclose(specialized[0], expected, atol=1e-5), kwargs)
+
+    def test_torchscript_export(self):
+        inputs = self.get_inputs(3, 7)
+        for model in self.get_models(adver_type="talking_head", att_prior_type="contextual"):
+            attention = next(module for module in model.modules() if isinstance(module, BertSelfAttention))
+            torch.jit.script(InferenceSelfAttention(attention))
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = os.path.join(tmp_dir, "model.pt")
+                # traced with other shapes than the inputs
+                export_torchscript(model, path, batch_size=1, seq_len=16)
+                loaded = torch.jit.load(path)
+            with torch.no_grad():
+                self.assertTrue(torch.allclose(loaded(*inputs), model(*inputs)[0], atol=1e-5))
+
+    @unittest.skipUnless(_onnxruntime_available, "test requires onnxruntime")
+    def test_onnx_export(self):
+        inputs = self.get_inputs(3, 7)
+        for model in self.get_models(adver_type="talking_head", att_prior_type="contextual"):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                path = os.path.join(tmp_dir, "model.onnx")
+                export_onnx(model, path, batch_size=1, seq_len=16)
+                session = load_onnxruntime(path)
+                with torch.no_grad():
+                    self.assertTrue(torch.allclose(session(*inputs), model(*inputs)[0], atol=1e-4))
+                latencies = compare_latency(model, session, batch_size=1, seq_len=16, num_runs=2)
+            self.assertEqual(set(latencies), {"eager", "exported", "speedup"})
+
+    @unittest.skipIf(_onnxruntime_available, "test requires onnxruntime not to be installed")
+    def test_onnx_without_onnxruntime(self):
+        self.assertIsNone(load_onnxruntime("model.onnx"))
+
+    def test_unsupported_att_type(self):
+        model = next(self.get_models())
+        for module in model.modules():
+            if isinstance(module, BertSelfAttention):
+                module.att_type = "gamma_att"
+        with self.assertRaisesRegex(ValueError, "soft_attention, soft_weibull, soft_lognormal"):
+            specialize_for_inference(model)
+
+    def test_quantized_round_trip(self):
+        inputs = self.get_inputs(2, 9)
+        for model in self.get_models(adver_type="combine", att_prior_type="contextual"):
+            quantized = quantize_dynamic(model)
+            self.assertFalse(hasattr(model.config, "quantized_modules"))
+            self.assertEqual(quantized.config.quantized_modules, quantizable_linears(model))
+            self.assertFalse(any("critic" in name or "classifier" in name for name in quantizable_linears(model)))
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                quantized.save_pretrained(tmp_dir)
+                loaded = model.__class__.from_pretrained(tmp_dir).eval()
+            with torch.no_grad():
+                expected = quantized(*inputs)[0]
+                self.assertTrue(torch.allclose(loaded(*inputs)[0], expected))
+                self.assertTrue(torch.allclose(model(*inputs)[0], expected, atol=1e-1))
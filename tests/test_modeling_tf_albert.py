@@ -16,14 +16,15 @@
 
 import unittest
 
-from transformers import AlbertConfig, is_tf_available
+from transformers import AlbertConfig, is_tf_available, is_torch_available
 
 from .test_configuration_common import ConfigTester
 from .test_modeling_tf_common import TFModelTesterMixin, ids_tensor
-from .utils import require_tf, slow
+from .utils import VARIATIONAL_ATTENTION_CONFIG, require_tf, require_torch, slow
 
 
 if is_tf_available():
+    import tensorflow as tf
     from transformers.modeling_tf_albert import (
         TFAlbertModel,
         TFAlbertForMaskedLM,
@@ -233,3 +234,108 @@ class TFAlbertModelTest(TFModelTesterMixin, unittest.TestCase):
         for model_name in list(TF_ALBERT_PRETRAINED_MODEL_ARCHIVE_MAP.keys())[:1]:
             model = TFAlbertModel.from_pretrained(model_name)
             self.assertIsNotNone(model)
+
+
+@require_tf
+class TFAlbertAlignmentAttentionTest(unittest.TestCase):
+    def get_config(self, **kwargs):
+        config = AlbertConfig(
+            vocab_size=99,
+            embedding_size=16,
+            hidden_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            intermediate_size=37,
+            num_labels=3,
+        )
+        config.update(VARIATIONAL_ATTENTION_CONFIG)
+        config.update(kwargs)
+        return config
+
+    def test_training_step_compiles(self):
+        for kwargs in (
+            {"adver_type": "act", "att_prior_type": "contextual"},
+            {"adver_type": "combine", "att_prior_type": "contextual"},
+            {"att_type": "soft_weibull", "att_prior_type": "contextual"},
+        ):
+            model = TFAlbertForSequenceClassification(self.get_config(**kwargs))
+            input_ids = ids_tensor([2, 7], 99)
+            attention_mask = tf.constant([[1] * 7, [1] * 5 + [0] * 2])
+            self.assertEqual(len(model([input_ids, attention_mask])), 1)
+
+            @tf.function(jit_compile=True)
+            def train_step(input_ids, attention_mask):
+                with tf.GradientTape() as tape:
+                    logits, kl = model([input_ids, attention_mask], training=True)
+                    loss = tf.reduce_mean(logits) + kl
+                return kl, tape.gradient(loss, model.trainable_variables)
+
+            kl, grads = train_step(input_ids, attention_mask)
+            self.assertTrue(bool(tf.math.is_finite(kl)), kwargs)
+            if "adver_type" in kwargs:
+                # the navigators are only reached through the alignment loss
+                navigator_grads = [g for v, g in zip(model.trainable_variables, grads) if "se_linear5" in v.name]
+                self.assertTrue(navigator_grads and all(g is not None for g in navigator_grads), kwargs)
+
+    @require_torch
+    def test_alignment_weights_convert_from_pytorch(self):
+        import torch
+        from transformers import AlbertModel, load_pytorch_model_in_tf2_model
+
+        config = self.get_config(adver_type="act", att_prior_type="contextual")
+        pt_model = AlbertModel(config).eval()
+        tf_model = load_pytorch_model_in_tf2_model(TFAlbertModel(config), pt_model)
+
+        pt_weight = pt_model.encoder.albert_layer_groups[0].albert_layers[0].attention.se_linear5.weight
+        tf_weight = tf_model.albert.encoder.albert_layer_groups[0].albert_layers[0].attention.se_linear5.kernel
+        self.assertTrue(abs(tf_weight.numpy().T - pt_weight.detach().numpy()).max() < 1e-6)
+
+        input_ids = [[31, 51, 99, 4, 2], [15, 5, 0, 0, 0]]
+        attention_mask = [[1, 1, 1, 1, 1], [1, 1, 0, 0, 0]]
+        with torch.no_grad():
+            pt_output = pt_model(torch.tensor(input_ids), attention_mask=torch.tensor(attention_mask))[0].numpy()
+        tf_output = tf_model([tf.constant(input_ids), tf.constant(attention_mask)])[0].numpy()
+        self.assertTrue(abs(pt_output - tf_output)[:, :2].max() < 1e-4)
+
+    @require_torch
+    def test_talking_head_converts_from_pytorch(self):
+        import torch
+        from transformers import AlbertModel, load_pytorch_model_in_tf2_model
+
+        config = self.get_config(adver_type="talking_head", att_prior_type="contextual")
+        pt_model = AlbertModel(config).eval()
+        tf_model = load_pytorch_model_in_tf2_model(TFAlbertModel(config), pt_model)
+
+        input_ids = [[31, 51, 98, 4, 2], [15, 5, 0, 0, 0]]
+        attention_mask = [[1, 1, 1, 1, 1], [1, 1, 0, 0, 0]]
+        with torch.no_grad():
+            pt_output = pt_model(torch.tensor(input_ids), attention_mask=torch.tensor(attention_mask))[0].numpy()
+        tf_output = tf_model([tf.constant(input_ids), tf.constant(attention_mask)])[0].numpy()
+        self.assertTrue(abs(pt_output - tf_output)[0].max() < 1e-4)
+        self.assertTrue(abs(pt_output - tf_output)[1, :2].max() < 1e-4)
+
+    @require_torch
+    def test_parameter_prior_converts_from_pytorch(self):
+        from transformers import AlbertModel, load_pytorch_model_in_tf2_model
+
+        for att_type, name in (("soft_weibull", "alpha_gamma"), ("soft_lognormal", "sigma_normal_prior")):
+            config = self.get_config(att_type=att_type, att_prior_type="parameter")
+            pt_model = AlbertModel(config).eval()
+            pt_attention = pt_model.encoder.albert_layer_groups[0].albert_layers[0].attention
+            getattr(pt_attention, name).data.fill_(2.5)
+            tf_model = load_pytorch_model_in_tf2_model(TFAlbertModel(config), pt_model)
+
+            tf_attention = tf_model.albert.encoder.albert_layer_groups[0].albert_layers[0].attention
+            self.assertEqual(getattr(tf_attention, name).numpy().tolist(), [2.5])
+            trainable_names = [variable.name.split("/")[-1].split(":")[0] for variable in tf_model.trainable_variables]
+            self.assertIn(name, trainable_names)
+
+            input_ids = ids_tensor([2, 7], 99)
+            with tf.GradientTape() as tape:
+                _, _, kl = tf_model(input_ids, training=True)
+            self.assertIsNotNone(tape.gradient(kl, getattr(tf_attention, name)), att_type)
+
+    def test_unported_adver_type_raises(self):
+        for adver_type in ("ot", "mmd", "act_test", "unknown"):
+            with self.assertRaises(ValueError):
+                TFAlbertModel(self.get_config(adver_type=adver_type, att_prior_type="contextual"))
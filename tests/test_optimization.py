@@ -80,6 +80,35 @@ class OptimizationTest(unittest.TestCase):
             w.grad.zero_()
         self.assertListAlmostEqual(w.tolist(), [0.4, 0.2, -0.5], tol=1e-2)
 
+    def test_adam_w_foreach(self):
+        def train(foreach, max_grad_norm, fused_clipping):
+            torch.manual_seed(0)
+            model = torch.nn.Sequential(torch.nn.Linear(5, 7), torch.nn.Linear(7, 3))
+            optimizer = AdamW(
+                [
+                    {"params": [p for p in model.parameters() if p.dim() > 1], "weight_decay": 0.01},
+                    {"params": [p for p in model.parameters() if p.dim() == 1], "weight_decay": 0.0},
+                ],
+                lr=1e-2,
+                foreach=foreach,
+                max_grad_norm=max_grad_norm if fused_clipping else None,
+            )
+            params = [p for group in optimizer.param_groups for p in group["params"]]
+            for _ in range(5):
+                for p in params:
+                    p.grad = 3 * torch.randn_like(p)
+                if max_grad_norm is not None and not fused_clipping:
+                    torch.nn.utils.clip_grad_norm_(params, max_grad_norm)
+                optimizer.step()
+            return params
+
+        for max_grad_norm in (None, 1.0):
+            expected = train(False, max_grad_norm, fused_clipping=False)
+            for foreach in (False, True):
+                for fused_clipping in (False, True) if max_grad_norm else (False,):
+                    for p, q in zip(expected, train(foreach, max_grad_norm, fused_clipping)):
+                        self.assertTrue(torch.equal(p, q))
+
 
 @require_torch
 class ScheduleInitTest(unittest.TestCase):
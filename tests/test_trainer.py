@@ -1,27 +1,70 @@
+import os
+import tempfile
 import unittest
 
+import numpy as np
+
 from transformers import AutoTokenizer, TrainingArguments, is_torch_available
 
-from .utils import require_torch
+from .utils import VARIATIONAL_ATTENTION_CONFIG, require_torch
 
 
 if is_torch_available():
     import torch
+    from torch.utils.data.dataset import Subset
     from transformers import (
+        AllReduceCounter,
+        AlbertConfig,
+        AlbertForSequenceClassification,
+        AttentionStore,
+        BertConfig,
+        BertForSequenceClassification,
+        InputFeatures,
+        StreamingMetrics,
         Trainer,
         LineByLineTextDataset,
         AutoModelForSequenceClassification,
         DefaultDataCollator,
         DataCollatorForLanguageModeling,
+        DataCollatorForFrozenActivations,
+        DataCollatorWithPadding,
         GlueDataset,
         GlueDataTrainingArguments,
         TextDataset,
     )
+    from transformers.trainer import AsyncEvaluator, StepTimer, _stratified_subsample
 
 
 PATH_SAMPLE_TEXT = "./tests/fixtures/sample_text.txt"
 
 
+def _distributed_train_worker(rank, world_size, output_dir, sync_every_micro_batch=False):
+    os.environ["MASTER_ADDR"], os.environ["MASTER_PORT"] = "127.0.0.1", "29511"
+    torch.distributed.init_process_group(backend="gloo", rank=rank, world_size=world_size)
+    trainer = TrainerPredictionLoopTest().get_trainer(
+        local_rank=rank,
+        per_gpu_train_batch_size=2,
+        gradient_accumulation_steps=2,
+        num_train_epochs=1,
+        logging_steps=1,
+        save_steps=0,
+        ddp_sync_every_micro_batch=sync_every_micro_batch,
+    )
+    trainer.train_dataset = TrainerPredictionLoopTest().get_dataset(16)
+    trainer.allreduce_counter = AllReduceCounter()
+    output = trainer.train()
+    torch.save(
+        (
+            output.training_loss,
+            [param.detach() for param in trainer.model.parameters()],
+            trainer.allreduce_counter.calls,
+            trainer.allreduce_counter.bytes,
+        ),
+        os.path.join(output_dir, "rank-{}.pt".format(rank)),
+    )
+    torch.distributed.destroy_process_group()
+
+
 @require_torch
 class DataCollatorIntegrationTest(unittest.TestCase):
     def test_default_classification(self):
@@ -107,3 +150,382 @@ class TrainerIntegrationTest(unittest.TestCase):
             tokenizer=tokenizer, file_path=PATH_SAMPLE_TEXT, block_size=tokenizer.max_len_single_sentence,
         )
         self.assertEqual(len(dataset), 31)
+
+
+@require_torch
+class TrainerPredictionLoopTest(unittest.TestCase):
+    def get_trainer(self, config_kwargs=None, **kwargs):
+        torch.manual_seed(0)
+        config = AlbertConfig(vocab_size=99, embedding_size=16, hidden_size=48, num_attention_heads=12, num_labels=3)
+        config.update(VARIATIONAL_ATTENTION_CONFIG)
+        config.update(config_kwargs or {})
+        model = AlbertForSequenceClassification(config)
+        args = TrainingArguments(output_dir=tempfile.mkdtemp(), no_cuda=True, per_gpu_eval_batch_size=4, **kwargs)
+        return Trainer(model=model, args=args)
+
+    def get_dataset(self, num_examples=10):
+        input_ids = torch.randint(99, (num_examples, 7)).tolist()
+        return [InputFeatures(input_ids=ids, label=i % 3) for i, ids in enumerate(input_ids)]
+
+    def test_predictions_match_model(self):
+        dataset = self.get_dataset()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for predictions_memmap_dir in (None, tmp_dir):
+                trainer = self.get_trainer(predictions_memmap_dir=predictions_memmap_dir)
+                output = trainer.predict(dataset)
+                with torch.no_grad():
+                    expected = trainer.model(torch.tensor([feature.input_ids for feature in dataset]))[0]
+                self.assertEqual(output.predictions.shape, (10, 3))
+                self.assertTrue(np.allclose(output.predictions, expected.numpy(), atol=1e-5))
+                self.assertEqual(output.label_ids.tolist(), [i % 3 for i in range(10)])
+            self.assertTrue(np.allclose(np.load(os.path.join(tmp_dir, "prediction_predictions.npy")), expected))
+
+    def test_parallel_loading_and_prefetch(self):
+        dataset = self.get_dataset()
+        expected = self.get_trainer().predict(dataset)
+        trainer = self.get_trainer(
+            dataloader_num_workers=2, dataloader_persistent_workers=True, background_prefetch_batches=2
+        )
+        output = trainer.predict(dataset)
+        self.assertTrue(np.allclose(output.predictions, expected.predictions, atol=1e-5))
+        self.assertEqual(output.label_ids.tolist(), expected.label_ids.tolist())
+
+        trainer.train_dataset = dataset
+        trainer.args.per_gpu_train_batch_size, trainer.args.num_train_epochs = 2, 1
+        self.assertEqual(trainer.train().global_step, 5)
+
+    def test_dynamic_padding(self):
+        dataset = [
+            InputFeatures(input_ids=torch.randint(1, 99, (length,)).tolist(), attention_mask=[1] * length, label=i % 3)
+            for i, length in enumerate([3, 12, 5, 4, 11, 3, 12, 6, 10, 4])
+        ]
+        batch = DataCollatorWithPadding(pad_token_id=0).collate_batch(dataset[:3])
+        self.assertEqual(batch["input_ids"].shape, (3, 12))
+        self.assertEqual(batch["input_ids"][0, 3:].tolist(), [0] * 9)
+        self.assertEqual(batch["attention_mask"].sum(-1).tolist(), [3, 12, 5])
+
+        trainer = self.get_trainer(dynamic_padding=True)
+        self.assertIsInstance(trainer.data_collator, DataCollatorWithPadding)
+        output = trainer.predict(dataset)
+        with torch.no_grad():
+            expected = torch.cat([trainer.model(torch.tensor([feature.input_ids]))[0] for feature in dataset])
+        self.assertTrue(np.allclose(output.predictions, expected.numpy(), atol=1e-5))
+
+        trainer.train_dataset = dataset
+        trainer.args.per_gpu_train_batch_size, trainer.args.num_train_epochs = 2, 1
+        batches = list(trainer.get_train_dataloader())
+        self.assertEqual(sum(len(batch["labels"]) for batch in batches), 10)
+        # examples of a batch fall in the same bins of 4 tokens, but for the leftovers of the last batch
+        for batch in batches[:-1]:
+            lengths = batch["attention_mask"].sum(-1)
+            self.assertEqual(batch["input_ids"].shape[1], lengths.max())
+            self.assertEqual(len(set(((lengths + 1) // 4).tolist())), 1)
+        self.assertEqual(trainer.train().global_step, 5)
+
+    def test_training_step_losses(self):
+        dataset = self.get_dataset()
+        trainer = self.get_trainer(gradient_accumulation_steps=2, logging_steps=1)
+        inputs = trainer.data_collator.collate_batch(dataset[:4])
+        losses = trainer._training_step(trainer.model, inputs, None, global_step=0)
+        # (loss, task_loss, alignment_loss), scaled by the accumulation steps
+        self.assertEqual(losses.shape, (3,))
+        self.assertFalse(losses.requires_grad)
+        self.assertTrue(torch.allclose(losses[0], losses[1] + trainer.args.att_kl * losses[2]))
+
+        trainer.train_dataset = dataset
+        trainer.args.per_gpu_train_batch_size, trainer.args.num_train_epochs = 2, 1
+        output = trainer.train()
+        self.assertIsInstance(output.training_loss, float)
+        self.assertGreater(output.training_loss, 0.0)
+
+    def test_compute_loss(self):
+        dataset = self.get_dataset()
+        trainer = self.get_trainer(kl_start_step=2, att_kl=0.5)
+        inputs = trainer.data_collator.collate_batch(dataset[:4])
+        # the attention KL term only joins the task loss from kl_start_step on
+        loss, outputs = trainer._compute_loss(trainer.model, inputs, global_step=1)
+        self.assertTrue(torch.equal(loss, outputs[0]))
+        loss, outputs = trainer._compute_loss(trainer.model, inputs, global_step=2)
+        self.assertGreater(outputs[-1].item(), 0.0)
+        self.assertTrue(torch.allclose(loss, outputs[0] + 0.5 * outputs[-1]))
+
+        # the training step backpropagates the loss of the subclasses
+        class DoubleLossTrainer(Trainer):
+            def _compute_loss(self, model, inputs, global_step):
+                loss, outputs = super()._compute_loss(model, inputs, global_step)
+                return 2.0 * loss, outputs
+
+        trainer = DoubleLossTrainer(model=trainer.model, args=trainer.args)
+        losses = trainer._training_step(trainer.model, inputs, None, global_step=2)
+        self.assertTrue(torch.allclose(losses[0], 2.0 * (losses[1] + 0.5 * losses[2])))
+        self.assertTrue(all(param.grad is not None for param in trainer.model.classifier.parameters()))
+
+    def test_async_checkpointing(self):
+        dataset = self.get_dataset()
+        checkpoints = []
+        for async_checkpointing in (False, True):
+            trainer = self.get_trainer(
+                async_checkpointing=async_checkpointing,
+                save_steps=2,
+                save_total_limit=2,
+                per_gpu_train_batch_size=2,
+                num_train_epochs=1,
+            )
+            trainer.train_dataset = dataset
+            trainer.train()
+            self.assertEqual(sorted(os.listdir(trainer.args.output_dir)), ["checkpoint-2", "checkpoint-4"])
+            checkpoint = os.path.join(trainer.args.output_dir, "checkpoint-4")
+            self.assertEqual(
+                sorted(os.listdir(checkpoint)),
+                ["config.json", "optimizer.pt", "pytorch_model.bin", "sampler.pt", "scheduler.pt", "training_args.bin"],
+            )
+            checkpoints.append(checkpoint)
+
+        expected, loaded = (AlbertForSequenceClassification.from_pretrained(path) for path in checkpoints)
+        for (name, parameter), loaded_parameter in zip(expected.named_parameters(), loaded.parameters()):
+            self.assertTrue(torch.equal(parameter, loaded_parameter), name)
+        expected, loaded = (torch.load(os.path.join(path, "optimizer.pt")) for path in checkpoints)
+        self.assertTrue(torch.equal(expected["state"][0]["exp_avg"], loaded["state"][0]["exp_avg"]))
+        self.assertEqual(*(torch.load(os.path.join(path, "scheduler.pt")) for path in checkpoints))
+
+    def test_resume_data_order(self):
+        class RecordingCollator(DefaultDataCollator):
+            def __init__(self):
+                self.batches = []
+
+            def collate_batch(self, features):
+                self.batches.append([feature.input_ids for feature in features])
+                return super().collate_batch(features)
+
+        dataset = self.get_dataset()
+        trainers = []
+        for model_path in (None, "checkpoint-3", "checkpoint-6"):
+            trainer = self.get_trainer(save_steps=3, per_gpu_train_batch_size=2, num_train_epochs=2)
+            trainer.train_dataset, trainer.data_collator = dataset, RecordingCollator()
+            if model_path is not None:
+                trainer.args.output_dir = trainers[0].args.output_dir
+                model_path = os.path.join(trainer.args.output_dir, model_path)
+            self.assertEqual(trainer.train(model_path=model_path).global_step, 10)
+            trainers.append(trainer)
+
+        batches = trainers[0].data_collator.batches
+        self.assertEqual(len(batches), 10)
+        self.assertNotEqual(batches[:5], batches[5:])
+        # the skipped batches are not even collated
+        self.assertEqual(trainers[1].data_collator.batches, batches[3:])
+        self.assertEqual(trainers[2].data_collator.batches, batches[6:])
+
+    def test_evaluation_during_training(self):
+        dataset = self.get_dataset(12)
+        indices = _stratified_subsample(dataset, 6, seed=42)
+        self.assertEqual(sorted(dataset[i].label for i in indices), [0, 0, 1, 1, 2, 2])
+        self.assertEqual(indices, _stratified_subsample(dataset, 6, seed=42))
+
+        trainer = self.get_trainer()
+        trainer.eval_dataset = dataset
+        expected = trainer.evaluate()
+        evaluator = AsyncEvaluator(trainer)
+        evaluator.submit(3, "eval_", trainer.model)
+        evaluator.submit(3, "eval_subsample_", trainer.model, indices)
+        results = evaluator.close()
+        self.assertAlmostEqual(results["eval_loss"], expected["loss"], places=5)
+        self.assertAlmostEqual(results["eval_subsample_loss"], trainer.evaluate(Subset(dataset, indices))["loss"])
+        self.assertEqual(results["eval_step"], 3)
+
+        for async_evaluation in (False, True):
+            trainer = self.get_trainer(
+                evaluate_during_training=True,
+                eval_subsample_size=6,
+                full_eval_steps=4,
+                async_evaluation=async_evaluation,
+                logging_steps=2,
+                per_gpu_train_batch_size=2,
+                num_train_epochs=1,
+            )
+            trainer.train_dataset, trainer.eval_dataset = dataset, dataset
+            logs = {}
+            trainer._log = lambda step_logs, global_step, iterator=None: logs.update(step_logs)
+            trainer.train()
+            self.assertIn("eval_loss", logs)
+            self.assertIn("eval_subsample_loss", logs)
+            if async_evaluation:
+                self.assertEqual(logs["eval_step"], 4)
+
+        # the metrics of the last evaluations, logged after the progress bars are closed, go to the logger
+        with self.assertLogs("transformers.trainer", level="INFO") as captured:
+            self.get_trainer()._log({"eval_loss": 1.0}, global_step=6)
+        self.assertIn('"eval_loss": 1.0', captured.output[-1])
+
+    def test_attention_store_skips_evaluation(self):
+        dataset = self.get_dataset(12)
+        store_dir = tempfile.mkdtemp()
+        trainer = self.get_trainer(
+            evaluate_during_training=True,
+            logging_steps=2,
+            per_gpu_train_batch_size=2,
+            num_train_epochs=1,
+            attention_store_dir=store_dir,
+            attention_store_rate=1.0,
+        )
+        trainer.train_dataset, trainer.eval_dataset = dataset, dataset
+        trainer.train()
+
+        # the 6 training batches of 2 examples, but none of the 3 evaluations of 12 examples in between
+        index = AttentionStore(os.path.join(store_dir, "rank-0")).index
+        self.assertEqual(sorted({entry["forward"] for entry in index}), list(range(6)))
+        self.assertEqual(sorted({entry["global_step"] for entry in index}), list(range(6)))
+        self.assertEqual(sorted({entry["row"] for entry in index}), [0, 1])
+
+    def test_cpu_distributed_training(self):
+        gradient_bytes = sum(param.numel() * param.element_size() for param in self.get_trainer().model.parameters())
+        allreduce_calls = []
+        for sync_every_micro_batch in (False, True):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                torch.multiprocessing.spawn(
+                    _distributed_train_worker, args=(2, tmp_dir, sync_every_micro_batch), nprocs=2, join=True
+                )
+                (loss_0, params_0, calls, allreduce_bytes), (loss_1, params_1, _, _) = [
+                    torch.load(os.path.join(tmp_dir, "rank-{}.pt".format(rank))) for rank in range(2)
+                ]
+            # the ranks trained on different batches, accumulated without all-reduce between the optimizer steps but
+            # stayed in sync, and report the loss of the global batches
+            self.assertEqual(loss_0, loss_1)
+            for param_0, param_1 in zip(params_0, params_1):
+                self.assertTrue(torch.equal(param_0, param_1))
+            self.assertFalse(torch.equal(params_0[0], next(self.get_trainer().model.parameters())))
+            # 8 examples per rank: 2 optimization steps of 2 micro-batches, all-reducing every gradient once per
+            # optimization step, or once per micro-batch without no_sync
+            self.assertEqual(allreduce_bytes, (4 if sync_every_micro_batch else 2) * gradient_bytes)
+            allreduce_calls.append(calls)
+        self.assertEqual(allreduce_calls[1], 2 * allreduce_calls[0])
+
+    def test_step_timing(self):
+        trainer = self.get_trainer(
+            step_timing=True, profile_steps="2-3", logging_steps=2, per_gpu_train_batch_size=2, num_train_epochs=1
+        )
+        trainer.train_dataset = self.get_dataset()
+        logs = {}
+        trainer._log = lambda step_logs, global_step, iterator=None: logs.update(step_logs)
+        trainer.train()
+        for phase in ("data", "h2d", "forward_task", "forward_alignment", "backward", "optimizer", "other"):
+            self.assertGreaterEqual(logs["step_seconds_" + phase], 0.0)
+        self.assertGreater(logs["step_seconds_forward_task"], 0.0)
+        self.assertGreater(logs["tokens_per_second"], logs["samples_per_second"])
+        self.assertTrue(os.path.isfile(os.path.join(trainer.args.output_dir, "trace-steps-2-3.json")))
+        # the timer is detached from the attention layers after training
+        self.assertIsNone(trainer._step_timer)
+        self.assertTrue(all(getattr(module, "alignment_timer", None) is None for module in trainer.model.modules()))
+
+        # the whole alignment branch is timed, e.g. the Sinkhorn iterations of ot, which run no submodule
+        trainer = self.get_trainer(config_kwargs={"adver_type": "ot"})
+        timer = StepTimer(trainer.args.device).attach(trainer.model)
+        inputs = trainer.data_collator.collate_batch(self.get_dataset()[:4])
+        trainer.model.train()(**inputs)
+        timer.lap("forward")
+        self.assertGreater(timer.seconds["forward_alignment"], 0.0)
+        self.assertGreater(timer.seconds["forward_task"], 0.0)
+        timer.close()
+
+    def check_frozen_layers(self, trainer, frozen_params, trained_params):
+        dataset = self.get_dataset()
+        trainer.train_dataset = dataset
+        model = trainer.model.eval()
+        frozen_dataset = trainer.get_frozen_train_dataset()
+        self.assertEqual(frozen_dataset.hidden_states.shape, (10, 7, 48))
+        self.assertTrue(os.path.isfile(frozen_dataset.cache_file))
+        # the upper layers on the cached activations give the outputs of the whole model
+        batch = DataCollatorForFrozenActivations(DefaultDataCollator()).collate_batch(list(frozen_dataset))
+        self.assertEqual(sorted(batch), ["frozen_hidden_states", "labels"])
+        with torch.no_grad():
+            expected = model(torch.tensor([feature.input_ids for feature in dataset]))[0]
+            logits = model(frozen_hidden_states=batch["frozen_hidden_states"])[0]
+        self.assertTrue(torch.allclose(logits, expected, atol=1e-5))
+
+        frozen = [param.detach().clone() for param in frozen_params]
+        trained = [param.detach().clone() for param in trained_params]
+        self.assertEqual(trainer.train().global_step, 5)
+        for param, before in zip(frozen_params, frozen):
+            self.assertFalse(param.requires_grad)
+            self.assertTrue(torch.equal(param, before))
+        self.assertTrue(any(not torch.equal(param, before) for param, before in zip(trained_params, trained)))
+
+        # after training too, the cached activations are those of the bottom of the model
+        with torch.no_grad():
+            model.eval()
+            inputs = DefaultDataCollator().collate_batch(dataset)
+            hidden_states = model.base_model.encode_frozen(inputs["input_ids"])
+        self.assertTrue(torch.allclose(hidden_states, batch["frozen_hidden_states"], atol=1e-5))
+        return frozen_dataset
+
+    def test_frozen_layers(self):
+        # 12 iterations over 2 layer groups: the first 6 ones run the first group
+        config_kwargs = {"frozen_layers": 6, "num_hidden_groups": 2}
+        trainer = self.get_trainer(
+            config_kwargs=config_kwargs, per_gpu_train_batch_size=2, num_train_epochs=1, save_steps=0
+        )
+        albert = trainer.model.albert
+        frozen_dataset = self.check_frozen_layers(
+            trainer,
+            list(albert.embeddings.parameters()) + list(albert.encoder.albert_layer_groups[0].parameters()),
+            list(albert.encoder.albert_layer_groups[1].parameters()) + list(trainer.model.classifier.parameters()),
+        )
+
+        # a run with the same frozen weights and training set reuses the cache
+        trainer = self.get_trainer(config_kwargs=config_kwargs, frozen_activations_dir=trainer.args.output_dir)
+        trainer.train_dataset = self.get_dataset()
+        self.assertEqual(trainer.get_frozen_train_dataset().cache_file, frozen_dataset.cache_file)
+
+        # with a single group, the frozen iterations would share their weights with the trained ones
+        with self.assertRaises(ValueError):
+            self.get_trainer(config_kwargs={"frozen_layers": 6})
+
+    def test_frozen_layers_bert(self):
+        torch.manual_seed(0)
+        config = BertConfig(
+            vocab_size=99,
+            hidden_size=48,
+            num_hidden_layers=4,
+            num_attention_heads=12,
+            intermediate_size=37,
+            num_labels=3,
+        )
+        config.update(VARIATIONAL_ATTENTION_CONFIG)
+        config.update({"frozen_layers": 2})
+        model = BertForSequenceClassification(config)
+        args = TrainingArguments(
+            output_dir=tempfile.mkdtemp(),
+            no_cuda=True,
+            per_gpu_eval_batch_size=4,
+            per_gpu_train_batch_size=2,
+            num_train_epochs=1,
+            save_steps=0,
+        )
+        bert = model.bert
+        self.check_frozen_layers(
+            Trainer(model=model, args=args),
+            list(bert.embeddings.parameters()) + list(bert.encoder.layer[:2].parameters()),
+            list(bert.encoder.layer[2:].parameters()) + list(model.classifier.parameters()),
+        )
+
+    def test_streaming_metrics(self):
+        class Accuracy(StreamingMetrics):
+            def reset(self):
+                self.correct, self.total, self.updates = 0, 0, 0
+
+            def update(self, p):
+                self.correct += (p.predictions.argmax(-1) == p.label_ids).sum()
+                self.total += len(p.label_ids)
+                self.updates += 1
+
+            def compute(self):
+                return {"acc": self.correct / self.total}
+
+        dataset = self.get_dataset()
+        trainer = self.get_trainer()
+        output = trainer.predict(dataset)
+        expected = (output.predictions.argmax(-1) == output.label_ids).mean()
+
+        trainer.compute_metrics = Accuracy()
+        self.assertAlmostEqual(trainer.evaluate(dataset)["acc"], expected)
+        self.assertEqual(trainer.compute_metrics.updates, 3)
+        self.assertAlmostEqual(trainer.predict(dataset).metrics["acc"], expected)
@@ -9,6 +9,31 @@ SMALL_MODEL_IDENTIFIER = "julien-c/bert-xsmall-dummy"
 DUMMY_UNKWOWN_IDENTIFIER = "julien-c/dummy-unknown"
 # Used to test Auto{Config, Model, Tokenizer} model_type detection.
 
+# Config attributes read by the (variational) attention layers, with the defaults run_glue.py passes.
+VARIATIONAL_ATTENTION_CONFIG = dict(
+    att_type="soft_attention",
+    adver_type="none",
+    rho=0.5,
+    smyrf=False,
+    n_hashes=8,
+    k_cluster_size=32,
+    q_cluster_size=32,
+    r=4,
+    k_weibull=1000.0,
+    att_prior_type="constant",
+    alpha_gamma=1.0,
+    beta_gamma=1.0,
+    prior_gamma=1.7,
+    three_initial=0.0,
+    sigma_normal_prior=1.0,
+    sigma_normal_posterior=1.0,
+    att_contextual_se=1,
+    att_se_hid_size=10,
+    att_se_nonlinear="relu",
+    label_noise=0.0,
+    k_parameterization="blue",
+)
+
 
 def parse_flag_from_env(key, default=False):
     try: